@@ -0,0 +1,65 @@
+'''
+Micro-batching of prediction windows across tags that share a model.
+
+Each tag submits its (1, timesteps, 10) window and awaits its own row of the
+result. Windows queue up until max_batch of them are waiting or the first has
+waited max_wait seconds, then run as one (B, timesteps, 10) call, so a
+backend's per-call overhead is paid once per batch instead of once per window.
+'''
+import numpy
+import asyncio
+
+MAX_BATCH = 32
+MAX_WAIT = 0.005
+
+
+class MicroBatcher:
+
+    def __init__(self, infer, max_batch=MAX_BATCH, max_wait=MAX_WAIT):
+        if max_batch < 1:
+            raise ValueError(f"max_batch must be at least 1, got {max_batch}")
+        self._infer = infer
+        self._max_batch = max_batch
+        self._max_wait = max_wait
+        self._windows = []
+        self._futures = []
+        self._timer = None
+        self.batches = 0
+        self.windows = 0
+
+    async def submit(self, window):
+        '''Queues one window and returns its row of the batched result'''
+        future = asyncio.get_event_loop().create_future()
+        # windows may be views into a tag's ring buffer, that tag is blocked here until its row comes back
+        self._windows.append(window)
+        self._futures.append(future)
+        if len(self._windows) >= self._max_batch:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self._max_wait, self.flush)
+        return await future
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._windows:
+            return
+        windows, futures = self._windows, self._futures
+        self._windows, self._futures = [], []
+        try:
+            result = self._infer(numpy.concatenate(windows))
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.batches += 1
+        self.windows += len(windows)
+        for i, future in enumerate(futures):
+            # a tag cancelled while waiting simply drops its row
+            if not future.done():
+                future.set_result(result[i])
+
+    def mean_batch(self):
+        return self.windows / self.batches if self.batches else 0.0
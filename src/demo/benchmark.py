@@ -0,0 +1,967 @@
+import io
+import json
+import os
+import sys
+import numpy
+import struct
+import random
+import asyncio
+import threading
+import itertools
+import collections
+import queue
+import socket
+import subprocess
+import tempfile
+import tracemalloc
+
+from time import time, perf_counter
+from functools import partial
+from contextlib import redirect_stdout
+from argparse import ArgumentParser
+
+# numpy only; bleak, paho and the modules built on them are imported by the benchmarks that use them
+from window_buffer import CHANNELS, WindowBuffer
+from inference import BACKENDS, load_backend, warm_up
+from replay import ReplayClient, load_recording
+from batching import MicroBatcher, MAX_BATCH, MAX_WAIT
+from wire import FORMATS, DTYPE_CODES, encode, decode
+from mqtt_async import MQTT_TRANSPORTS
+
+PREDICT_TOPICS = "Group_12/LSTM/predict/#"
+# upper edges of the latency histogram buckets, in ms
+HISTOGRAM_EDGES = [1, 2, 5, 10, 20, 50, 100, 200, 500]
+RECORDING = os.path.join(sys.path[0], "..", "..", "ProjectData", "test.zip")
+SAMPLE_RATE = 10
+# seconds between the publishing steps of the outage benchmark
+OUTAGE_STEP = 0.01
+
+BARO_PAYLOAD = bytes([0x00, 0x0A, 0x00, 0x10, 0x8A, 0x01])
+MOTION_PAYLOAD = struct.pack("<hhhhhhhhh", 10, -20, 30, 100, 200, 4000, -5, 6, 7)
+
+
+class FakeSensorTagClient:
+    '''Stands in for BleakClient: every GATT request costs one round trip, notifications fire every period'''
+
+    def __init__(self, address=None, round_trip=0.075, period=0.1):
+        from sensortag import BarometerSensor, MovementSensorMPU9250
+
+        self._round_trip = round_trip
+        self._period = period
+        self._notifiers = []
+        self._baro_uuid = BarometerSensor().data_uuid
+        self._motion_uuid = MovementSensorMPU9250().data_uuid
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        for task in self._notifiers:
+            task.cancel()
+
+    async def is_connected(self):
+        return True
+
+    async def write_gatt_char(self, uuid, data):
+        await asyncio.sleep(self._round_trip)
+
+    async def read_gatt_char(self, uuid):
+        await asyncio.sleep(self._round_trip)
+        return self._payload(uuid)
+
+    async def start_notify(self, uuid, callback):
+        self._notifiers.append(asyncio.ensure_future(self._notify(uuid, callback)))
+
+    def _payload(self, uuid):
+        if uuid == self._baro_uuid:
+            return bytearray(BARO_PAYLOAD)
+        if uuid == self._motion_uuid:
+            return bytearray(MOTION_PAYLOAD)
+        return bytearray([100])
+
+    async def _notify(self, uuid, callback):
+        while True:
+            await asyncio.sleep(self._period)
+            callback(uuid, self._payload(uuid))
+
+
+def movement_sensor():
+    from sensortag import (MovementSensorMPU9250, AccelerometerSensorMovementSensorMPU9250,
+                           GyroscopeSensorMovementSensorMPU9250, MagnetometerSensorMovementSensorMPU9250)
+
+    sensor = MovementSensorMPU9250()
+    sensor.register(AccelerometerSensorMovementSensorMPU9250())
+    sensor.register(GyroscopeSensorMovementSensorMPU9250())
+    sensor.register(MagnetometerSensorMovementSensorMPU9250())
+    return sensor
+
+
+async def measure_ingest(stream_mode, duration, round_trip, period):
+    from sensortag import SensorStream, BarometerSensor
+
+    async with FakeSensorTagClient(round_trip=round_trip, period=period) as client:
+        stream = SensorStream(BarometerSensor(), movement_sensor())
+        if stream_mode:
+            await stream.subscribe(client)
+            poller = None
+        else:
+            poller = asyncio.ensure_future(stream.poll(client))
+
+        received = 0
+        start = time()
+        try:
+            while time() - start < duration:
+                try:
+                    await asyncio.wait_for(stream.get(), timeout=duration)
+                except asyncio.TimeoutError:
+                    break
+                received += 1
+        finally:
+            if poller is not None:
+                poller.cancel()
+        return received / (time() - start), stream.dropped
+
+
+def bench_ingest(args):
+    print(f"GATT round trip: {args.round_trip * 1000:.0f}ms, notify period: {args.period * 1000:.0f}ms")
+    loop = asyncio.get_event_loop()
+    for name, stream_mode in (("poll", False), ("stream", True)):
+        rate, dropped = loop.run_until_complete(
+            measure_ingest(stream_mode, args.duration, args.round_trip, args.period))
+        print(f"{name:>8}: {rate:6.2f} samples/s, dropped: {dropped}")
+
+
+def decision_latency(rows, labels, timesteps, hop):
+    '''
+    Feeds the stream through a WindowBuffer and lets the majority label of each
+    window stand in for the model, so only the windowing delay is measured.
+    Returns the samples from each label change to its first decision and the
+    number of decisions made.
+    '''
+    buffer = WindowBuffer(timesteps, hop)
+    onsets = list(numpy.flatnonzero(numpy.diff(labels)) + 1)
+    latencies = []
+    decisions = 0
+    for k, row in enumerate(rows):
+        buffer.append_row(row)
+        if not buffer.ready():
+            continue
+        buffer.window()
+        decisions += 1
+        decided = numpy.bincount(labels[k - timesteps + 1:k + 1]).argmax()
+        while onsets and k >= onsets[0] and decided == labels[onsets[0]]:
+            latencies.append(k - onsets.pop(0) + 1)
+        # a label that never wins a window before the next change counts as missed
+        while len(onsets) > 1 and k >= onsets[1]:
+            onsets.pop(0)
+    return numpy.array(latencies), decisions
+
+
+def bench_window(args):
+    _, rows, labels = load_recording(args.recording)
+    seconds = len(rows) / SAMPLE_RATE
+    print(f"{args.recording}: {len(rows)} samples, {numpy.count_nonzero(numpy.diff(labels))} label changes")
+    hops = args.hop or range(1, args.timesteps + 1)
+    for hop in hops:
+        # recorded gestures start on window boundaries, so average over every phase
+        results = [decision_latency(rows[offset:], labels[offset:], args.timesteps, hop)
+                   for offset in range(args.timesteps)]
+        latencies = numpy.concatenate([r[0] for r in results]) * 1000.0 / SAMPLE_RATE
+        decisions = results[0][1]
+        print(f"hop {hop}: mean latency {latencies.mean():6.0f}ms, p90 {numpy.percentile(latencies, 90):6.0f}ms, "
+              f"{decisions / seconds:5.2f} predictions/s")
+
+
+def bench_inference(args):
+    windows = numpy.random.rand(args.runs + 1, 1, args.timesteps, len(CHANNELS)).astype(numpy.float32)
+    print(f"{args.model}: {args.runs} single-window calls per backend")
+    for name in args.backend or BACKENDS:
+        infer = load_backend(args.model, name)
+        times = []
+        for window in windows:
+            start = time()
+            infer(window)
+            times.append((time() - start) * 1000.0)
+        # the first call pays tracing and allocation, keep it out of the percentiles
+        first, times = times[0], numpy.array(times[1:])
+        print(f"{name:>9}: first {first:8.2f}ms, p50 {numpy.percentile(times, 50):6.2f}ms, "
+              f"p99 {numpy.percentile(times, 99):6.2f}ms")
+
+
+def bench_warmup(args):
+    windows = numpy.random.rand(args.runs + 1, 1, args.timesteps, len(CHANNELS)).astype(numpy.float32)
+    print(f"{args.model}: first window vs the next {args.runs}, freshly loaded each time")
+    for name in args.backend or BACKENDS:
+        for warm in (False, True):
+            infer = load_backend(args.model, name)
+            warmup = warm_up(infer, args.timesteps) * 1000.0 if warm else 0.0
+            times = []
+            for window in windows:
+                start = perf_counter()
+                infer(window)
+                times.append((perf_counter() - start) * 1000.0)
+            first, p99 = times[0], numpy.percentile(times[1:], 99)
+            print(f"{name:>9} {'warm' if warm else 'cold':>4}: warm-up {warmup:8.2f}ms, first {first:8.2f}ms, "
+                  f"p50 {numpy.percentile(times[1:], 50):6.2f}ms, p99 {p99:6.2f}ms, first {'<=' if first <= p99 else '>'} p99")
+
+
+async def simulated_tag(predict, windows, period, duration, latencies):
+    '''Predicts one window every period seconds (back to back when 0) for duration seconds'''
+    start = perf_counter()
+    tick = 0
+    while perf_counter() - start < duration:
+        window = windows[tick % len(windows)]
+        t = perf_counter()
+        await predict(window)
+        latencies.append(perf_counter() - t)
+        tick += 1
+        # always yield, an unbatched call never does on its own
+        await asyncio.sleep(max(0.0, start + tick * period - perf_counter()))
+
+
+def bench_batching(args):
+    infer = load_backend(args.model, args.backend)
+    windows = numpy.random.rand(64, 1, args.timesteps, len(CHANNELS)).astype(numpy.float32)
+    infer(numpy.concatenate(windows))
+    loop = asyncio.get_event_loop()
+    print(f"{args.model} ({args.backend}), period {args.period or 'back to back'}, "
+          f"batches of up to {args.max_batch} waiting at most {args.max_wait}ms")
+    for tags in args.tags:
+        for mode in ("single", "batched"):
+            batcher = MicroBatcher(infer, args.max_batch, args.max_wait / 1000.0)
+
+            async def single(window):
+                return infer(window)[0]
+
+            predict = batcher.submit if mode == "batched" else single
+            latencies = []
+            start = perf_counter()
+            loop.run_until_complete(asyncio.gather(*[simulated_tag(predict, windows, args.period, args.duration, latencies)
+                                                     for _ in range(tags)]))
+            elapsed = perf_counter() - start
+            latencies = numpy.array(latencies) * 1000.0
+            batches = f", mean batch {batcher.mean_batch():.1f}" if mode == "batched" else ""
+            print(f"{tags:>3} tags {mode:>8}: {len(latencies) / elapsed:8.1f} windows/s, "
+                  f"latency p50 {numpy.percentile(latencies, 50):6.2f}ms p99 {numpy.percentile(latencies, 99):6.2f}ms{batches}")
+
+
+def legacy_encode(window):
+    # what demo_send.py used to publish
+    return json.dumps({"data": window.tolist(), "batterylife": 100})
+
+
+def legacy_decode(payload):
+    recv_dict = json.loads(payload)
+    return numpy.array(recv_dict["data"])
+
+
+def bench_wire(args):
+    _, rows, _ = load_recording(args.recording)
+    n = len(rows) // args.timesteps
+    windows = rows[:n * args.timesteps].reshape(n, 1, args.timesteps, len(CHANNELS))
+    # the same samples packed args.batch windows per message
+    m = n // args.batch
+    batches = rows[:m * args.batch * args.timesteps].reshape(m, args.batch, args.timesteps, len(CHANNELS))
+    print(f"{n} windows of {args.recording}, {args.repeat} passes")
+    codecs = [("legacy json", windows, legacy_encode, legacy_decode)]
+    codecs += [(fmt, windows, partial(encode, device="Sean", battery=100, fmt=fmt), lambda payload: decode(payload).window)
+               for fmt in FORMATS]
+    for fmt in DTYPE_CODES:
+        for delta, compress in [(False, False), (True, False), (False, True), (True, True)]:
+            name = f"{fmt} x{args.batch}" + (" delta" if delta else "") + (" zlib" if compress else "")
+            codecs.append((name, batches, partial(encode, device="Sean", battery=100, fmt=fmt, delta=delta, compress=compress),
+                           lambda payload: decode(payload).window))
+    for name, windows, enc, dec in codecs:
+        n = len(windows)
+        start = perf_counter()
+        for _ in range(args.repeat):
+            payloads = [enc(window) for window in windows]
+        encode_time = (perf_counter() - start) / (args.repeat * n)
+        start = perf_counter()
+        for _ in range(args.repeat):
+            decoded = [dec(payload) for payload in payloads]
+        decode_time = (perf_counter() - start) / (args.repeat * n)
+        error = max(numpy.abs(numpy.asarray(d) - w).max() for d, w in zip(decoded, windows))
+        size = numpy.mean([len(payload) for payload in payloads])
+        per_sample = size / (windows.shape[1] * windows.shape[2])
+        print(f"{name:>21}: {size:7.1f} bytes/message, {per_sample:5.1f} bytes/sample, encode {encode_time * 1e6:7.1f}us, "
+              f"decode {decode_time * 1e6:7.1f}us, max error {error:.2g}")
+        # float32 and json give the samples back as sent, int16 to within a quantization step per channel
+        tolerance = numpy.abs(windows).max() * 1e-6
+        if name.startswith("int16"):
+            tolerance += max(numpy.ptp(w.reshape(-1, w.shape[-1]), axis=0).max() for w in windows) / 65534
+        assert len(decoded) == n and error <= tolerance, f"{name}: max error {error:.2g}, allowed {tolerance:.2g}"
+
+
+class LoopbackMessage:
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class LoopbackBroker:
+    '''
+    Stands in for a broker and its network: publishes reach the subscribers of the
+    topic (a trailing + matches one level) after a one-way delay, and a fraction
+    `loss` of them never arrive. Deliveries run on one thread, like paho's.
+    '''
+
+    def __init__(self, delay, loss=0.0):
+        self._delay = delay
+        self._loss = loss
+        self._subscriptions = []
+        self._order = itertools.count()
+        self._queue = queue.PriorityQueue()
+        self._thread = threading.Thread(target=self._deliver, daemon=True)
+        self._thread.start()
+
+    def subscribe(self, pattern, on_message):
+        self._subscriptions.append((pattern, on_message))
+
+    def publish(self, topic, payload):
+        if random.random() >= self._loss:
+            self._queue.put((perf_counter() + self._delay, next(self._order), topic, payload))
+
+    def close(self):
+        self._queue.put((0.0, -1, None, None))
+
+    def _deliver(self):
+        while True:
+            due, _, topic, payload = self._queue.get()
+            if topic is None:
+                return
+            time_left = due - perf_counter()
+            if time_left > 0:
+                threading.Event().wait(time_left)
+            for pattern, on_message in self._subscriptions:
+                if topic == pattern or (pattern.endswith("+") and topic.rsplit("/", 1)[0] == pattern[:-2]):
+                    on_message(self, None, LoopbackMessage(topic, payload))
+
+
+async def send_windows(uplink, windows, period, duration, stop_and_wait=False):
+    start = perf_counter()
+    while perf_counter() - start < duration:
+        # the time the tag takes to sample a window
+        await asyncio.sleep(period)
+        await uplink.send(windows[uplink.windows % len(windows)], battery=100)
+        if stop_and_wait:
+            # what demo_send did before: nothing is sampled until the answer is back
+            await uplink.drain()
+    elapsed = perf_counter() - start
+    await uplink.drain()
+    uplink.close()
+    return elapsed
+
+
+def bench_uplink(args):
+    from uplink import Uplink, RESULT_TOPIC
+    from demo_receive import InferenceServer, CLASSIFY_TOPIC
+
+    _, rows, _ = load_recording(args.recording)
+    n = len(rows) // args.timesteps
+    windows = rows[:n * args.timesteps].reshape(n, 1, args.timesteps, len(CHANNELS))
+    with redirect_stdout(io.StringIO()):
+        server = InferenceServer(args.model, args.backend)
+    loop = asyncio.get_event_loop()
+    print(f"one window every {args.period}s sampled, {args.loss:.0%} loss, timeout {args.timeout}s")
+    for rtt in args.rtt:
+        for in_flight in [0] + args.in_flight:
+            broker = LoopbackBroker(rtt / 2, args.loss)
+            uplink = Uplink(broker, "Bench", max(in_flight, 1), args.timeout, args.retries, on_result=lambda result: None)
+            broker.subscribe(CLASSIFY_TOPIC, server.on_message)
+            broker.subscribe(RESULT_TOPIC.format("Bench"), uplink.on_message)
+            with redirect_stdout(io.StringIO()):
+                elapsed = loop.run_until_complete(send_windows(uplink, windows, args.period, args.duration, in_flight == 0))
+            broker.close()
+            rtts = numpy.array(uplink.rtts) * 1000.0
+            mode = f"in flight {in_flight:>2}" if in_flight else "stop-and-wait"
+            print(f"rtt {rtt * 1000:5.0f}ms, {mode:>13}: {uplink.sequence / elapsed:6.2f} windows/s, "
+                  f"result rtt p50 {numpy.percentile(rtts, 50):7.1f}ms, {uplink.stats()}")
+            # every message answered or given up on after its retries, none given up on without loss
+            assert uplink.acked + uplink.lost == uplink.sequence, uplink.stats()
+            assert args.loss or not uplink.lost, uplink.stats()
+
+
+def bench_batch(args):
+    from uplink import Uplink, RESULT_TOPIC
+    from demo_receive import InferenceServer, CLASSIFY_TOPIC
+
+    _, rows, _ = load_recording(args.recording)
+    n = len(rows) // args.timesteps
+    windows = rows[:n * args.timesteps].reshape(n, 1, args.timesteps, len(CHANNELS))
+    with redirect_stdout(io.StringIO()):
+        server = InferenceServer(args.model, args.backend)
+    loop = asyncio.get_event_loop()
+    print(f"one window every {args.period}s sampled, rtt {args.rtt * 1000:.0f}ms, linger {args.linger:.0f}ms, {args.wire}")
+    for batch in args.batch:
+        for delta, compress in [(False, False), (False, True), (True, True)] if batch > 1 else [(False, False)]:
+            broker = LoopbackBroker(args.rtt / 2)
+            answered = []
+            # a sender of its own per setting, the server would take its sequence numbers for resends
+            name = f"Bench{len(server.clients)}"
+            uplink = Uplink(broker, name, args.in_flight, fmt=args.wire, on_result=answered.append, max_batch=batch,
+                            linger=args.linger / 1000.0, delta=delta, compress=compress)
+            broker.subscribe(CLASSIFY_TOPIC, server.on_message)
+            broker.subscribe(RESULT_TOPIC.format(name), uplink.on_message)
+            with redirect_stdout(io.StringIO()):
+                elapsed = loop.run_until_complete(send_windows(uplink, windows, args.period, args.duration))
+            broker.close()
+            results = sum(len(result.get("results", [result])) for result in answered)
+            rtts = numpy.array(uplink.rtts) * 1000.0
+            mode = f"batch {batch:>2}" + (" delta" if delta else "") + (" zlib" if compress else "")
+            print(f"{mode:>19}: {uplink.windows / elapsed:6.1f} windows/s in {uplink.sequence / elapsed:6.1f} msgs/s, "
+                  f"{uplink.bytes_per_sample():5.1f} bytes/sample, {results} results, "
+                  f"result rtt p50 {numpy.percentile(rtts, 50):6.1f}ms")
+
+
+def bench_server(args):
+    from uplink import RESULT_TOPIC
+    from demo_receive import InferenceServer, CLASSIFY_TOPIC
+
+    _, rows, _ = load_recording(args.recording)
+    n = len(rows) // args.timesteps
+    windows = rows[:n * args.timesteps].reshape(n, 1, args.timesteps, len(CHANNELS))
+    pace = f"every {args.period}s" if args.period else "as fast as the broker takes them"
+    print(f"{args.senders} senders, {args.windows} windows each, sent {pace}")
+    for workers in args.workers:
+        with redirect_stdout(io.StringIO()):
+            server = InferenceServer(args.model, args.backend)
+        if workers:
+            server.use_pool(workers, args.batch, args.max_wait / 1000.0)
+        broker = LoopbackBroker(0.0)
+        broker.subscribe(CLASSIFY_TOPIC, server.on_message)
+        sent, latencies = {}, []
+        answered = threading.Semaphore(0)
+
+        def on_result(client, userdata, msg):
+            # publish to answer, including any wait in the broker before the server sees the window
+            latencies.append(perf_counter() - sent[msg.topic.rsplit("/", 1)[-1], json.loads(msg.payload)["sequence"]])
+            answered.release()
+
+        for sender in range(args.senders):
+            broker.subscribe(RESULT_TOPIC.format(f"Sender{sender}"), on_result)
+        start = perf_counter()
+        with redirect_stdout(io.StringIO()):
+            for i in range(args.windows):
+                threading.Event().wait(max(0.0, start + i * args.period - perf_counter()))
+                for sender in range(args.senders):
+                    name = f"Sender{sender}"
+                    sent[name, i] = perf_counter()
+                    broker.publish(f"Group_12/LSTM/classify/{name}", encode(windows[i % n], device=name, sequence=i))
+            for _ in range(args.senders * args.windows):
+                answered.acquire()
+        elapsed = perf_counter() - start
+        broker.close()
+        server.close()
+        latencies = numpy.array(latencies) * 1000.0
+        batches = f", batch mean {numpy.mean(server._pool.batch_sizes):.1f}" if workers else ""
+        mode = f"{workers} workers" if workers else "inline"
+        print(f"{mode:>10}: {len(latencies) / elapsed:8.1f} windows/s, latency p50 {numpy.percentile(latencies, 50):7.2f}ms "
+              f"p99 {numpy.percentile(latencies, 99):7.2f}ms{batches}")
+
+
+class NullPublisher:
+    '''Counts publishes instead of sending them to a broker'''
+
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, payload):
+        self.published += 1
+
+
+async def replay_pipeline(tag, replay, stream):
+    run = asyncio.ensure_future(tag.run(stream=stream, client_factory=lambda address: replay))
+    finished = asyncio.ensure_future(replay.finished.wait())
+    done, _ = await asyncio.wait([run, finished], return_when=asyncio.FIRST_COMPLETED)
+    if run in done:
+        # run only returns early on an error, surface it
+        finished.cancel()
+        run.result()
+    run.cancel()
+    await asyncio.gather(run, return_exceptions=True)
+
+
+def bench_pipeline(args):
+    from sensortag import SensorTag
+
+    publisher = NullPublisher()
+    tag = SensorTag(address= "replay", name= "permas", model= args.model, mqtt_client= publisher,
+                    hop= args.hop, backend= args.backend)
+
+    tag.predict_latencies = collections.deque()
+    replay = ReplayClient(source= args.recording, speed= args.speed)
+    loop = asyncio.get_event_loop()
+    start = perf_counter()
+    with redirect_stdout(io.StringIO()):
+        loop.run_until_complete(replay_pipeline(tag, replay, args.stream))
+    elapsed = perf_counter() - start
+
+    latencies = numpy.array(tag.predict_latencies) * 1000.0
+    print(f"{args.recording} at speed {args.speed or 'max'}: {tag.samples} samples in {elapsed:.2f}s "
+          f"({tag.samples / elapsed:.1f} samples/s), {len(latencies)} predictions, {publisher.published} publishes")
+    print(f"predict latency p50 {numpy.percentile(latencies, 50):.2f}ms, p99 {numpy.percentile(latencies, 99):.2f}ms")
+
+
+class TimedReplayClient(ReplayClient):
+    '''ReplayClient noting when each sample is handed to the tag'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sample_times = []
+
+    def _advance(self):
+        self.sample_times.append(perf_counter())
+        super()._advance()
+
+
+class TimedPublisher:
+    '''Publishes through a real MQTT client, noting for every message when the newest sample behind it arrived'''
+
+    def __init__(self, mqtt_client, tag, replay):
+        self._client = mqtt_client
+        self._tag = tag
+        self._replay = replay
+        self.sent = collections.defaultdict(collections.deque)
+
+    def publish(self, topic, payload):
+        # the tag has just consumed its samples-th sample, the newest one in the window
+        self.sent[topic].append((self._replay.sample_times[self._tag.samples - 1], perf_counter()))
+        return self._client.publish(topic, payload)
+
+    def pending(self):
+        return sum(len(sent) for sent in self.sent.values())
+
+
+def histogram(latencies, edges=HISTOGRAM_EDGES, width=40):
+    counts = numpy.bincount(numpy.searchsorted(edges, latencies), minlength=len(edges) + 1)
+    labels = [f"<= {edge}ms" for edge in edges] + [f"> {edges[-1]}ms"]
+    for label, count in zip(labels, counts):
+        print(f"{label:>10} {count:6d} {'#' * int(round(width * count / max(counts.max(), 1)))}")
+
+
+class BrokerProcess:
+    '''broker.py in a process of its own, so it does not compete for the GIL with the clients measured'''
+
+    def __init__(self):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.port = s.getsockname()[1]
+        self.host = "127.0.0.1"
+        self._process = subprocess.Popen([sys.executable, os.path.join(sys.path[0], "broker.py"), "--port", str(self.port)],
+                                         stdout=subprocess.DEVNULL)
+        while True:
+            try:
+                socket.create_connection((self.host, self.port)).close()
+                return
+            except ConnectionRefusedError:
+                threading.Event().wait(0.05)
+
+    def stop(self):
+        self._process.terminate()
+        self._process.wait()
+
+
+def close_client(mqtt_client):
+    import paho.mqtt.client as mqtt
+
+    if isinstance(mqtt_client, mqtt.Client):
+        mqtt_client.loop_stop()
+        mqtt_client.disconnect()
+    else:
+        asyncio.get_event_loop().run_until_complete(mqtt_client.disconnect())
+
+
+async def publish_ticks(mqtt_client, topic, period, count, call_times, lateness, burst=1):
+    '''A tag publishing burst predictions per tick from the event loop, as check_and_publish does'''
+    payloads = [json.dumps({"Shown": shown, "batterylife": 100}) for shown in ("NOD", "IDLE")]
+    start = perf_counter()
+    for tick in range(1, count + 1):
+        due = start + tick * period
+        await asyncio.sleep(max(0.0, due - perf_counter()))
+        # how late the loop got back to the tag, i.e. to its next sensor read
+        lateness.append(perf_counter() - due)
+        for i in range(burst):
+            t = perf_counter()
+            mqtt_client.publish(topic, payloads[i % 2])
+            call_times.append(perf_counter() - t)
+
+
+def bench_publish(args):
+    import paho.mqtt.client as mqtt
+    from sensortag import setup, async_setup
+
+    broker = BrokerProcess()
+    loop = asyncio.get_event_loop()
+    print(f"one publish every {args.period}s per tag, {args.count} per tag, through broker.py in its own process")
+    for tags in args.tags:
+        for transport in MQTT_TRANSPORTS:
+            received = threading.Semaphore(0)
+            subscriber = mqtt.Client()
+            subscriber.on_message = lambda client, userdata, msg: received.release()
+            subscriber.connect(broker.host, broker.port)
+            subscriber.subscribe(PREDICT_TOPICS)
+            subscriber.loop_start()
+            with redirect_stdout(io.StringIO()):
+                if transport == 'paho':
+                    mqtt_client = setup(broker.host, broker.port)
+                else:
+                    mqtt_client = loop.run_until_complete(async_setup(broker.host, broker.port))
+                # let both clients finish connecting and subscribing
+                threading.Event().wait(0.5)
+
+            call_times, lateness = [], []
+            start = perf_counter()
+            loop.run_until_complete(asyncio.gather(*[publish_ticks(mqtt_client, f"Group_12/LSTM/predict/Tag{i}", args.period,
+                                                                   args.count, call_times, lateness)
+                                                     for i in range(tags)]))
+            elapsed = perf_counter() - start
+            delivered = sum(received.acquire(timeout=2.0) for _ in range(tags * args.count))
+            close_client(mqtt_client)
+            subscriber.loop_stop()
+
+            call_times, lateness = numpy.array(call_times) * 1e6, numpy.array(lateness) * 1000.0
+            print(f"{tags:>3} tags {transport:>7}: {tags * args.count / elapsed:7.1f} publishes/s, publish call "
+                  f"p50 {numpy.percentile(call_times, 50):6.1f}us p99 {numpy.percentile(call_times, 99):7.1f}us, "
+                  f"tick lateness p50 {numpy.percentile(lateness, 50):5.2f}ms p99 {numpy.percentile(lateness, 99):6.2f}ms, "
+                  f"{delivered}/{tags * args.count} delivered")
+    broker.stop()
+
+
+def bench_shared(args):
+    from broker import Broker
+    from publisher import SharedPublisher
+    from sensortag import async_setup
+
+    broker = Broker(port=0).start()
+    loop = asyncio.get_event_loop()
+    print(f"{args.burst} publishes per tag every {args.period}s, {args.count} times")
+    for tags in args.tags:
+        for mode in ("per tag", "shared"):
+            with redirect_stdout(io.StringIO()):
+                clients = [loop.run_until_complete(async_setup(broker.host, broker.port))
+                           for _ in range(tags if mode == "per tag" else 1)]
+            publishers = clients if mode == "per tag" else [SharedPublisher(clients[0], args.linger / 1000.0)]
+            connections = len(broker.sessions)
+            received = broker.published
+            call_times, lateness = [], []
+            start = perf_counter()
+            loop.run_until_complete(asyncio.gather(*[publish_ticks(publishers[i % len(publishers)], f"Group_12/LSTM/predict/Tag{i}",
+                                                                   args.period, args.count, call_times, lateness, args.burst)
+                                                     for i in range(tags)]))
+            if mode == "shared":
+                loop.run_until_complete(publishers[0].close())
+            for client in clients:
+                loop.run_until_complete(client.flush())
+            elapsed = perf_counter() - start
+            # the broker thread may still be reading the last messages
+            threading.Event().wait(0.2)
+            received = broker.published - received
+            for client in clients:
+                close_client(client)
+
+            lateness = numpy.array(lateness) * 1000.0
+            print(f"{tags:>3} tags {mode:>7}: {connections:3d} connections, {len(call_times) / elapsed:8.1f} publishes/s in, "
+                  f"{received / elapsed:8.1f} msgs/s to the broker, tick lateness p50 {numpy.percentile(lateness, 50):5.2f}ms "
+                  f"p99 {numpy.percentile(lateness, 99):6.2f}ms")
+    broker.stop()
+
+
+async def publish_through_outage(publisher, broker, rate, before, outage, after, memory):
+    '''
+    Publishes rate numbered messages/s while the broker goes away for outage seconds, sampling traced
+    memory. Returns how many were published and the broker started again in place of the first.
+    '''
+    from broker import Broker
+
+    start, sent, port = perf_counter(), 0, broker.port
+    while perf_counter() - start < before + outage + after:
+        now = perf_counter() - start
+        if before <= now < before + outage and broker is not None:
+            broker.stop()
+            broker = None
+        elif now >= before + outage and broker is None:
+            broker = Broker(port=port).start()
+        while sent < now * rate:
+            publisher.publish("Group_12/LSTM/predict/Bench", json.dumps({"Shown": "NOD", "sequence": sent}))
+            sent += 1
+        memory.append(tracemalloc.get_traced_memory()[0])
+        await asyncio.sleep(OUTAGE_STEP)
+    return sent, broker
+
+
+def bench_outage(args):
+    import paho.mqtt.client as mqtt
+    from broker import Broker
+    from spool import OfflineQueue
+    from mqtt_async import AsyncMQTTClient
+
+    loop = asyncio.get_event_loop()
+    print(f"{args.rate} msgs/s, broker gone for {args.outage}s after {args.before}s")
+    for mode in ("client", "outbox"):
+        broker = Broker(port=0).start()
+        # received, last sequence, out of order; counters rather than a list, which would show up as memory
+        received = [0, -1, 0]
+
+        def on_message(client, userdata, msg):
+            sequence = json.loads(msg.payload)["sequence"]
+            received[0] += 1
+            received[2] += sequence <= received[1]
+            received[1] = sequence
+
+        subscriber = mqtt.Client()
+        subscriber.on_message = on_message
+        # the subscriber reconnects by itself once the broker is back, sooner than the publisher
+        subscriber.reconnect_delay_set(0.1, 0.2)
+        subscriber.on_connect = lambda client, userdata, flags, rc: client.subscribe(PREDICT_TOPICS)
+        subscriber.connect(broker.host, broker.port)
+        subscriber.loop_start()
+        # holding everything in memory is what the client alone does without its cap
+        client = loop.run_until_complete(AsyncMQTTClient(broker.host, broker.port, max_pending=None).connect())
+        publisher = client
+        if mode == "outbox":
+            spool = tempfile.NamedTemporaryFile(suffix=".spool", delete=False).name
+            publisher = OfflineQueue(client, spool, ttl=args.ttl)
+        threading.Event().wait(0.2)
+
+        memory = []
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        with redirect_stdout(io.StringIO()):
+            sent, broker = loop.run_until_complete(publish_through_outage(publisher, broker, args.rate, args.before, args.outage,
+                                                                  args.after, memory))
+        tracemalloc.stop()
+        replay_start = perf_counter()
+        loop.run_until_complete(asyncio.wait_for(client.connected.wait(), 60.0))
+        if mode == "outbox":
+            loop.run_until_complete(asyncio.wait_for(publisher.drain(), 60.0))
+        loop.run_until_complete(client.flush())
+        drained = perf_counter() - replay_start
+        # the subscriber may still be reading
+        deadline = perf_counter() + 2.0
+        while received[0] < sent and perf_counter() < deadline:
+            threading.Event().wait(0.05)
+        loop.run_until_complete(client.disconnect())
+        subscriber.loop_stop()
+        broker.stop()
+
+        growth = (max(memory) - baseline) / 1024
+        order = f"{received[2]} out of order" if received[2] else "in order"
+        print(f"{mode:>7}: {sent} sent, {received[0]} received {order}, memory grew {growth:8.1f}KiB at most, "
+              f"backlog sent {drained:.2f}s after publishing stopped")
+        # QoS 0: the step written just before the broker went away, and not yet read by it, is lost with
+        # it; everything published after that arrives once it is back, in order, unless the ttl expired it
+        assert args.ttl or sent - received[0] <= args.rate * OUTAGE_STEP + 1, f"{sent - received[0]} of {sent} never arrived"
+        assert not received[2], f"{received[2]} out of order"
+        if mode == "outbox":
+            print(f"         {publisher.stats()}")
+            publisher.close()
+            os.remove(spool)
+            os.remove(spool + ".offset")
+
+
+def bench_mqtt(args):
+    import paho.mqtt.client as mqtt
+    from broker import Broker
+    from sensortag import SensorTag, setup, async_setup
+
+    class EveryPredictionTag(SensorTag):
+        '''Publishes every prediction rather than only changes, so every window is a latency sample'''
+
+        def check_and_publish(self, prediction):
+            self._previous_shown = None
+            super().check_and_publish(prediction)
+
+    broker = None
+    if args.broker is None:
+        broker = Broker(port=0).start()
+    host, port = args.broker or broker.host, args.port if args.broker else broker.port
+
+    latencies, transport = [], []
+    subscribed = threading.Event()
+
+    def on_message(client, userdata, msg):
+        received = perf_counter()
+        sample_time, publish_time = publisher.sent[msg.topic].popleft()
+        latencies.append(received - sample_time)
+        transport.append(received - publish_time)
+
+    subscriber = mqtt.Client()
+    subscriber.on_message = on_message
+    subscriber.on_subscribe = lambda client, userdata, mid, granted: subscribed.set()
+    subscriber.on_connect = lambda client, userdata, flags, rc: client.subscribe(PREDICT_TOPICS)
+    subscriber.connect(host, port)
+    subscriber.loop_start()
+    subscribed.wait()
+
+    loop = asyncio.get_event_loop()
+    replay = TimedReplayClient(source= args.recording, speed= args.speed)
+    with redirect_stdout(io.StringIO()):
+        mqtt_client = setup(host, port) if args.mqtt == 'paho' else loop.run_until_complete(async_setup(host, port))
+        tag = (EveryPredictionTag if args.every else SensorTag)(address= "replay", name= "permas", model= args.model,
+                                                                mqtt_client= None, hop= args.hop, backend= args.backend)
+    publisher = TimedPublisher(mqtt_client, tag, replay)
+    tag._mqtt_client = publisher
+
+    start = perf_counter()
+    with redirect_stdout(io.StringIO()):
+        loop.run_until_complete(replay_pipeline(tag, replay, args.stream))
+    # the last predictions may still be on their way
+    deadline = perf_counter() + 2.0
+    while publisher.pending() and perf_counter() < deadline:
+        threading.Event().wait(0.01)
+    elapsed = perf_counter() - start
+
+    close_client(mqtt_client)
+    subscriber.loop_stop()
+    if broker is not None:
+        broker.stop()
+
+    where = f"{host}:{port}" if broker is None else "the local stand-in broker"
+    print(f"{args.recording} at speed {args.speed or 'max'} through {where} ({args.mqtt} client): {tag.samples} samples in {elapsed:.2f}s, "
+          f"{len(latencies)} predictions published to {PREDICT_TOPICS}, {publisher.pending()} never arrived")
+    if not latencies:
+        return
+    for name, values in (("sample to subscriber", latencies), ("publish to subscriber", transport)):
+        values = numpy.array(values) * 1000.0
+        print(f"{name}: p50 {numpy.percentile(values, 50):.2f}ms, p99 {numpy.percentile(values, 99):.2f}ms, "
+              f"max {values.max():.2f}ms")
+        histogram(values)
+
+
+if __name__ == '__main__':
+    p = ArgumentParser(description= "Offline benchmarks for the demo pipeline")
+    sub = p.add_subparsers(dest= "bench", required= True)
+
+    ingest = sub.add_parser("ingest", help= "sustained sample rate of polling vs notification ingest")
+    ingest.add_argument("--duration", default= 5.0, type= float, help= "seconds to measure each mode")
+    ingest.add_argument("--round-trip", default= 0.075, type= float, help= "simulated GATT round trip in seconds")
+    ingest.add_argument("--period", default= 0.1, type= float, help= "notification period in seconds")
+    ingest.set_defaults(func= bench_ingest)
+
+    window = sub.add_parser("window", help= "decision latency per hop size on a recorded stream")
+    window.add_argument("--recording", default= RECORDING, type= str, help= "ProjectData zip to replay")
+    window.add_argument("--timesteps", default= 5, type= int, help= "window size in samples")
+    window.add_argument("--hop", nargs= "+", type= int, help= "hop sizes to compare (default: all)")
+    window.set_defaults(func= bench_window)
+
+    inference = sub.add_parser("inference", help= "per-window latency of each inference backend")
+    inference.add_argument("--model", default= "lstm_model.hd5", type= str, help= "saved Keras model, numpy uses its exported .npz")
+    inference.add_argument("--timesteps", default= 5, type= int, help= "window size in samples")
+    inference.add_argument("--runs", default= 500, type= int, help= "windows per backend")
+    inference.add_argument("--backend", nargs= "+", choices= list(BACKENDS), help= "backends to compare (default: all)")
+    inference.set_defaults(func= bench_inference)
+
+    wire = sub.add_parser("wire", help= "bytes per message and encode/decode time of the uplink payload formats")
+    wire.add_argument("--recording", default= RECORDING, type= str, help= "ProjectData zip or capture file to take windows from")
+    wire.add_argument("--timesteps", default= 5, type= int, help= "window size in samples")
+    wire.add_argument("--repeat", default= 5, type= int, help= "passes over the windows")
+    wire.add_argument("--batch", default= 8, type= int, help= "windows per message of the packed formats")
+    wire.set_defaults(func= bench_wire)
+
+    uplink = sub.add_parser("uplink", help= "windows/s of the demo_send uplink per round trip time and windows in flight")
+    uplink.add_argument("--recording", default= RECORDING, type= str, help= "ProjectData zip or capture file to take windows from")
+    uplink.add_argument("--model", default= "lstm_model.hd5", type= str, help= "model the server runs")
+    uplink.add_argument("--backend", default= "compiled", choices= list(BACKENDS), type= str, help= "inference backend of the server")
+    uplink.add_argument("--timesteps", default= 5, type= int, help= "window size in samples")
+    uplink.add_argument("--period", default= 0.1, type= float, help= "seconds the tag takes to sample a window")
+    uplink.add_argument("--rtt", nargs= "+", default= [0.05, 0.2, 0.5], type= float, help= "round trip times in seconds")
+    uplink.add_argument("--in-flight", nargs= "+", default= [1, 2, 4, 8], type= int, help= "windows in flight to compare with stop-and-wait")
+    uplink.add_argument("--loss", default= 0.0, type= float, help= "fraction of publishes dropped")
+    uplink.add_argument("--timeout", default= 1.0, type= float, help= "seconds before a window is resent")
+    uplink.add_argument("--retries", default= 2, type= int, help= "resends before a window is lost")
+    uplink.add_argument("--duration", default= 3.0, type= float, help= "seconds per setting")
+    uplink.set_defaults(func= bench_uplink)
+
+    packed = sub.add_parser("batch", help= "messages/s and bytes/sample of the uplink packing several windows per message")
+    packed.add_argument("--recording", default= RECORDING, type= str, help= "ProjectData zip or capture file to take windows from")
+    packed.add_argument("--model", default= "lstm_model.hd5", type= str, help= "model the server runs")
+    packed.add_argument("--backend", default= "compiled", choices= list(BACKENDS), type= str, help= "inference backend of the server")
+    packed.add_argument("--timesteps", default= 5, type= int, help= "window size in samples")
+    packed.add_argument("--period", default= 0.01, type= float, help= "seconds the tag takes to sample a window")
+    packed.add_argument("--rtt", default= 0.05, type= float, help= "round trip time in seconds")
+    packed.add_argument("--batch", nargs= "+", default= [1, 4, 16, 64], type= int, help= "windows per message")
+    packed.add_argument("--linger", default= 500.0, type= float, help= "ms the first window of a message waits for the rest")
+    packed.add_argument("--in-flight", default= 4, type= int, help= "messages in flight")
+    packed.add_argument("--wire", default= "float32", choices= list(DTYPE_CODES), type= str, help= "payload format of the windows")
+    packed.add_argument("--duration", default= 3.0, type= float, help= "seconds per setting")
+    packed.set_defaults(func= bench_batch)
+
+    server = sub.add_parser("server", help= "throughput and per-sender latency of demo_receive inline vs with a worker pool")
+    server.add_argument("--recording", default= RECORDING, type= str, help= "ProjectData zip or capture file to take windows from")
+    server.add_argument("--model", default= "lstm_model.hd5", type= str, help= "model the server runs")
+    server.add_argument("--backend", default= "compiled", choices= list(BACKENDS), type= str, help= "inference backend of the server")
+    server.add_argument("--timesteps", default= 5, type= int, help= "window size in samples")
+    server.add_argument("--senders", default= 16, type= int, help= "concurrent senders")
+    server.add_argument("--windows", default= 200, type= int, help= "windows per sender")
+    server.add_argument("--period", default= 0.0, type= float, help= "seconds between windows of each sender, 0 floods")
+    server.add_argument("--workers", nargs= "+", default= [0, 1, 2, 4], type= int, help= "worker counts, 0 classifies inline")
+    server.add_argument("--batch", default= 32, type= int, help= "largest batch per worker")
+    server.add_argument("--max-wait", default= 2.0, type= float, help= "ms a worker waits for its batch to fill")
+    server.set_defaults(func= bench_server)
+
+    warmup = sub.add_parser("warmup", help= "first-window latency with and without warming the model up")
+    warmup.add_argument("--model", default= "lstm_model.hd5", type= str, help= "saved Keras model, numpy uses its exported .npz")
+    warmup.add_argument("--timesteps", default= 5, type= int, help= "window size in samples")
+    warmup.add_argument("--runs", default= 500, type= int, help= "windows after the first")
+    warmup.add_argument("--backend", nargs= "+", choices= list(BACKENDS), help= "backends to compare (default: all)")
+    warmup.set_defaults(func= bench_warmup)
+
+    batching = sub.add_parser("batching", help= "throughput and latency of per-tag calls vs micro-batching across tags")
+    batching.add_argument("--model", default= "lstm_model.hd5", type= str, help= "saved Keras model, numpy uses its exported .npz")
+    batching.add_argument("--backend", default= "compiled", choices= list(BACKENDS), type= str, help= "inference backend")
+    batching.add_argument("--timesteps", default= 5, type= int, help= "window size in samples")
+    batching.add_argument("--tags", nargs= "+", default= [1, 2, 4, 8, 16, 32, 64], type= int, help= "simulated tag counts")
+    batching.add_argument("--period", default= 0.0, type= float, help= "seconds between windows per tag, 0 for back to back")
+    batching.add_argument("--duration", default= 3.0, type= float, help= "seconds per tag count and mode")
+    batching.add_argument("--max-batch", default= MAX_BATCH, type= int, help= "largest batch")
+    batching.add_argument("--max-wait", default= MAX_WAIT * 1000, type= float, help= "ms a window waits for a batch to fill")
+    batching.set_defaults(func= bench_batching)
+
+    pipeline = sub.add_parser("pipeline", help= "throughput and prediction latency of SensorTag.run on a replayed recording")
+    pipeline.add_argument("--recording", default= RECORDING, type= str, help= "ProjectData zip or capture file to replay")
+    pipeline.add_argument("--speed", default= 0, type= float, help= "replay speed, 1 is real time, 0 as fast as possible")
+    pipeline.add_argument("--model", default= "head", choices= ['head', 'hand'], type= str, help= "model to use")
+    pipeline.add_argument("--backend", default= "compiled", choices= list(BACKENDS), type= str, help= "inference backend")
+    pipeline.add_argument("--hop", type= int, help= "samples between predictions")
+    pipeline.add_argument("--stream", action= "store_true", help= "replay as notifications instead of polled reads")
+    pipeline.set_defaults(func= bench_pipeline)
+
+    e2e = sub.add_parser("mqtt", help= "sample to predict topic latency of SensorTag.run publishing through an MQTT broker")
+    e2e.add_argument("--recording", default= RECORDING, type= str, help= "ProjectData zip or capture file to replay")
+    e2e.add_argument("--speed", default= 1.0, type= float, help= "replay speed, 1 is real time, 0 as fast as possible")
+    e2e.add_argument("--model", default= "head", choices= ['head', 'hand'], type= str, help= "model to use")
+    e2e.add_argument("--backend", default= "compiled", choices= list(BACKENDS), type= str, help= "inference backend")
+    e2e.add_argument("--hop", type= int, help= "samples between predictions")
+    e2e.add_argument("--stream", action= "store_true", help= "replay as notifications instead of polled reads")
+    e2e.add_argument("--every", action= "store_true", help= "publish every prediction, not only when the shown one changes")
+    e2e.add_argument("--mqtt", default= "asyncio", choices= MQTT_TRANSPORTS, type= str, help= "MQTT client the tag publishes with")
+    e2e.add_argument("--broker", type= str, help= "MQTT broker to go through (default: a local stand-in, see broker.py)")
+    e2e.add_argument("--port", default= 1883, type= int, help= "port of --broker")
+    e2e.set_defaults(func= bench_mqtt)
+
+    publish = sub.add_parser("publish", help= "publish call time and sensor loop lateness of the asyncio vs paho MQTT client")
+    publish.add_argument("--tags", default= [1, 8], nargs= "+", type= int, help= "tags publishing from the one loop")
+    publish.add_argument("--period", default= 0.01, type= float, help= "seconds between publishes of a tag")
+    publish.add_argument("--count", default= 500, type= int, help= "publishes per tag")
+    publish.set_defaults(func= bench_publish)
+
+    shared = sub.add_parser("shared", help= "broker connections and messages with one MQTT connection per tag vs a shared publisher")
+    shared.add_argument("--tags", default= [1, 8, 32], nargs= "+", type= int, help= "tags publishing from the one loop")
+    shared.add_argument("--period", default= 0.01, type= float, help= "seconds between bursts of a tag")
+    shared.add_argument("--burst", default= 3, type= int, help= "publishes per tag per burst, as when a prediction flips back and forth")
+    shared.add_argument("--count", default= 200, type= int, help= "bursts per tag")
+    shared.add_argument("--linger", default= 0.0, type= float, help= "ms the shared publisher waits for newer messages to coalesce with")
+    shared.set_defaults(func= bench_shared)
+
+    outage = sub.add_parser("outage", help= "memory, delivery and replay rate of publishing through a broker outage, with and without the outbox")
+    outage.add_argument("--rate", default= 1000, type= int, help= "messages published per second")
+    outage.add_argument("--before", default= 1.0, type= float, help= "seconds before the broker goes away")
+    outage.add_argument("--outage", default= 5.0, type= float, help= "seconds the broker is away")
+    outage.add_argument("--after", default= 3.0, type= float, help= "seconds of publishing after it is back")
+    outage.add_argument("--ttl", type= float, help= "seconds a queued message stays worth sending")
+    outage.set_defaults(func= bench_outage)
+
+    args = p.parse_args()
+    args.func(args)
@@ -0,0 +1,214 @@
+'''
+Local stand-in for the MQTT broker, so every client can be pointed at
+localhost instead of the EC2 broker or test.mosquitto.org:
+
+    python broker.py [--host] [--port]
+    python demo_receive.py --broker localhost
+
+or in process, on a free port when port is 0:
+
+    broker = Broker(port=0).start()
+    client.connect("127.0.0.1", broker.port)
+    ...
+    broker.stop()
+
+It speaks enough MQTT 3.1 / 3.1.1 for paho: CONNECT with any credentials,
+SUBSCRIBE / UNSUBSCRIBE with + and # wildcards, retained messages, PUBLISH at
+QoS 0, 1 and 2, and PINGREQ. Messages are always delivered to subscribers at
+QoS 0, there are no persistent sessions, will messages or keep-alive timeouts.
+'''
+import asyncio
+import threading
+
+from argparse import ArgumentParser
+
+PORT = 1883
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+
+def topic_matches(pattern, topic):
+    '''Whether a topic filter with + and # wildcards matches a topic name'''
+    levels = topic.split('/')
+    for i, level in enumerate(pattern.split('/')):
+        if level == '#':
+            return True
+        if i == len(levels) or (level != '+' and level != levels[i]):
+            return False
+    return len(pattern.split('/')) == len(levels)
+
+
+def packet(kind, body=b'', flags=0):
+    header = bytearray([kind << 4 | flags])
+    length = len(body)
+    while True:
+        byte, length = length % 128, length // 128
+        header.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(header) + body
+
+
+def string(data, offset):
+    length = int.from_bytes(data[offset:offset + 2], 'big')
+    return data[offset + 2:offset + 2 + length].decode(), offset + 2 + length
+
+
+def encode_string(text):
+    data = text.encode()
+    return len(data).to_bytes(2, 'big') + data
+
+
+class Session:
+    '''One connected client and the topic filters it subscribed to'''
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.task = asyncio.current_task()
+        self.client_id = None
+        self.subscriptions = set()
+
+    def send(self, data):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+
+class Broker:
+
+    def __init__(self, host='127.0.0.1', port=PORT):
+        self.host = host
+        self.port = port
+        self.sessions = set()
+        self.retained = {}
+        self.published = 0
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    async def serve(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        # port 0 asks the OS for a free one
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self._server
+
+    def start(self):
+        '''Runs the broker on its own event loop thread and returns once it accepts connections'''
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.serve())
+            started.set()
+            self._loop.run_forever()
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    async def close(self):
+        self._server.close()
+        tasks = [session.task for session in self.sessions]
+        # closing the connection ends the handler's read with an IncompleteReadError
+        for session in list(self.sessions):
+            session.writer.close()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def publish(self, topic, payload, retain=False):
+        self.published += 1
+        if retain:
+            # an empty retained payload clears the topic
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        data = packet(PUBLISH, encode_string(topic) + payload)
+        for session in self.sessions:
+            if any(topic_matches(pattern, topic) for pattern in session.subscriptions):
+                session.send(data)
+
+    async def _read_packet(self, reader):
+        first = await reader.readexactly(1)
+        length, shift = 0, 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return first[0] >> 4, first[0] & 0x0F, await reader.readexactly(length)
+
+    async def _handle(self, reader, writer):
+        session = Session(writer)
+        self.sessions.add(session)
+        try:
+            while True:
+                kind, flags, body = await self._read_packet(reader)
+                if kind == DISCONNECT:
+                    break
+                self._dispatch(session, kind, flags, body)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            writer.close()
+
+    def _dispatch(self, session, kind, flags, body):
+        if kind == CONNECT:
+            _, offset = string(body, 0)
+            # level, connect flags and keep-alive, then the client id
+            session.client_id, _ = string(body, offset + 4)
+            session.send(packet(CONNACK, b'\x00\x00'))
+        elif kind == PUBLISH:
+            qos = (flags >> 1) & 3
+            topic, offset = string(body, 0)
+            if qos:
+                packet_id = body[offset:offset + 2]
+                offset += 2
+                session.send(packet(PUBACK if qos == 1 else PUBREC, packet_id))
+            self.publish(topic, body[offset:], retain=bool(flags & 1))
+        elif kind == PUBREL:
+            session.send(packet(PUBCOMP, body[:2]))
+        elif kind == SUBSCRIBE:
+            offset, granted, patterns = 2, bytearray(), []
+            while offset < len(body):
+                pattern, offset = string(body, offset)
+                offset += 1
+                patterns.append(pattern)
+                granted.append(0)
+            session.subscriptions.update(patterns)
+            session.send(packet(SUBACK, body[:2] + bytes(granted)))
+            for topic, payload in self.retained.items():
+                if any(topic_matches(pattern, topic) for pattern in patterns):
+                    session.send(packet(PUBLISH, encode_string(topic) + payload, flags=1))
+        elif kind == UNSUBSCRIBE:
+            offset = 2
+            while offset < len(body):
+                pattern, offset = string(body, offset)
+                session.subscriptions.discard(pattern)
+            session.send(packet(UNSUBACK, body[:2]))
+        elif kind == PINGREQ:
+            session.send(packet(PINGRESP))
+
+
+if __name__ == '__main__':
+    p = ArgumentParser(description= "Local MQTT broker to run the demo scripts against")
+    p.add_argument("--host", default= "127.0.0.1", type= str, help= "address to listen on, 0.0.0.0 for other machines")
+    p.add_argument("--port", default= PORT, type= int, help= "port to listen on")
+    args = p.parse_args()
+
+    broker = Broker(args.host, args.port)
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(broker.serve())
+    print(f"MQTT broker listening on {args.host}:{broker.port}")
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        loop.run_until_complete(broker.close())
+        print("Received exit, exiting...")
@@ -1,3 +1,5 @@
+# imported first so the startup profile covers every import below
+from startup import START, StartupProfile
 import os
 import csv
 import sys
@@ -6,27 +8,20 @@ import numpy
 import struct
 import asyncio
 import platform
-import tensorflow as tf
 import paho.mqtt.client as mqtt
 
-from time import time, ctime
+from time import time, ctime, perf_counter
 from bleak import BleakClient
 from dotenv import load_dotenv
 
 from numpy import mean, std, dstack
-from keras.models import Sequential, load_model
-from tensorflow.python.keras.backend import set_session
-
-ACC_X_BUFFER = []
-ACC_Y_BUFFER = []
-ACC_Z_BUFFER = []
-GYRO_X_BUFFER = []
-GYRO_Y_BUFFER = []
-GYRO_Z_BUFFER = []
-MAG_X_BUFFER = []
-MAG_Y_BUFFER = []
-MAG_Z_BUFFER = []
-BARO_BUFFER = []
+from window_buffer import WindowBuffer
+from argparse import ArgumentParser
+from functools import partial
+from inference import BACKENDS, load_backend, warm_up
+
+TIMESTEPS = 5
+BUFFER = WindowBuffer(TIMESTEPS)
 
 BATTERYLIFE = 0
 
@@ -36,11 +31,10 @@ SHOW_INTERVAL = 3
 BATTERY_INTERVAL = 15
 
 loaded_model = None
+PROFILE = StartupProfile()
 temp_predict = ''
 predict_time = 0.0
 
-session = tf.compat.v1.Session(graph=tf.compat.v1.Graph())
-
 actions = {0: 'NOD', 1: 'SHAKE', 2: 'LOOKUP', 3: 'TILT'}
 # actions = {0: 'NOD', 1: 'SHAKE'}
 PREVIOUS_SHOWN = ''
@@ -190,46 +184,29 @@ def on_connect(client, userdata, flags, rc):
 
 
 class lstm_model():
-    def __init__(self):
+    def __init__(self, backend='compiled'):
         global loaded_model
-        loaded_model = load_model(MODEL_NAME)
+        # TensorFlow is imported here, and only by the keras backends
+        with PROFILE.stage("model load"):
+            loaded_model = load_backend(MODEL_NAME, backend)
+        # trace and allocate now rather than on the first gesture
+        with PROFILE.stage("warm-up"):
+            warm_up(loaded_model, TIMESTEPS)
         print("Model loaded, ready to predict")
 
     # load the dataset, returns train and test X and y elements
     def load_dataset(self):
-        # load all data
-        loaded = []
-        loaded.append(ACC_X_BUFFER)
-        loaded.append(ACC_Y_BUFFER)
-        loaded.append(ACC_Z_BUFFER)
-        loaded.append(GYRO_X_BUFFER)
-        loaded.append(GYRO_Y_BUFFER)
-        loaded.append(GYRO_Z_BUFFER)
-        loaded.append(MAG_X_BUFFER)
-        loaded.append(MAG_X_BUFFER)
-        loaded.append(MAG_X_BUFFER)
-        loaded.append(BARO_BUFFER)
-        # stack group so that features are the 3rd dimension
-        data = dstack(loaded)
-        return data
+        # latest window as model input, shape (1, timesteps, 10)
+        return BUFFER.window()
 
     # Clearing buffers after making prediction
     def clear_buffer(self):
-        BARO_BUFFER.clear()
-        GYRO_X_BUFFER.clear()
-        GYRO_Y_BUFFER.clear()
-        GYRO_Z_BUFFER.clear()
-        ACC_X_BUFFER.clear()
-        ACC_Y_BUFFER.clear()
-        ACC_Z_BUFFER.clear()
-        MAG_X_BUFFER.clear()
-        MAG_Y_BUFFER.clear()
-        MAG_Z_BUFFER.clear()
+        BUFFER.clear()
 
     def predict(self):
         data = self.load_dataset()
         global loaded_model, temp_predict, predict_time
-        result = loaded_model.predict(data)
+        result = loaded_model(data)
         self.clear_buffer()
         themax = numpy.argmax(result[0])
 
@@ -262,16 +239,7 @@ def setup(hostname):
 
 
 def append_buffer(baro_reading, motion_reading):
-    BARO_BUFFER.append(baro_reading)
-    GYRO_X_BUFFER.append(motion_reading[0])
-    GYRO_Y_BUFFER.append(motion_reading[1])
-    GYRO_Z_BUFFER.append(motion_reading[2])
-    ACC_X_BUFFER.append(motion_reading[3])
-    ACC_Y_BUFFER.append(motion_reading[4])
-    ACC_Z_BUFFER.append(motion_reading[5])
-    MAG_X_BUFFER.append(motion_reading[6])
-    MAG_Y_BUFFER.append(motion_reading[7])
-    MAG_Z_BUFFER.append(motion_reading[8])
+    BUFFER.append(baro_reading, motion_reading)
 
 
 def check_and_publish(prediction, mqtt_client):
@@ -290,17 +258,23 @@ def check_and_publish(prediction, mqtt_client):
     PREVIOUS_SHOWN = prediction
 
 
-async def run(address):
+async def run(address, backend='compiled'):
+    # the model loads in a thread while the tag connects and its sensors are enabled
+    loading = asyncio.get_event_loop().run_in_executor(None, partial(lstm_model, backend))
+    connect_start = perf_counter()
     async with BleakClient(address) as client:
         global BATTERYLIFE
 
         x = await client.is_connected()
         print("Connected: {0}".format(x))
+        PROFILE.record("ble connect", connect_start)
 
         # Setting MQTT Client
-        mqtt_client = setup(os.getenv("REACT_APP_EC2_PUBLIC_IP"))
+        with PROFILE.stage("mqtt connect"):
+            mqtt_client = setup(os.getenv("REACT_APP_EC2_PUBLIC_IP"))
 
         # Enabling sensors
+        enable_start = perf_counter()
         barometer_sensor = await BarometerSensor().enable(client)
         acc_sensor = AccelerometerSensorMovementSensorMPU9250()
         gyro_sensor = GyroscopeSensorMovementSensorMPU9250()
@@ -310,6 +284,7 @@ async def run(address):
         movement_sensor.register(gyro_sensor)
         movement_sensor.register(magneto_sensor)
         m_sensor = await movement_sensor.enable(client)
+        PROFILE.record("sensor enable", enable_start)
 
         # Enabling battery status
         battery = BatteryService()
@@ -317,18 +292,21 @@ async def run(address):
         BATTERYLIFE = await battery.read(client)
 
         # Initialise lstm model
-        model = lstm_model()
+        model = await loading
 
         # Iterations of data collection
-        timesteps = 5
+        timesteps = TIMESTEPS
 
+        window_start = perf_counter()
         while (True):
             for i in range(0, timesteps):
                 baro_reading = await barometer_sensor.read(client)
                 motion_reading = await m_sensor.read(client)
                 append_buffer(baro_reading, motion_reading)
 
+            predict_start = perf_counter()
             prediction = model.predict()
+            PROFILE.first_prediction(window_start, predict_start)
             print('predicted result: ', prediction)
             if time() - prev_battery_reading_time > BATTERY_INTERVAL:
                 BATTERYLIFE = await battery.read(client)
@@ -342,6 +320,12 @@ async def run(address):
 
 if __name__ == '__main__':
 
+    PROFILE.record("import", START)
+    p = ArgumentParser(description= "Head gesture demo for the sensortag")
+    p.add_argument("--backend", default= "compiled", choices= list(BACKENDS), type= str, help= "how the model is called per window")
+    p.add_argument("--startup-profile", action= "store_true", help= "print where the time to the first prediction went")
+    args = p.parse_args()
+    PROFILE.enabled = args.startup_profile
     os.environ["PYTHONASYNCIODEBUG"] = str(1)
     load_dotenv()
 
@@ -356,7 +340,7 @@ if __name__ == '__main__':
 
         loop = asyncio.get_event_loop()
         try:
-            loop.run_until_complete(run(address))
+            loop.run_until_complete(run(address, args.backend))
         except KeyboardInterrupt:
             loop.stop()
             loop.close()
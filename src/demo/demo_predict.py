@@ -8,6 +8,8 @@ Adapted by Ashwin from the following sources:
  - https://github.com/hbldh/bleak/blob/develop/examples/sensortag.py
 
 """
+# imported first so the startup profile covers every import below
+from startup import START, StartupProfile
 import asyncio
 import platform
 import struct
@@ -18,9 +20,11 @@ import numpy
 from bleak import BleakClient
 
 from numpy import mean, std, dstack
-from pandas import read_csv
-from keras.models import Sequential, load_model
-from time import time
+from window_buffer import WindowBuffer
+from argparse import ArgumentParser
+from functools import partial
+from inference import BACKENDS, load_backend, warm_up
+from time import time, perf_counter
 
 MODEL_NAME = 'lstm_model.hd5'
 CONFIDENCE = 0.88
@@ -28,21 +32,14 @@ SHOW_INTERVAL = 3
 BATTERY_INTERVAL = 15
 
 loaded_model = None
+PROFILE = StartupProfile()
 # dict = {0: 'IDLE', 1: 'NOD', 2: 'SHAKE'}
 dict = {0: 'NOD', 1: 'SHAKE', 2: 'LOOKUP', 3: 'TILT'}
 prediction, temp_predict = '', ''
 predict_time = 0.0
 
-ACC_X_BUFFER = []
-ACC_Y_BUFFER = []
-ACC_Z_BUFFER = []
-GYRO_X_BUFFER = []
-GYRO_Y_BUFFER = []
-GYRO_Z_BUFFER = []
-MAG_X_BUFFER = []
-MAG_Y_BUFFER = []
-MAG_Z_BUFFER = []
-BARO_BUFFER = []
+TIMESTEPS = 5
+BUFFER = WindowBuffer(TIMESTEPS)
 
 
 class Service:
@@ -184,33 +181,25 @@ class BarometerSensor(Sensor):
 
 class lstm_model():
 
-    def __init__(self):
+    def __init__(self, backend='compiled'):
         global loaded_model
-        loaded_model = load_model(MODEL_NAME)
+        # TensorFlow is imported here, and only by the keras backends
+        with PROFILE.stage("model load"):
+            loaded_model = load_backend(MODEL_NAME, backend)
+        # trace and allocate now rather than on the first gesture
+        with PROFILE.stage("warm-up"):
+            warm_up(loaded_model, TIMESTEPS)
         print("Model loaded, ready to predict")
 
     # load the dataset, returns train and test X and y elements
     def load_dataset(self):
-        # load all data
-        loaded = list()
-        loaded.append(ACC_X_BUFFER)
-        loaded.append(ACC_Y_BUFFER)
-        loaded.append(ACC_Z_BUFFER)
-        loaded.append(GYRO_X_BUFFER)
-        loaded.append(GYRO_Y_BUFFER)
-        loaded.append(GYRO_Z_BUFFER)
-        loaded.append(MAG_X_BUFFER)
-        loaded.append(MAG_X_BUFFER)
-        loaded.append(MAG_X_BUFFER)
-        loaded.append(BARO_BUFFER)
-        # stack group so that features are the 3rd dimension
-        data = dstack(loaded)
-        return data
+        # latest window as model input, shape (1, timesteps, 10)
+        return BUFFER.window()
 
     def predict(self):
         data = self.load_dataset()
         global loaded_model, prediction
-        result = loaded_model.predict(data)
+        result = loaded_model(data)
         print('predicted result: ', result)
 
         themax = numpy.argmax(result[0])
@@ -228,25 +217,21 @@ class lstm_model():
         output_to_user()
         
         # Clearing buffers after making prediction
-        BARO_BUFFER.clear()
-        GYRO_X_BUFFER.clear()
-        GYRO_Y_BUFFER.clear()
-        GYRO_Z_BUFFER.clear()
-        ACC_X_BUFFER.clear()
-        ACC_Y_BUFFER.clear()
-        ACC_Z_BUFFER.clear()
-        MAG_X_BUFFER.clear()
-        MAG_Y_BUFFER.clear()
-        MAG_Z_BUFFER.clear()
+        BUFFER.clear()
 
 
 
-async def run(address):
+async def run(address, backend='compiled'):
+    # the model loads in a thread while the tag connects and its sensors are enabled
+    loading = asyncio.get_event_loop().run_in_executor(None, partial(lstm_model, backend))
+    connect_start = perf_counter()
     async with BleakClient(address) as client:
         x = await client.is_connected()
         print("Connected: {0}".format(x))
+        PROFILE.record("ble connect", connect_start)
 
         # Enabling sensors
+        enable_start = perf_counter()
         barometer_sensor = await BarometerSensor().enable(client)
         acc_sensor = AccelerometerSensorMovementSensorMPU9250()
         gyro_sensor = GyroscopeSensorMovementSensorMPU9250()
@@ -256,6 +241,7 @@ async def run(address):
         movement_sensor.register(gyro_sensor)
         movement_sensor.register(magneto_sensor)
         m_sensor = await movement_sensor.enable(client)
+        PROFILE.record("sensor enable", enable_start)
 
         # Enabling battery status
         battery = BatteryService()
@@ -265,29 +251,23 @@ async def run(address):
         print("Battery Reading: {}\n".format(battery_reading))
 
         # Initialise lstm model
-        model = lstm_model()
+        model = await loading
 
         # Iterations of data collection
-        timesteps = 5
+        timesteps = TIMESTEPS
 
+        window_start = perf_counter()
         while True:
             # reading_time = time()
             for i in range(0, timesteps):
                 baro_reading = await barometer_sensor.read(client)
                 motion_reading = await m_sensor.read(client)
-                BARO_BUFFER.append(baro_reading)
-                GYRO_X_BUFFER.append(motion_reading[0])
-                GYRO_Y_BUFFER.append(motion_reading[1])
-                GYRO_Z_BUFFER.append(motion_reading[2])
-                ACC_X_BUFFER.append(motion_reading[3])
-                ACC_Y_BUFFER.append(motion_reading[4])
-                ACC_Z_BUFFER.append(motion_reading[5])
-                MAG_X_BUFFER.append(motion_reading[6])
-                MAG_Y_BUFFER.append(motion_reading[7])
-                MAG_Z_BUFFER.append(motion_reading[8])
+                BUFFER.append(baro_reading, motion_reading)
 
             # print(f"time taken to read one window: {time()- reading_time}s")
+            predict_start = perf_counter()
             model.predict()
+            PROFILE.first_prediction(window_start, predict_start)
 
             # Updates battery status after 15s
             if time() - prev_battery_reading_time > BATTERY_INTERVAL:
@@ -319,6 +299,12 @@ def output_to_user():
 
 if __name__ == "__main__":
     # os.system('color 7')
+    PROFILE.record("import", START)
+    p = ArgumentParser(description= "Prints head gesture predictions from the sensortag")
+    p.add_argument("--backend", default= "compiled", choices= list(BACKENDS), type= str, help= "how the model is called per window")
+    p.add_argument("--startup-profile", action= "store_true", help= "print where the time to the first prediction went")
+    args = p.parse_args()
+    PROFILE.enabled = args.startup_profile
     os.environ["PYTHONASYNCIODEBUG"] = str(1)
     try:
         with open(f"{sys.path[0]}/sensortag_addr.txt") as f:
@@ -334,7 +320,7 @@ if __name__ == "__main__":
         loop = asyncio.get_event_loop()
 
         try:
-            loop.run_until_complete(run(address))
+            loop.run_until_complete(run(address, args.backend))
         except KeyboardInterrupt:
             print("Received exit, exiting...")
             loop.stop()
@@ -1,113 +1,376 @@
+# imported first so the startup profile covers every import below
+from startup import START, StartupProfile
 import json
+import queue
+import threading
+import collections
 import numpy as np
-import tensorflow as tf
 import paho.mqtt.client as mqtt
 
-from time import time
-from keras.models import load_model
-from tensorflow.python.keras.backend import set_session
+from time import time, perf_counter
+from argparse import ArgumentParser
+from inference import BACKENDS, load_backend, warm_up
+from registry import ModelInfo
+from wire import decode
 
 MODEL_NAME = 'lstm_model.hd5'
-loaded_model = None
+# what this server has always published for the head model, its sidecar holds the SensorTag scripts' labels
+CONFIDENCE = 0.93
+ACTIONS = {0: 'Nod', 1: 'Shake'}
+# every sender publishes to its own classify topic and gets results on the matching predict topic
+CLASSIFY_TOPIC = "Group_12/LSTM/classify/+"
+PREDICT_TOPIC = "Group_12/LSTM/predict/{}"
+# every window with a sequence number is answered here, see uplink.py
+RESULT_TOPIC = "Group_12/LSTM/result/{}"
+# answers kept per sender to resend for retransmitted windows
+RECENT_RESULTS = 64
+SHOW_INTERVAL = 5
+# worker pool batches, see WorkerPool
+MAX_BATCH = 32
+MAX_WAIT = 0.002
+# Recent latencies and batch sizes kept for reporting
+LATENCY_WINDOW = 1000
+PROFILE = StartupProfile()
 
-prediction, temp_predict = '', ''
-predict_time = 0.0
 
-session = tf.compat.v1.Session(graph=tf.compat.v1.Graph())
-action = {0: 'Nod', 1: 'Shake'}
-PREVIOUS_SHOWN = ''
-# When calling load_model
+class ClientState:
+    '''Smoothing and publish state of one sender, so senders never see each other's gestures'''
 
+    def __init__(self, name):
+        self.name = name
+        self.topic = PREDICT_TOPIC.format(name)
+        self.result_topic = RESULT_TOPIC.format(name)
+        self.temp_predict = ''
+        self.predict_time = 0.0
+        self.previous_shown = ''
+        self.messages = 0
+        self.windows = 0
+        self.samples = 0
+        self.bytes = 0
+        self.duplicates = 0
+        self.first_message = None
+        # seconds from receiving a window to publishing its answer
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self._recent = collections.OrderedDict()
+        # resends are looked up on the network thread while workers answer and smooth
+        self.lock = threading.RLock()
 
-def loading_model():
-    with session.graph.as_default():
-        set_session(session)
-        global loaded_model
-        loaded_model = load_model(MODEL_NAME)
-        print("Model loaded, ready to predict")
+    @staticmethod
+    def _key(message):
+        # a retransmit is the same payload, timestamp included, while a sender that restarted
+        # numbers its windows from 0 again with new timestamps
+        return message.sequence, message.timestamp
 
+    def answered(self, message):
+        with self.lock:
+            return self._recent.get(self._key(message))
 
-def on_connect(client, userdata, flags, rc):
-    if rc == 0:
-        print("Successfully connected to broker")
-        print("Loading model... Do not send data!")
-        client.subscribe("Group_12/LSTM/classify/Sean")
-    else:
-        print("Connection failed with code: %d." % rc)
+    def remember(self, message, reply):
+        with self.lock:
+            self._recent[self._key(message)] = reply
+            if len(self._recent) > RECENT_RESULTS:
+                self._recent.popitem(last=False)
 
+    def output_to_user(self, prediction):
+        if prediction == 'IDLE':
+            if self.temp_predict != 'IDLE':
+                if time() - self.predict_time < SHOW_INTERVAL:
+                    return self.temp_predict
+                else:
+                    self.temp_predict = 'IDLE'
+                    return prediction
+            else:
+                return self.temp_predict
+        else:
+            self.temp_predict = prediction
+            self.predict_time = time()
+            return self.temp_predict
 
-def output_to_user():
-    global prediction, temp_predict, predict_time
 
-    if prediction == 'IDLE':
-        if temp_predict != 'IDLE':
-            if time() - predict_time < 5:
-                return temp_predict
-            else:
-                temp_predict = 'IDLE'
-                return prediction
+class InferenceServer:
+
+    def __init__(self, model_name=MODEL_NAME, backend='compiled', confidence=None, actions=None):
+        self._info = ModelInfo.load(model_name)
+        self._confidence = self._info.confidence if confidence is None else confidence
+        # classes without a label of their own keep the sidecar's
+        self._actions = dict(self._info.actions)
+        self._actions.update(actions or {})
+        # TensorFlow is imported here, and only by the keras backends
+        with PROFILE.stage("model load"):
+            self._model = load_backend(model_name, backend)
+        # trace and allocate now rather than on the first message
+        with PROFILE.stage("warm-up"):
+            warm_up(self._model, self._info.timesteps)
+        self._ready_time = perf_counter()
+        self._pool = None
+        self.clients = {}
+        print("Model loaded, ready to predict")
+
+    def client(self, name):
+        if name not in self.clients:
+            self.clients[name] = ClientState(name)
+            print(f"New client: {name}")
+        return self.clients[name]
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            print("Successfully connected to broker")
+            # subscribing here also restores the subscription after a reconnect
+            client.subscribe(CLASSIFY_TOPIC)
         else:
-            return temp_predict
-    else:
-        temp_predict = prediction
-        predict_time = time()
-        return temp_predict
-
-# When predicting
-
-
-def predict(motion_data):
-    with session.graph.as_default():
-        set_session(session)
-        # print("Start classifying")
-        global loaded_model, prediction
-        result = loaded_model.predict(motion_data)
-        themax = np.argmax(result[0])
-        confidence = 0.93
-        if (result[0][themax] < confidence):
+            print("Connection failed with code: %d." % rc)
+
+    def infer(self, windows):
+        '''Class probabilities of a (B, timesteps, 10) batch of windows'''
+        predict_start = perf_counter()
+        result = self._model(np.asarray(windows, dtype=np.float32))
+        PROFILE.first_prediction(self._ready_time, predict_start)
+        return result
+
+    def decide(self, state, result):
+        themax = np.argmax(result)
+        if (result[themax] < self._confidence):
             prediction = 'IDLE'
         else:
-            prediction = action[themax]
-        # print("Done.")
-        shown = output_to_user()
-    return {"Prediction": prediction, "Shown": shown}
-
-
-def on_message(client, userdata, msg):
-    # Payload is in msg. We convert it back to a Python dictionary.
-    recv_dict = json.loads(msg.payload)
-    global PREVIOUS_SHOWN
-    # Recreate the data
-    motion_data = np.array(recv_dict["data"])
-    battery_reading = recv_dict["batterylife"]
-    result = predict(motion_data)
-    if result["Shown"] != PREVIOUS_SHOWN:
-        print("Sending results: ", result)
-        result["batterylife"] = battery_reading
-        # Select your topic by uncommenting and commenting
-        # client.publish("Group_12/LSTM/predict/Glen", json.dumps(result))
-        client.publish("Group_12/LSTM/predict/Sean", json.dumps(result))
-        # client.publish("Group_12/LSTM/predict/Nicholas", json.dumps(result))
-    PREVIOUS_SHOWN = result["Shown"]
-
-
-def setup(hostname):
+            prediction = self._actions[themax]
+        shown = state.output_to_user(prediction)
+        return {"Prediction": prediction, "Shown": shown}
+
+    def predict(self, state, motion_data):
+        return self.decide(state, self.infer(motion_data)[0])
+
+    def on_message(self, client, userdata, msg):
+        received = perf_counter()
+        # Payload is in msg, a binary window read in place or the original JSON
+        try:
+            message = decode(msg.payload)
+        except Exception as e:
+            # anyone can publish on the classify topics, a bad payload must not stop the loop
+            print(f"Dropped a malformed message on {msg.topic}: {e!r}")
+            return
+        # the sender is the last level of the topic
+        state = self.client(msg.topic.rsplit('/', 1)[-1])
+        if state.first_message is None:
+            state.first_message = received
+        state.messages += 1
+        if self.resend(client, state, message):
+            return
+        state.bytes += len(msg.payload)
+        if self._pool is not None:
+            # the network thread only queues, the workers classify
+            self._pool.submit(client, state, message, received)
+            return
+        try:
+            self.respond(client, state, message, self.infer(message.window), received)
+        except Exception as e:
+            print(f"Could not classify a message from {state.name}: {e!r}")
+
+    def resend(self, client, state, message):
+        '''Answers a retransmit of a window already classified again, without touching the smoothing state'''
+        reply = None if message.sequence is None else state.answered(message)
+        if reply is None:
+            return False
+        state.duplicates += 1
+        client.publish(state.result_topic, reply)
+        return True
+
+    def respond(self, client, state, message, rows, received):
+        '''Answers a message from the class probabilities of its windows, one row per window, oldest first'''
+        with state.lock:
+            self._respond(client, state, message, rows, received)
+
+    def _respond(self, client, state, message, rows, received):
+        if self.resend(client, state, message):
+            return
+        # the windows of a batched message went through the smoothing one by one, as if sent apart
+        results = [self.decide(state, row) for row in rows]
+        state.windows += len(results)
+        state.samples += message.window.shape[0] * message.window.shape[1]
+        if message.sequence is not None:
+            reply = dict(results[-1], sequence=message.sequence)
+            if len(results) > 1:
+                reply["results"] = results
+            reply = json.dumps(reply)
+            state.remember(message, reply)
+            client.publish(state.result_topic, reply)
+        for result in results:
+            if result["Shown"] != state.previous_shown:
+                print(f"Sending results to {state.name}: ", result)
+                client.publish(state.topic, json.dumps(dict(result, batterylife=message.battery)))
+            state.previous_shown = result["Shown"]
+        state.latencies.append(perf_counter() - received)
+
+    def use_pool(self, workers, max_batch=MAX_BATCH, max_wait=MAX_WAIT):
+        self._pool = WorkerPool(self, workers, max_batch, max_wait)
+        return self._pool
+
+    def stats(self):
+        lines = [self._pool.stats()] if self._pool is not None else []
+        for state in self.clients.values():
+            latencies = np.array(state.latencies) * 1000.0
+            elapsed = max(perf_counter() - state.first_message, 1e-9)
+            line = (f"{state.name}: {state.messages} messages ({state.messages / elapsed:.1f} msgs/s), "
+                    f"{state.windows} windows, {state.bytes / max(state.samples, 1):.1f} bytes/sample, "
+                    f"{state.duplicates} resent")
+            if len(latencies):
+                line += f", latency p50 {np.percentile(latencies, 50):.2f}ms p99 {np.percentile(latencies, 99):.2f}ms"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+
+
+class WorkerPool:
+    '''
+    Inference threads shared by all senders. Each worker takes up to max_batch
+    queued messages, from any senders, waiting at most max_wait for the batch to
+    fill, and classifies all their windows in one call. Batches are answered in the order
+    they were taken, so every sender's smoothing state sees its windows in order.
+    '''
+
+    def __init__(self, server, workers=2, max_batch=MAX_BATCH, max_wait=MAX_WAIT):
+        self._server = server
+        self._max_batch = max_batch
+        self._max_wait = max_wait
+        self._queue = queue.Queue()
+        self._take = threading.Lock()
+        self._turn = threading.Condition()
+        self._taken = 0
+        self._answered = 0
+        self.batch_sizes = collections.deque(maxlen=LATENCY_WINDOW)
+        self.queue_depths = collections.deque(maxlen=LATENCY_WINDOW)
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, client, state, message, received):
+        self._queue.put((client, state, message, received))
+
+    def _take_batch(self):
+        with self._take:
+            item = self._queue.get()
+            if item is None:
+                return None, None
+            batch = [item]
+            deadline = perf_counter() + self._max_wait
+            while len(batch) < self._max_batch:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - perf_counter()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    # leave the sentinel for the next worker once this batch is done
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+            self.queue_depths.append(self._queue.qsize())
+            self.batch_sizes.append(len(batch))
+            ticket = self._taken
+            self._taken += 1
+            return ticket, batch
+
+    def _work(self):
+        while True:
+            ticket, batch = self._take_batch()
+            if batch is None:
+                self._queue.put(None)
+                return
+            rows = self._classify(batch)
+            with self._turn:
+                self._turn.wait_for(lambda: self._answered == ticket)
+                try:
+                    for (client, state, message, received), result in zip(batch, rows):
+                        if result is None:
+                            continue
+                        try:
+                            self._server.respond(client, state, message, result, received)
+                        except Exception as e:
+                            print(f"Could not answer {state.name}: {e!r}")
+                finally:
+                    # a batch that failed still hands the turn on, or every worker waits forever
+                    self._answered += 1
+                    self._turn.notify_all()
+
+    def _classify(self, batch):
+        '''Class probabilities per message, None for those that could not be classified'''
+        rows = [None] * len(batch)
+        # windows of the same shape are classified in one call, a malformed one only fails its own group
+        groups = collections.defaultdict(list)
+        for i, (_, _, message, _) in enumerate(batch):
+            groups[message.window.shape[1:]].append(i)
+        for shape, indices in groups.items():
+            try:
+                result = self._server.infer(np.concatenate([batch[i][2].window for i in indices]))
+            except Exception as e:
+                print(f"Could not classify {len(indices)} messages of windows shaped {shape}: {e!r}")
+                continue
+            start = 0
+            for i in indices:
+                # a message may carry several windows
+                end = start + len(batch[i][2].window)
+                rows[i] = result[start:end]
+                start = end
+        return rows
+
+    def stats(self):
+        sizes, depths = np.array(self.batch_sizes), np.array(self.queue_depths)
+        if not len(sizes):
+            return f"{len(self._threads)} workers, no batches yet"
+        return (f"{len(self._threads)} workers, {self._queue.qsize()} queued, batch mean {sizes.mean():.1f} "
+                f"max {sizes.max()}, queue depth mean {depths.mean():.1f} max {depths.max()}")
+
+    def close(self):
+        self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+def setup(hostname, server, port=1883):
     client = mqtt.Client()
-    client.on_connect = on_connect
-    client.on_message = on_message
-    client.connect(hostname)
-    client.loop_start()
+    client.on_connect = server.on_connect
+    client.on_message = server.on_message
+    client.connect(hostname, port)
     return client
 
 
-def main():
-    setup("test.mosquitto.org")
-    with session.graph.as_default():
-        set_session(session)
-        loading_model()
+def report(server, interval):
     while True:
-        pass
+        threading.Event().wait(interval)
+        print(server.stats())
+
+
+def main(backend='compiled', hostname="test.mosquitto.org", workers=0, max_batch=MAX_BATCH, max_wait=MAX_WAIT,
+         interval=None, port=1883):
+    # the model is ready before subscribing, so no window arrives before it
+    server = InferenceServer(MODEL_NAME, backend, CONFIDENCE, ACTIONS)
+    if workers:
+        server.use_pool(workers, max_batch, max_wait)
+    if interval:
+        threading.Thread(target=report, args=(server, interval), daemon=True).start()
+    with PROFILE.stage("broker connect"):
+        client = setup(hostname, server, port)
+    try:
+        # blocks in select() between messages instead of spinning
+        client.loop_forever()
+    except KeyboardInterrupt:
+        client.disconnect()
+        server.close()
+        print("Received exit, exiting...")
 
 
 if __name__ == '__main__':
-    main()
+    PROFILE.record("import", START)
+    p = ArgumentParser(description= "Classifies windows received over MQTT from any number of senders")
+    p.add_argument("--backend", default= "compiled", choices= list(BACKENDS), type= str, help= "how the model is called per window")
+    p.add_argument("--broker", default= "test.mosquitto.org", type= str, help= "MQTT broker to connect to, e.g. localhost for broker.py")
+    p.add_argument("--port", default= 1883, type= int, help= "port of the MQTT broker")
+    p.add_argument("--workers", default= 0, type= int, help= "inference threads batching windows across senders, 0 classifies on the network thread")
+    p.add_argument("--batch", default= MAX_BATCH, type= int, help= "most messages a worker classifies at once")
+    p.add_argument("--max-wait", default= MAX_WAIT * 1000, type= float, help= "ms a worker waits for its batch to fill")
+    p.add_argument("--report", type= float, help= "print queue, batch and per-sender latency stats every REPORT seconds")
+    p.add_argument("--startup-profile", action= "store_true", help= "print where the time to the first prediction went")
+    args = p.parse_args()
+    PROFILE.enabled = args.startup_profile
+    main(args.backend, args.broker, args.workers, args.batch, args.max_wait / 1000.0, args.report, args.port)
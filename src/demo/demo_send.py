@@ -1,8 +1,6 @@
 import os
 import csv
 import sys
-import json
-import numpy
 import struct
 import asyncio
 import platform
@@ -10,22 +8,21 @@ import paho.mqtt.client as mqtt
 
 from time import time
 from bleak import BleakClient
+from argparse import ArgumentParser
+
+from window_buffer import WindowBuffer
+from wire import FORMATS
+from uplink import Uplink, RESULT_TOPIC, MAX_IN_FLIGHT, TIMEOUT, RETRIES, MAX_BATCH, LINGER
+
+TIMESTEPS = 5
+BUFFER = WindowBuffer(TIMESTEPS)
+
+# Select your name, it is the device id sent with every window
+DEVICE = "Sean"
+# float32 or int16 binary windows, or the original JSON
+WIRE_FORMAT = 'float32'
+BATTERY_INTERVAL = 15
 
-from numpy import mean, std, dstack
-from keras.models import Sequential, load_model
-
-ACC_X_BUFFER = []
-ACC_Y_BUFFER = []
-ACC_Z_BUFFER = []
-GYRO_X_BUFFER = []
-GYRO_Y_BUFFER = []
-GYRO_Z_BUFFER = []
-MAG_X_BUFFER = []
-MAG_Y_BUFFER = []
-MAG_Z_BUFFER = []
-BARO_BUFFER = []
-
-READY = False
 BATTERYLIFE = 0
 
 
@@ -168,76 +165,45 @@ class BarometerSensor(Sensor):
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
         print("Connected")
-        # Please uncomment accordingly
-        # client.subscribe("Group_12/LSTM/predict/Glen")
-        client.subscribe("Group_12/LSTM/predict/Sean")
-        # client.subscribe("Group_12/LSTM/predict/Nicholas")
+        # every window is answered on this sender's result topic
+        client.subscribe(RESULT_TOPIC.format(DEVICE))
     else:
         print("Failed to connect. Error code: %d." % rc)
 
 
-def on_message(client, userdata, msg):
-    # print("Received message from server.")
-    resp_dict = json.loads(msg.payload)
-    print("Prediction: %s" % (resp_dict["Prediction"]))
-    global READY
-    READY = True
-
-
-def sending_data(mqtt_client):
-
-    global BATTERYLIFE
-    # load all data
-    loaded = list()
-    loaded.append(ACC_X_BUFFER)
-    loaded.append(ACC_Y_BUFFER)
-    loaded.append(ACC_Z_BUFFER)
-    loaded.append(GYRO_X_BUFFER)
-    loaded.append(GYRO_Y_BUFFER)
-    loaded.append(GYRO_Z_BUFFER)
-    loaded.append(MAG_X_BUFFER)
-    loaded.append(MAG_X_BUFFER)
-    loaded.append(MAG_X_BUFFER)
-    loaded.append(BARO_BUFFER)
-
-    # stack group so that features are the 3rd dimension
-    data = dstack(loaded)
-    data = data.tolist()
-    send_dict = {"data": data, "batterylife": BATTERYLIFE}
-    mqtt_client.publish("Group_12/LSTM/classify/Sean", json.dumps(send_dict))
-
-    # Clearing buffers after making prediction
-    BARO_BUFFER.clear()
-    GYRO_X_BUFFER.clear()
-    GYRO_Y_BUFFER.clear()
-    GYRO_Z_BUFFER.clear()
-    ACC_X_BUFFER.clear()
-    ACC_Y_BUFFER.clear()
-    ACC_Z_BUFFER.clear()
-    MAG_X_BUFFER.clear()
-    MAG_Y_BUFFER.clear()
-    MAG_Z_BUFFER.clear()
-
-
-def setup(hostname):
+def on_result(result):
+    # a message of several windows is answered with a result per window
+    for window_result in result.get("results", [result]):
+        print("Prediction: %s" % (window_result["Prediction"]))
+
+
+async def sending_data(uplink):
+    # latest window, shape (1, timesteps, 10); returns as soon as it is queued or published, not when it is answered
+    await uplink.send(BUFFER.window(), battery=BATTERYLIFE)
+
+    # Clearing buffers after sending
+    BUFFER.clear()
+
+
+def setup(hostname, port=1883):
     client = mqtt.Client()
     client.on_connect = on_connect
-    client.on_message = on_message
-    client.connect(hostname)
-    client.loop_start()
+    client.connect(hostname, port)
     return client
 
 
-async def run(address):
+async def run(address, in_flight=MAX_IN_FLIGHT, timeout=TIMEOUT, retries=RETRIES, hostname="test.mosquitto.org", port=1883,
+              batch=MAX_BATCH, linger=LINGER, delta=False, compress=False, interval=None):
     async with BleakClient(address) as client:
-        global READY
         global BATTERYLIFE
-        READY = False
         x = await client.is_connected()
         print("Connected: {0}".format(x))
 
-        # Setting MQTT Client
-        mqtt_client = setup("test.mosquitto.org")
+        # Setting MQTT Client, results go to the uplink
+        mqtt_client = setup(hostname, port)
+        uplink = Uplink(mqtt_client, DEVICE, in_flight, timeout, retries, WIRE_FORMAT, on_result, batch, linger, delta, compress)
+        mqtt_client.on_message = uplink.on_message
+        mqtt_client.loop_start()
 
         # Enabling sensors
         barometer_sensor = await BarometerSensor().enable(client)
@@ -255,38 +221,49 @@ async def run(address):
         prev_battery_reading_time = time()
         BATTERYLIFE = await battery.read(client)
         # print("Battery Reading: {}\n".format(BATTERYLIFE))
+        prev_report_time = time()
 
         while (True):
 
             # Iterations of data collection
-            timesteps = 5
+            timesteps = TIMESTEPS
             # print("Please perform action for 3 seconds.")
 
             for i in range(0, timesteps):
                 baro_reading = await barometer_sensor.read(client)
                 motion_reading = await m_sensor.read(client)
-                BARO_BUFFER.append(baro_reading)
-                GYRO_X_BUFFER.append(motion_reading[0])
-                GYRO_Y_BUFFER.append(motion_reading[1])
-                GYRO_Z_BUFFER.append(motion_reading[2])
-                ACC_X_BUFFER.append(motion_reading[3])
-                ACC_Y_BUFFER.append(motion_reading[4])
-                ACC_Z_BUFFER.append(motion_reading[5])
-                MAG_X_BUFFER.append(motion_reading[6])
-                MAG_Y_BUFFER.append(motion_reading[7])
-                MAG_Z_BUFFER.append(motion_reading[8])
-
-            sending_data(mqtt_client)
-
-            while not READY:
-                # Updates battery status after 15s
-                if time() - prev_battery_reading_time > 15:
-                    BATTERYLIFE = await battery.read(client)
-                    # print("Battery Reading: {}\n".format(BATTERYLIFE))
-                    prev_battery_reading_time = time()
+                BUFFER.append(baro_reading, motion_reading)
+
+            # only waits when in_flight windows are still unanswered
+            await sending_data(uplink)
+
+            # Updates battery status after 15s
+            if time() - prev_battery_reading_time > BATTERY_INTERVAL:
+                BATTERYLIFE = await battery.read(client)
+                # print("Battery Reading: {}\n".format(BATTERYLIFE))
+                prev_battery_reading_time = time()
+
+            if interval and time() - prev_report_time > interval:
+                print(uplink.stats())
+                prev_report_time = time()
 
 if __name__ == '__main__':
 
+    p = ArgumentParser(description= "Sends sensortag windows to demo_receive.py")
+    p.add_argument("--broker", default= "test.mosquitto.org", type= str, help= "MQTT broker to connect to, e.g. localhost for broker.py")
+    p.add_argument("--port", default= 1883, type= int, help= "port of the MQTT broker")
+    p.add_argument("--wire", default= WIRE_FORMAT, choices= FORMATS, type= str, help= "payload format of the windows")
+    p.add_argument("--in-flight", default= MAX_IN_FLIGHT, type= int, help= "windows sent ahead of their results, 1 is stop-and-wait")
+    p.add_argument("--timeout", default= TIMEOUT, type= float, help= "seconds before an unanswered window is sent again")
+    p.add_argument("--retries", default= RETRIES, type= int, help= "resends before a window is given up on")
+    p.add_argument("--batch", default= MAX_BATCH, type= int, help= "consecutive windows packed into one message")
+    p.add_argument("--linger", default= LINGER * 1000, type= float, help= "ms the first window of a message waits for the rest of its batch")
+    p.add_argument("--delta", action= "store_true", help= "send every sample as its difference to the one before")
+    p.add_argument("--zlib", action= "store_true", help= "zlib compress the samples of every message")
+    p.add_argument("--report", type= float, help= "print messages/s, bytes/sample and uplink stats every REPORT seconds")
+    args = p.parse_args()
+    WIRE_FORMAT = args.wire
+
     os.environ["PYTHONASYNCIODEBUG"] = str(1)
     try:
         with open(f"{sys.path[0]}/sensortag_addr.txt") as f:
@@ -299,7 +276,8 @@ if __name__ == '__main__':
         loop = asyncio.get_event_loop()
 
         try:
-            loop.run_until_complete(run(address))
+            loop.run_until_complete(run(address, args.in_flight, args.timeout, args.retries, args.broker, args.port,
+                                        args.batch, args.linger / 1000.0, args.delta, args.zlib, args.report))
             # loop.run_forever()
         except KeyboardInterrupt:
             loop.stop()
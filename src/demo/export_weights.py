@@ -0,0 +1,68 @@
+import os
+import json
+import numpy
+
+from argparse import ArgumentParser
+
+from numpy_lstm import NumpyModel
+from inference import weights_path
+
+
+def layer_spec(layer):
+    '''Returns the numpy_lstm description and weights of a Keras layer, None for layers skipped at inference'''
+    kind = type(layer).__name__
+    config = layer.get_config()
+    if kind == 'LSTM':
+        kernel, recurrent_kernel, bias = layer.get_weights()
+        return {'type': kind,
+                'weights': ['kernel', 'recurrent_kernel', 'bias'],
+                'config': {'activation': config['activation'],
+                           'recurrent_activation': config['recurrent_activation'],
+                           'return_sequences': config['return_sequences']}}, [kernel, recurrent_kernel, bias]
+    if kind == 'Dense':
+        kernel, bias = layer.get_weights()
+        return {'type': kind,
+                'weights': ['kernel', 'bias'],
+                'config': {'activation': config['activation']}}, [kernel, bias]
+    if kind == 'Dropout':
+        return None
+    raise ValueError(f"layer {layer.name} of type {kind} is not supported by numpy_lstm")
+
+
+def export(model, path):
+    spec = []
+    arrays = {'input_shape': numpy.array(model.input_shape[1:])}
+    for layer in model.layers:
+        exported = layer_spec(layer)
+        if exported is None:
+            continue
+        description, weights = exported
+        for name, value in zip(description['weights'], weights):
+            arrays[f"{len(spec)}_{name}"] = value.astype(numpy.float32)
+        spec.append(description)
+    numpy.savez_compressed(path, spec=numpy.array(json.dumps(spec)), **arrays)
+
+
+def check(model, path, windows=256, tolerance=1e-4):
+    '''Compares Keras and numpy outputs on random windows, returns the largest absolute difference'''
+    x = numpy.random.randn(windows, *model.input_shape[1:]).astype(numpy.float32)
+    expected = model.predict(x)
+    actual = NumpyModel(path)(x)
+    diff = float(numpy.abs(expected - actual).max())
+    if diff > tolerance or not (expected.argmax(axis=-1) == actual.argmax(axis=-1)).all():
+        raise AssertionError(f"numpy output differs from keras by {diff}")
+    return diff
+
+
+if __name__ == '__main__':
+    p = ArgumentParser(description= "Export a Keras LSTM model to a .npz for numpy_lstm")
+    p.add_argument("model", nargs= "+", type= str, help= "saved Keras model, e.g. hand_model.hd5")
+    args = p.parse_args()
+
+    from keras.models import load_model
+
+    for path in args.model:
+        model = load_model(path)
+        out = weights_path(path)
+        export(model, out)
+        print(f"{path} -> {out} ({os.path.getsize(out) / 1024:.0f} KiB), max diff vs keras: {check(model, out):.2e}")
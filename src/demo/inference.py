@@ -0,0 +1,84 @@
+'''
+Ways of running a loaded Keras model on a single (1, timesteps, 10) window.
+
+Model.predict sets up batching and a dataset on every call, which costs far
+more than the LSTM itself for one window. The other backends call the model
+directly and return a numpy array shaped like predict's output. The numpy
+backend runs weights exported by export_weights.py and never imports TensorFlow.
+
+The first calls of a backend trace graphs and allocate buffers, warm_up runs
+them on dummy windows before any real window arrives.
+'''
+import os
+import numpy
+
+from time import perf_counter
+
+from numpy_lstm import NumpyModel
+from window_buffer import CHANNELS
+
+WARMUP_RUNS = 3
+
+
+class KerasPredictBackend:
+    '''Model.predict on every window, as the demo scripts originally did'''
+
+    def __init__(self, model):
+        self._model = model
+
+    def __call__(self, window):
+        return self._model.predict(window)
+
+
+class DirectCallBackend:
+    '''Calls the model eagerly, skipping predict's batching machinery'''
+
+    def __init__(self, model):
+        self._model = model
+
+    def __call__(self, window):
+        return self._model(window, training=False).numpy()
+
+
+class CompiledBackend:
+    '''Traces the model once into a tf.function and reuses the graph for every window'''
+
+    def __init__(self, model):
+        import tensorflow as tf
+
+        signature = [tf.TensorSpec(shape=(None,) + tuple(model.input_shape[1:]), dtype=tf.float32)]
+        self._fn = tf.function(lambda x: model(x, training=False), input_signature=signature)
+
+    def __call__(self, window):
+        return self._fn(window).numpy()
+
+
+BACKENDS = {
+    'predict': KerasPredictBackend,
+    'direct': DirectCallBackend,
+    'compiled': CompiledBackend,
+    'numpy': NumpyModel,
+}
+
+
+def weights_path(model_path):
+    '''The .npz export_weights.py writes next to a saved Keras model'''
+    return os.path.splitext(model_path)[0] + ".npz"
+
+
+def load_backend(model_path, kind='compiled'):
+    if kind == 'numpy':
+        return NumpyModel(weights_path(model_path))
+    from keras.models import load_model
+    return BACKENDS[kind](load_model(model_path))
+
+
+def warm_up(infer, timesteps, batch_sizes=(1,), runs=WARMUP_RUNS):
+    '''Runs random windows of each batch size through infer, returns the seconds it took'''
+    rng = numpy.random.default_rng(0)
+    start = perf_counter()
+    for batch in batch_sizes:
+        windows = rng.standard_normal((batch, timesteps, len(CHANNELS))).astype(numpy.float32)
+        for _ in range(runs):
+            infer(windows)
+    return perf_counter() - start
@@ -0,0 +1,261 @@
+'''
+MQTT client running on the asyncio loop of the tag it publishes for.
+
+paho's loop_start() runs the network on a thread of its own, so every publish
+from SensorTag.run crosses threads and competes with the BLE loop for the GIL.
+AsyncMQTTClient does its reads, keep-alive pings and reconnects as tasks on the
+same loop instead. publish() never waits: it writes to the socket buffer, or
+holds the message while disconnected, and returns a future for callers that
+want to await delivery:
+
+    mqtt_client = AsyncMQTTClient(hostname, port, username, password)
+    await mqtt_client.connect()
+    mqtt_client.publish(topic, payload)          # from check_and_publish
+    await mqtt_client.publish(topic, payload, qos=1)   # QoS 0 and 1
+    await mqtt_client.subscribe("Group_12/LSTM/predict/#")
+
+The connection is re-established with backoff when it drops, subscriptions
+are renewed, unacknowledged QoS 1 messages sent again and held messages sent
+in order. Callbacks take paho's arguments, so on_connect and on_message
+handlers work with either client.
+'''
+import asyncio
+import itertools
+import collections
+
+from time import perf_counter
+from broker import (CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP, SUBSCRIBE, SUBACK,
+                    PINGREQ, PINGRESP, DISCONNECT, packet, string, encode_string)
+
+# the clients a tag can publish with: this one, or paho on its own thread
+MQTT_TRANSPORTS = ['asyncio', 'paho']
+
+KEEPALIVE = 60
+# messages held while disconnected, the oldest are dropped beyond this
+MAX_PENDING = 1000
+# bytes waiting in the socket buffer beyond which the broker counts as too slow to write to
+WRITE_BUFFER_LIMIT = 64 * 1024
+RECONNECT_MIN = 1.0
+RECONNECT_MAX = 30.0
+
+
+class MQTTMessage:
+
+    def __init__(self, topic, payload, qos=0, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+class AsyncMQTTClient:
+
+    def __init__(self, hostname, port=1883, username=None, password=None, client_id='', keepalive=KEEPALIVE,
+                 max_pending=MAX_PENDING):
+        self.hostname = hostname
+        self.port = port
+        self._username = username
+        self._password = password
+        self._client_id = client_id
+        self._keepalive = keepalive
+        self._reader = None
+        self._writer = None
+        self._packet_ids = itertools.cycle(range(1, 65536))
+        # packet id -> future, of QoS 1 publishes and subscribes waiting for their ack
+        self._acks = {}
+        # packet id -> packet, of QoS 1 publishes to send again after a reconnect
+        self._unacked = {}
+        self._pending = collections.deque(maxlen=max_pending)
+        self._subscriptions = {}
+        self._tasks = []
+        self._closing = False
+        # when the PINGREQ still waiting for its PINGRESP was sent
+        self._ping_sent = None
+        self.connected = asyncio.Event()
+        self.on_connect = None
+        self.on_message = None
+        self.published = 0
+        self.dropped = 0
+        self.reconnects = 0
+
+    async def connect(self):
+        '''Connects, raising if the broker cannot be reached, and keeps the connection up from then on'''
+        await self._open()
+        self._tasks = [asyncio.ensure_future(self._maintain()), asyncio.ensure_future(self._ping())]
+        return self
+
+    async def _open(self):
+        self._reader, self._writer = await asyncio.open_connection(self.hostname, self.port)
+        flags = 0x02
+        payload = encode_string(self._client_id)
+        if self._username is not None:
+            flags |= 0x80
+            payload += encode_string(self._username)
+            if self._password is not None:
+                flags |= 0x40
+                payload += encode_string(self._password)
+        header = encode_string('MQTT') + bytes([4, flags]) + self._keepalive.to_bytes(2, 'big')
+        self._writer.write(packet(CONNECT, header + payload))
+        kind, _, body = await self._read_packet()
+        rc = body[1] if kind == CONNACK else -1
+        if rc != 0:
+            self._writer.close()
+            raise ConnectionError(f"MQTT broker refused the connection with code {rc}")
+        self.connected.set()
+        self._ping_sent = None
+        for topic, qos in self._subscriptions.items():
+            self._send_subscribe(topic, qos)
+        for data in self._unacked.values():
+            # with the DUP flag set
+            self._writer.write(bytes([data[0] | 0x08]) + data[1:])
+        # held while disconnected, in the order they were published
+        while self._pending:
+            self._write(*self._pending.popleft())
+        if self.on_connect is not None:
+            self._callback(self.on_connect, self, None, {}, 0)
+
+    def _callback(self, callback, *args):
+        # an error in user code must not end the read loop, and with it the reconnects
+        try:
+            callback(*args)
+        except Exception as e:
+            print(f"MQTT callback {callback.__name__} raised {e!r}")
+
+    async def _read_packet(self):
+        first = await self._reader.readexactly(1)
+        length, shift = 0, 0
+        while True:
+            byte = (await self._reader.readexactly(1))[0]
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return first[0] >> 4, first[0] & 0x0F, await self._reader.readexactly(length)
+
+    async def _maintain(self):
+        delay = RECONNECT_MIN
+        while not self._closing:
+            try:
+                if not self.connected.is_set():
+                    await self._open()
+                    self.reconnects += 1
+                    delay = RECONNECT_MIN
+                while True:
+                    self._dispatch(*await self._read_packet())
+            except (OSError, asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+                # ValueError: a packet that could not be parsed, the stream cannot be trusted after it
+                if self._closing:
+                    return
+                if self.connected.is_set():
+                    print(f"MQTT connection lost ({e!r}), reconnecting")
+                    self._writer.close()
+                self.connected.clear()
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX)
+
+    async def _ping(self):
+        while not self._closing:
+            await asyncio.sleep(self._keepalive / 2)
+            if not self._is_open():
+                continue
+            if self._ping_sent is None:
+                self._ping_sent = perf_counter()
+                self._writer.write(packet(PINGREQ))
+            elif perf_counter() - self._ping_sent >= self._keepalive:
+                # half-open: writes still succeed but nothing reaches the broker, drop it as paho does
+                print(f"No PINGRESP from {self.hostname} in {self._keepalive}s, reconnecting")
+                self._writer.transport.abort()
+
+    def _dispatch(self, kind, flags, body):
+        if kind == PUBLISH:
+            qos = (flags >> 1) & 3
+            topic, offset = string(body, 0)
+            if qos:
+                packet_id = body[offset:offset + 2]
+                offset += 2
+                self._writer.write(packet(PUBACK if qos == 1 else PUBREC, packet_id))
+            if self.on_message is not None:
+                self._callback(self.on_message, self, None, MQTTMessage(topic, body[offset:], qos, bool(flags & 1)))
+        elif kind in (PUBACK, SUBACK):
+            packet_id = int.from_bytes(body[:2], 'big')
+            self._unacked.pop(packet_id, None)
+            future = self._acks.pop(packet_id, None)
+            if future is not None and not future.done():
+                future.set_result(None)
+        elif kind == PUBREL:
+            # second half of receiving at QoS 2
+            self._writer.write(packet(PUBCOMP, body[:2]))
+        elif kind == PINGRESP:
+            self._ping_sent = None
+
+    def _write(self, data, future, packet_id=None):
+        self._writer.write(data)
+        self.published += 1
+        if packet_id is None:
+            future.set_result(None)
+        else:
+            self._acks[packet_id] = future
+            self._unacked[packet_id] = data
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        '''Sends without waiting, returns a future done once written (QoS 0) or acknowledged (QoS 1)'''
+        if isinstance(payload, str):
+            payload = payload.encode()
+        future = asyncio.get_event_loop().create_future()
+        body = encode_string(topic)
+        packet_id = None
+        qos = min(qos, 1)
+        if qos:
+            packet_id = next(self._packet_ids)
+            body += packet_id.to_bytes(2, 'big')
+        data = packet(PUBLISH, body + bytes(payload), flags=(qos << 1) | int(retain))
+        if self._is_open():
+            self._write(data, future, packet_id)
+        else:
+            if len(self._pending) == self._pending.maxlen:
+                self._pending.popleft()[1].cancel()
+                self.dropped += 1
+            self._pending.append((data, future, packet_id))
+        return future
+
+    def _send_subscribe(self, topic, qos):
+        packet_id = next(self._packet_ids)
+        future = asyncio.get_event_loop().create_future()
+        self._acks[packet_id] = future
+        body = packet_id.to_bytes(2, 'big') + encode_string(topic) + bytes([qos])
+        self._writer.write(packet(SUBSCRIBE, body, flags=2))
+        return future
+
+    async def subscribe(self, topic, qos=0):
+        '''Subscribes and waits for the broker to confirm, the subscription is renewed on every reconnect'''
+        self._subscriptions[topic] = qos
+        await self.connected.wait()
+        await self._send_subscribe(topic, qos)
+
+    def _is_open(self):
+        # the connection may be gone before the read loop has noticed
+        return self.connected.is_set() and not self._writer.is_closing()
+
+    def writable(self):
+        '''Connected, and the broker keeps up with what was written so far'''
+        return self._is_open() and self._writer.transport.get_write_buffer_size() < WRITE_BUFFER_LIMIT
+
+    async def flush(self):
+        '''Waits until everything published so far has left the socket buffer'''
+        if self.connected.is_set():
+            await self._writer.drain()
+
+    async def disconnect(self):
+        self._closing = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.connected.is_set():
+            self._writer.write(packet(DISCONNECT))
+            await self._writer.drain()
+            self._writer.close()
+        self.connected.clear()
+
+    def stats(self):
+        return (f"{self.published} published, {len(self._pending)} held, {self.dropped} dropped, "
+                f"{self.reconnects} reconnects")
@@ -2,15 +2,16 @@ import paho.mqtt.client as mqtt
 import json
 import os
 from dotenv import load_dotenv
+from argparse import ArgumentParser
 
-def setup(hostname):
+def setup(hostname, port=1883):
     USERID = os.getenv("REACT_APP_EC2_USER")
     PASSWORD = os.getenv("REACT_APP_EC2_PASSWORD")    
 
     client = mqtt.Client()
     client.username_pw_set(USERID, PASSWORD)
     client.on_connect = on_connect
-    client.connect(hostname)
+    client.connect(hostname, port)
     client.loop_start()
     return client
 
@@ -22,9 +23,13 @@ def on_connect(client, userdata, flags, rc):
 
 if __name__ == '__main__':
     load_dotenv()
+    p = ArgumentParser(description= "Publishes one prediction to check the MQTT connection")
+    p.add_argument("--broker", type= str, help= "MQTT broker to publish to, e.g. localhost for broker.py (default: the EC2 broker)")
+    p.add_argument("--port", default= 1883, type= int, help= "port of the MQTT broker")
+    args = p.parse_args()
 
     # Setting MQTT Client
-    mqtt_client = setup(os.getenv("REACT_APP_EC2_PUBLIC_IP"))
+    mqtt_client = setup(args.broker or os.getenv("REACT_APP_EC2_PUBLIC_IP"), args.port)
 
     result = {
         "Prediction" : "NOD",
@@ -0,0 +1,153 @@
+'''
+Drives several SensorTags from one process: one asyncio loop, one MQTT
+connection shared through a SharedPublisher, and one loaded model per
+(model, backend) however many tags use it, through the model registry.
+With --batch, windows of tags sharing a model are run together through a
+MicroBatcher.
+
+    python multi_tag.py -t <addr> glen hand -t <addr> sean head [--stream]
+'''
+import os
+import numpy
+import asyncio
+
+from time import perf_counter
+from bleak import BleakClient
+from functools import partial
+from dotenv import load_dotenv
+from argparse import ArgumentParser
+
+from sensortag import SensorTag, MODEL_FILES, MQTT_TRANSPORTS, setup, async_setup
+from inference import BACKENDS
+from registry import REGISTRY, get_model
+from replay import ReplayClient
+from batching import MicroBatcher, MAX_WAIT
+from publisher import SharedPublisher, LINGER
+from spool import OfflineQueue
+
+REPORT_INTERVAL = 10
+
+
+class SharedBatchers:
+    '''One MicroBatcher per loaded model, shared by every tag using it'''
+
+    def __init__(self, batch=None, max_wait=MAX_WAIT):
+        self._batchers = {}
+        self._batch = batch
+        self._max_wait = max_wait
+
+    def get(self, model, backend):
+        '''The MicroBatcher of a model, or None when batching is off'''
+        if not self._batch:
+            return None
+        # batches come in every size up to the limit, warm up both ends
+        handle = get_model(MODEL_FILES[model], backend, (1, self._batch))
+        key = (handle.digest, backend)
+        if key not in self._batchers:
+            self._batchers[key] = (handle, MicroBatcher(handle.infer, self._batch, self._max_wait))
+        return self._batchers[key][1]
+
+    def items(self):
+        return self._batchers.values()
+
+
+def tag_report(tag, samples, elapsed):
+    latencies = numpy.array(tag.predict_latencies) * 1000.0
+    line = f"{tag.topic} [{tag.address}]: {samples / elapsed:5.1f} samples/s"
+    if len(latencies):
+        line += f", predict p50 {numpy.percentile(latencies, 50):.2f}ms p99 {numpy.percentile(latencies, 99):.2f}ms"
+    return line
+
+
+async def report(tags, batchers, interval, publisher=None, outbox=None):
+    last = [tag.samples for tag in tags]
+    start = perf_counter()
+    while True:
+        await asyncio.sleep(interval)
+        elapsed = perf_counter() - start
+        for i, tag in enumerate(tags):
+            print(tag_report(tag, tag.samples - last[i], elapsed))
+            last[i] = tag.samples
+        for handle, batcher in batchers.items():
+            print(f"{handle.path} ({handle.backend}): {batcher.batches} batches, mean size {batcher.mean_batch():.1f}")
+        if publisher is not None:
+            print(publisher.report())
+        if outbox is not None:
+            print(outbox.stats())
+        start = perf_counter()
+
+
+async def run_tags(tags, batchers, stream, client_factory, interval=REPORT_INTERVAL, publisher=None, outbox=None):
+    reporter = asyncio.ensure_future(report(tags, batchers, interval, publisher, outbox))
+    try:
+        await asyncio.gather(*[tag.run(stream=stream, client_factory=client_factory) for tag in tags])
+    finally:
+        reporter.cancel()
+
+
+if __name__ == '__main__':
+
+    os.environ["PYTHONASYNCIODEBUG"] = str(1)
+    load_dotenv()
+    p = ArgumentParser(description= "Run several sensortags in one process")
+    p.add_argument("-t", "--tag", required= True, action= "append", nargs= 3, metavar= ("ADDR", "NAME", "MODEL"),
+                   help= "sensortag address, user name and model (head or hand), repeat per tag")
+    p.add_argument("--stream", action= "store_true", help= "subscribe to sensor notifications instead of polling")
+    p.add_argument("--hop", type= int, help= "predict every HOP samples over the last window (default: window size)")
+    p.add_argument("--backend", default= "compiled", choices= list(BACKENDS), type= str, help= "how the model is called per window")
+    p.add_argument("--batch", type= int, help= "run windows of tags sharing a model in batches of up to BATCH")
+    p.add_argument("--max-wait", default= MAX_WAIT * 1000, type= float, help= "ms a window waits for a batch to fill")
+    p.add_argument("--report", default= REPORT_INTERVAL, type= float, help= "seconds between rate and latency reports")
+    p.add_argument("--replay", type= str, help= "replay a ProjectData zip or capture file instead of connecting to tags")
+    p.add_argument("--broker", type= str, help= "MQTT broker to publish to, e.g. localhost for broker.py (default: the EC2 broker)")
+    p.add_argument("--port", default= 1883, type= int, help= "port of the MQTT broker")
+    p.add_argument("--mqtt", default= "asyncio", choices= MQTT_TRANSPORTS, type= str, help= "MQTT client, on the asyncio loop or on paho's own thread")
+    p.add_argument("--outbox", type= str, help= "file to queue predictions in while the broker is unreachable, sent once it is back")
+    p.add_argument("--outbox-ttl", type= float, help= "seconds a queued prediction stays worth sending (default: forever)")
+    p.add_argument("--linger", default= LINGER * 1000, type= float, help= "ms a publish waits for newer ones of its topic to coalesce with")
+    p.add_argument("--speed", default= 1.0, type= float, help= "replay speed, 1 is real time, 0 as fast as possible")
+    args = p.parse_args()
+
+    for addr, name, model in args.tag:
+        if name not in ('glen', 'nicholas', 'sean', 'permas'):
+            p.error(f"unknown name {name}")
+        if model not in MODEL_FILES:
+            p.error(f"model must be one of {', '.join(MODEL_FILES)}, got {model}")
+
+    loop = asyncio.get_event_loop()
+
+    # Setting MQTT Client, one connection shared by every tag through the publisher
+    hostname = args.broker or os.getenv("REACT_APP_EC2_PUBLIC_IP")
+    if args.mqtt == 'paho':
+        mqtt_client = setup(hostname, args.port)
+    else:
+        mqtt_client = loop.run_until_complete(async_setup(hostname, args.port))
+    outbox = None
+    if args.outbox:
+        mqtt_client = outbox = OfflineQueue(mqtt_client, args.outbox, ttl= args.outbox_ttl)
+    publisher = SharedPublisher(mqtt_client, args.linger / 1000.0)
+
+    batchers = SharedBatchers(args.batch, args.max_wait / 1000.0)
+    tags = [SensorTag(address= addr, name= name, model= model, mqtt_client= publisher, hop= args.hop,
+                      backend= args.backend, batcher= batchers.get(model, args.backend))
+            for addr, name, model in args.tag]
+    print(f"{len(tags)} tags sharing {len(REGISTRY)} loaded models")
+
+    client_factory = BleakClient
+    if args.replay:
+        client_factory = partial(ReplayClient, source= args.replay, speed= args.speed, loop= True)
+
+    running = asyncio.ensure_future(run_tags(tags, batchers, args.stream, client_factory, args.report, publisher, outbox))
+    try:
+        loop.run_until_complete(running)
+    except KeyboardInterrupt:
+        print("Received exit, exiting...")
+    finally:
+        running.cancel()
+        loop.run_until_complete(asyncio.gather(running, return_exceptions=True))
+        # what the publisher still holds goes out, or into the outbox, whose memory queue is kept in its file
+        loop.run_until_complete(publisher.close())
+        if outbox is not None:
+            outbox.close()
+        loop.stop()
+        loop.close()
@@ -0,0 +1,93 @@
+'''
+Forward pass of the LSTM + Dense stack built by buildlstm, in plain numpy.
+
+Weights come from export_weights.py, which writes a .npz next to the Keras
+model. Dropout layers are no-ops at inference time and are not exported.
+'''
+import json
+import numpy
+
+
+def sigmoid(x):
+    # tanh form never overflows for large inputs such as raw pressure values
+    return 0.5 * (numpy.tanh(0.5 * x) + 1.0)
+
+
+def softmax(x):
+    e = numpy.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: numpy.maximum(x, 0.0),
+    'tanh': numpy.tanh,
+    'sigmoid': sigmoid,
+    'hard_sigmoid': lambda x: numpy.clip(0.2 * x + 0.5, 0.0, 1.0),
+    'softmax': softmax,
+}
+
+
+class LSTMLayer:
+    def __init__(self, kernel, recurrent_kernel, bias, activation='tanh',
+                 recurrent_activation='sigmoid', return_sequences=False):
+        self.kernel = kernel
+        self.recurrent_kernel = recurrent_kernel
+        self.bias = bias
+        self.units = recurrent_kernel.shape[0]
+        self.activation = ACTIVATIONS[activation]
+        self.recurrent_activation = ACTIVATIONS[recurrent_activation]
+        self.return_sequences = return_sequences
+
+    def __call__(self, x):
+        batch, timesteps, _ = x.shape
+        h = numpy.zeros((batch, self.units), dtype=numpy.float32)
+        c = numpy.zeros((batch, self.units), dtype=numpy.float32)
+        # input projection for every timestep at once, only the recurrence is sequential
+        projected = x @ self.kernel + self.bias
+        outputs = []
+        for t in range(timesteps):
+            z = projected[:, t] + h @ self.recurrent_kernel
+            # Keras gate order: input, forget, cell, output
+            i, f, g, o = numpy.split(z, 4, axis=-1)
+            c = self.recurrent_activation(f) * c + self.recurrent_activation(i) * self.activation(g)
+            h = self.recurrent_activation(o) * self.activation(c)
+            outputs.append(h)
+        return numpy.stack(outputs, axis=1) if self.return_sequences else h
+
+
+class DenseLayer:
+    def __init__(self, kernel, bias, activation='linear'):
+        self.kernel = kernel
+        self.bias = bias
+        self.activation = ACTIVATIONS[activation]
+
+    def __call__(self, x):
+        return self.activation(x @ self.kernel + self.bias)
+
+
+LAYERS = {
+    'LSTM': LSTMLayer,
+    'Dense': DenseLayer,
+}
+
+
+class NumpyModel:
+    '''Callable like the inference backends: (batch, timesteps, 10) window in, class probabilities out'''
+
+    def __init__(self, path):
+        with numpy.load(path) as weights:
+            spec = json.loads(str(weights['spec']))
+            self.layers = [LAYERS[layer['type']](
+                               *[weights[f"{n}_{name}"].astype(numpy.float32) for name in layer['weights']],
+                               **layer['config'])
+                           for n, layer in enumerate(spec)]
+            self.input_shape = (None,) + tuple(int(n) for n in weights['input_shape'])
+
+    def __call__(self, window):
+        x = numpy.asarray(window, dtype=numpy.float32)
+        for layer in self.layers:
+            x = layer(x)
+        return x
+
+    predict = __call__
@@ -0,0 +1,90 @@
+'''
+One MQTT connection shared by every tag of a process.
+
+Tags publish into a queue instead of straight to a client, and one task drains
+it onto the connection, so the connection count and keep-alive traffic stay the
+same however many tags are added. A message still waiting when a newer one for
+the same topic comes in is replaced by it: a predict topic carries the gesture
+shown right now, and an older one has been superseded before it was sent. The
+queue drains on the next pass of the event loop, so only bursts coalesce; with
+linger > 0 it waits that long after the first message, coalescing more at the
+price of that much latency.
+
+    publisher = SharedPublisher(mqtt_client)
+    SensorTag(..., mqtt_client= publisher)
+'''
+import asyncio
+import collections
+
+from time import perf_counter
+
+LINGER = 0.0
+
+
+class SharedPublisher:
+
+    def __init__(self, mqtt_client, linger=LINGER, coalesce=True):
+        self._client = mqtt_client
+        self._linger = linger
+        self._coalesce = coalesce
+        # [topic, payload] in the order first queued, and the entry still queued per topic
+        self._queue = []
+        self._queued = {}
+        self._wakeup = asyncio.Event()
+        self._drainer = None
+        self.accepted = collections.Counter()
+        self.published = collections.Counter()
+        self.coalesced = collections.Counter()
+        self._last = (perf_counter(), collections.Counter(), collections.Counter(), collections.Counter())
+
+    def publish(self, topic, payload):
+        '''Queues a message, replacing one still waiting for the same topic, and returns without waiting'''
+        self.accepted[topic] += 1
+        entry = self._queued.get(topic) if self._coalesce else None
+        if entry is not None:
+            entry[1] = payload
+            self.coalesced[topic] += 1
+        else:
+            entry = [topic, payload]
+            self._queue.append(entry)
+            self._queued[topic] = entry
+        if self._drainer is None:
+            self._drainer = asyncio.ensure_future(self._drain())
+        self._wakeup.set()
+
+    def _send(self):
+        queue, self._queue, self._queued = self._queue, [], {}
+        for topic, payload in queue:
+            self._client.publish(topic, payload)
+            self.published[topic] += 1
+
+    async def _drain(self):
+        while True:
+            await self._wakeup.wait()
+            if self._linger:
+                await asyncio.sleep(self._linger)
+            self._wakeup.clear()
+            self._send()
+
+    def pending(self):
+        return len(self._queue)
+
+    async def close(self):
+        '''Sends whatever is still queued and stops draining'''
+        if self._drainer is not None:
+            self._drainer.cancel()
+            await asyncio.gather(self._drainer, return_exceptions=True)
+            self._drainer = None
+        self._send()
+
+    def report(self):
+        '''Per-topic rates since the last report'''
+        now = perf_counter()
+        since, accepted, published, coalesced = self._last
+        elapsed = max(now - since, 1e-9)
+        lines = [f"{topic}: {(self.accepted[topic] - accepted[topic]) / elapsed:6.1f} msgs/s in, "
+                 f"{(self.published[topic] - published[topic]) / elapsed:6.1f} msgs/s out, "
+                 f"{(self.coalesced[topic] - coalesced[topic]) / elapsed:6.1f} msgs/s coalesced"
+                 for topic in sorted(self.accepted)]
+        self._last = (now, self.accepted.copy(), self.published.copy(), self.coalesced.copy())
+        return "\n".join(lines)
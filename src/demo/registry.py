@@ -0,0 +1,140 @@
+'''
+Process-wide registry of loaded models.
+
+Every model artifact is loaded once per backend and shared: asking again for
+the same path, or for a different path with identical content, uses the same
+loaded model. Artifacts are keyed by a sha256 of their content, which is only
+recomputed when a file's mtime or size changes. A ModelHandle, warmed up for
+the batch sizes asked for, is shared by the paths whose artifact and sidecar
+both match, so a copy with sidecar metadata of its own keeps it.
+
+What a model predicts comes from a sidecar JSON next to it
+(hand_model.hd5 -> hand_model.json):
+
+    {"actions": ["HAND_IDLE", "RAISE", "WAVE", "CLAP"], "confidence": 0.85,
+     "idle": "HAND_IDLE", "timesteps": 5, "channels": ["acc_x", ..., "baro"]}
+'''
+import os
+import json
+import hashlib
+
+from window_buffer import CHANNELS
+from inference import load_backend, weights_path, warm_up
+
+
+def metadata_path(model_path):
+    return os.path.splitext(model_path)[0] + ".json"
+
+
+def artifact_files(path):
+    '''The files making up an artifact, a single file or a SavedModel directory'''
+    if not os.path.isdir(path):
+        return [path]
+    files = []
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        files += [os.path.join(root, name) for name in sorted(names)]
+    return files
+
+
+class ModelInfo:
+    '''What a model outputs and what input it expects, as read from its sidecar'''
+
+    def __init__(self, actions, confidence, idle, timesteps, channels=CHANNELS):
+        self.actions = dict(enumerate(actions))
+        self.confidence = confidence
+        self.idle = idle
+        self.timesteps = timesteps
+        self.channels = tuple(channels)
+        if self.channels != CHANNELS:
+            raise ValueError(f"model expects channels {self.channels}, the window buffer produces {CHANNELS}")
+
+    @classmethod
+    def load(cls, model_path):
+        return cls(**cls.read(model_path))
+
+    @staticmethod
+    def read(model_path):
+        with open(metadata_path(model_path)) as f:
+            return json.load(f)
+
+
+class ModelHandle:
+    '''A loaded model shared by every tag using it: its inference callable plus metadata'''
+
+    def __init__(self, path, digest, backend, infer, info):
+        self.path = path
+        self.digest = digest
+        self.backend = backend
+        self.infer = infer
+        self.info = info
+        self.warmup_time = 0.0
+        self._warm = set()
+
+    def __call__(self, window):
+        return self.infer(window)
+
+    def warm_up(self, batch_sizes=(1,)):
+        '''Warms the model up for the batch sizes it has not seen yet, returns the seconds it took'''
+        sizes = [size for size in batch_sizes if size not in self._warm]
+        if not sizes:
+            return 0.0
+        elapsed = warm_up(self.infer, self.info.timesteps, sizes)
+        self._warm.update(sizes)
+        self.warmup_time += elapsed
+        print(f"{self.path} warmed up for batch sizes {sizes} in {elapsed * 1000:.1f}ms")
+        return elapsed
+
+
+class ModelRegistry:
+
+    def __init__(self):
+        self._digests = {}
+        # (digest, backend) -> inference callable, and the handles using it per sidecar
+        self._models = {}
+        self._handles = {}
+        self.loads = 0
+
+    def digest(self, path):
+        '''sha256 of an artifact's content, cached against the mtime and size of its files'''
+        files = artifact_files(path)
+        stats = tuple((name, os.stat(name).st_mtime_ns, os.stat(name).st_size) for name in files)
+        key = os.path.realpath(path)
+        cached = self._digests.get(key)
+        if cached is not None and cached[0] == stats:
+            return cached[1]
+        h = hashlib.sha256()
+        for name in files:
+            h.update(os.path.relpath(name, path).encode())
+            with open(name, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+        self._digests[key] = (stats, h.hexdigest())
+        return h.hexdigest()
+
+    def get(self, path, backend='compiled', batch_sizes=(1,)):
+        # the numpy backend runs the exported weights, so those are the artifact that has to match
+        artifact = weights_path(path) if backend == 'numpy' else path
+        model = (self.digest(artifact), backend)
+        metadata = ModelInfo.read(path)
+        key = model + (json.dumps(metadata, sort_keys=True),)
+        if key not in self._handles:
+            if model not in self._models:
+                # keras backends import TensorFlow here, the numpy backend never does
+                self._models[model] = load_backend(path, backend)
+                self.loads += 1
+                print(f"{path} loaded with {backend} backend, ready to predict")
+            self._handles[key] = ModelHandle(path, model[0], backend, self._models[model], ModelInfo(**metadata))
+        # before the first real window, so it does not pay for tracing and allocation
+        self._handles[key].warm_up(batch_sizes)
+        return self._handles[key]
+
+    def __len__(self):
+        return len(self._models)
+
+
+REGISTRY = ModelRegistry()
+
+
+def get_model(path, backend='compiled', batch_sizes=(1,)):
+    return REGISTRY.get(path, backend, batch_sizes)
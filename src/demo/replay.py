@@ -0,0 +1,146 @@
+'''
+Hardware-free stand-in for BleakClient that replays recorded sensor data.
+
+Recordings are either ProjectData zips (train.zip / test.zip, sampled at 10Hz)
+or capture files written by generate/data/capture.py, which carry their own
+timestamps. Samples are encoded back into the raw GATT payloads of the CC2650,
+so BarometerSensor, MovementSensorMPU9250 and BatteryService decode them as if
+they came from a tag:
+
+    SensorTag(...).run(client_factory=partial(ReplayClient, source="test.zip", speed=0))
+
+speed 1 replays in real time, 10 ten times faster and 0 as fast as possible.
+'''
+import os
+import json
+import numpy
+import struct
+import asyncio
+import zipfile
+
+from time import perf_counter
+
+from window_buffer import CHANNELS
+
+SAMPLE_PERIOD = 0.1
+CAPTURE_MAGIC = b'CS3237CAP'
+
+BARO_UUID = "f000aa41-0451-4000-b000-000000000000"
+MOVEMENT_UUID = "f000aa81-0451-4000-b000-000000000000"
+BATTERY_UUID = "00002a19-0000-1000-8000-00805f9b34fb"
+
+# raw units per physical unit, inverse of the scales in the MovementSensorMPU9250 sub services
+GYRO_SCALE = 65536.0 / 500.0
+ACCEL_SCALE = 32768.0 / 8.0
+MAG_SCALE = 32760 / 4912.0
+
+
+def load_recording(path):
+    '''
+    Returns (timestamps, rows, labels) of a recording, rows being (samples, 10) in CHANNELS order.
+    '''
+    if path.endswith(".zip"):
+        group = os.path.splitext(os.path.basename(path))[0]
+        with zipfile.ZipFile(path) as archive:
+            channels = [numpy.loadtxt(archive.open(f"{group}/IndividualSignals/{name}_{group}.csv"),
+                                      delimiter=",", dtype=numpy.float32, ndmin=2)
+                        for name in CHANNELS]
+            labels = numpy.loadtxt(archive.open(f"{group}/y_{group}.csv"), dtype=int, ndmin=1)
+        windows = numpy.stack(channels, axis=-1)
+        rows = windows.reshape(-1, len(CHANNELS))
+        return numpy.arange(len(rows)) * SAMPLE_PERIOD, rows, numpy.repeat(labels, windows.shape[1])
+
+    with open(path, "rb") as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is neither a ProjectData zip nor a capture file")
+        length = int.from_bytes(f.read(4), "little")
+        header = json.loads(f.read(length))
+        records = numpy.fromfile(f, dtype=numpy.dtype([tuple(field) for field in header['descr']]))
+    rows = numpy.stack([records[name] for name in CHANNELS], axis=-1).astype(numpy.float32)
+    return records['timestamp'] - records['timestamp'][0], rows, records['label']
+
+
+def baro_payload(press):
+    raw = int(round(press * 100))
+    return bytearray(struct.pack('<BBBBBB', 0, 0, 0, raw & 0xFF, (raw >> 8) & 0xFF, (raw >> 16) & 0xFF))
+
+
+def motion_payload(row):
+    raw = numpy.concatenate([row[3:6] * GYRO_SCALE, row[0:3] * ACCEL_SCALE, row[6:9] * MAG_SCALE])
+    return bytearray(struct.pack("<hhhhhhhhh", *numpy.clip(numpy.rint(raw), -32768, 32767).astype(int)))
+
+
+class ReplayClient:
+
+    def __init__(self, address=None, source=None, speed=1.0, loop=False, battery=100, recording=None):
+        self.address = address
+        self.speed = speed
+        self.loop = loop
+        self.battery = battery
+        self.timestamps, self.rows, self.labels = recording or load_recording(source)
+        self.cursor = 0
+        self.finished = asyncio.Event()
+        self._callbacks = {}
+        self._notifier = None
+        self._start = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        if self._notifier is not None:
+            self._notifier.cancel()
+
+    async def is_connected(self):
+        return not self.finished.is_set()
+
+    async def write_gatt_char(self, uuid, data):
+        # sensor enable and period writes have nothing to configure in a replay
+        pass
+
+    async def read_gatt_char(self, uuid):
+        if uuid == BATTERY_UUID:
+            return bytearray([self.battery])
+        await self._wait_for_sample()
+        row = self.rows[self.cursor]
+        if uuid == BARO_UUID:
+            return baro_payload(row[9])
+        # SensorStream.poll reads the barometer, then the movement sensor for each sample
+        self._advance()
+        return motion_payload(row)
+
+    async def start_notify(self, uuid, callback):
+        self._callbacks[uuid] = callback
+        if self._notifier is None:
+            self._notifier = asyncio.ensure_future(self._notify())
+
+    def _advance(self):
+        self.cursor += 1
+        if self.cursor == len(self.rows):
+            if self.loop:
+                self.cursor = 0
+                self._start = None
+            else:
+                self.finished.set()
+
+    async def _wait_for_sample(self):
+        if self.finished.is_set():
+            # an exhausted replay behaves like a tag that stopped sending, callers wait on `finished`
+            await asyncio.get_event_loop().create_future()
+        if self._start is None:
+            self._start = perf_counter() - self.timestamps[self.cursor] / self.speed if self.speed else perf_counter()
+        if self.speed:
+            await asyncio.sleep(max(0.0, self._start + self.timestamps[self.cursor] / self.speed - perf_counter()))
+        else:
+            # still yield so the consumer runs between samples
+            await asyncio.sleep(0)
+
+    async def _notify(self):
+        while not self.finished.is_set():
+            await self._wait_for_sample()
+            row = self.rows[self.cursor]
+            if BARO_UUID in self._callbacks:
+                self._callbacks[BARO_UUID](BARO_UUID, baro_payload(row[9]))
+            if MOVEMENT_UUID in self._callbacks:
+                self._callbacks[MOVEMENT_UUID](MOVEMENT_UUID, motion_payload(row))
+            self._advance()
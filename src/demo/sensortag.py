@@ -6,22 +6,29 @@ import numpy
 import struct
 import asyncio
 import platform
-import tensorflow as tf
+import collections
 import paho.mqtt.client as mqtt
 
-from time import time
+from time import time, perf_counter
 from bleak import BleakClient
 from dotenv import load_dotenv
 from argparse import ArgumentParser
 
 from numpy import mean, std, dstack
-from keras.models import Sequential, load_model
-from tensorflow.python.keras.backend import set_session
+from window_buffer import WindowBuffer
+from inference import BACKENDS
+from registry import get_model
+from mqtt_async import AsyncMQTTClient, MQTT_TRANSPORTS
+from spool import OfflineQueue
 
 SHOW_INTERVAL = 3
 BATTERY_INTERVAL = 15
+# Samples buffered between the BLE callbacks and the predictor
+SAMPLE_QUEUE_SIZE = 50
+# Recent predictions kept for latency reporting
+LATENCY_WINDOW = 100
 
-session = tf.compat.v1.Session(graph=tf.compat.v1.Graph())
+MODEL_FILES = {'hand': "hand_model.hd5", 'head': "lstm_model.hd5"}
 
 # actions = {0: 'NOD', 1: 'SHAKE'}
 PREVIOUS_SHOWN = ''
@@ -49,6 +56,10 @@ class Sensor(Service):
         val = await client.read_gatt_char(self.data_uuid)
         return self.callback(1, val)
 
+    async def start_listener(self, client, handler):
+        # handler receives the raw notification, decoding is left to the caller
+        await client.start_notify(self.data_uuid, handler)
+
 class BatteryService(Service):
     def __init__(self):
         super().__init__()
@@ -157,87 +168,96 @@ class BarometerSensor(Sensor):
         press = (pH*65536 + pM*256 + pL) / 100.0
         return press
 
+class SensorStream:
+    '''Pairs barometer and movement readings into (baro, motion) samples on an asyncio queue'''
+
+    def __init__(self, barometer, movement, maxsize=SAMPLE_QUEUE_SIZE):
+        self._barometer = barometer
+        self._movement = movement
+        self._latest_baro = None
+        self.dropped = 0
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    def _push(self, sample):
+        # never block inside a BLE callback, drop the oldest sample instead
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(sample)
+
+    def _on_baro(self, sender, data):
+        self._latest_baro = self._barometer.callback(sender, data)
+
+    def _on_motion(self, sender, data):
+        # movement notifications drive the sample clock, paired with the last pressure seen
+        if self._latest_baro is None:
+            return
+        self._push((self._latest_baro, self._movement.callback(sender, data)))
+
+    async def subscribe(self, client):
+        await self._barometer.start_listener(client, self._on_baro)
+        await self._movement.start_listener(client, self._on_motion)
+
+    async def poll(self, client):
+        while True:
+            baro_reading = await self._barometer.read(client)
+            motion_reading = await self._movement.read(client)
+            await self.queue.put((baro_reading, motion_reading))
+
+    async def get(self):
+        return await self.queue.get()
+
 class lstm_model():
-    def __init__(self, model):
+    def __init__(self, model, hop=None, backend='compiled'):
         self._temp_predict = ''
         self._predict_time = 0.0
-        self._model = model
-
-        if model == "hand_model.hd5":
-            self._confidence = 0.85
-            self._actions = {0: 'HAND_IDLE', 1: 'RAISE', 2: 'WAVE', 3: 'CLAP'}
-            self._IDLE = 'HAND_IDLE'
-        else: # head model
-            self._confidence = 0.94
-            self._actions = {0: 'NOD', 1: 'SHAKE', 2: 'LOOKUP', 3: 'TILT'}
-            self._IDLE = 'IDLE'
-
-        self._loaded_model = load_model(model)
-        print(f"{model} loaded, ready to predict")
+
+        # loaded once per process and shared between tags, the buffer and smoothing state are not
+        self._handle = get_model(model, backend)
+        self._infer = self._handle.infer
+
+        info = self._handle.info
+        self._confidence = info.confidence
+        self._actions = info.actions
+        self._IDLE = info.idle
         
-        self.ACC_X_BUFFER  = []
-        self.ACC_Y_BUFFER  = []
-        self.ACC_Z_BUFFER  = []
-        self.GYRO_X_BUFFER = []
-        self.GYRO_Y_BUFFER = []
-        self.GYRO_Z_BUFFER = []
-        self.MAG_X_BUFFER  = []
-        self.MAG_Y_BUFFER  = []
-        self.MAG_Z_BUFFER  = []
-        self.BARO_BUFFER   = []
+        self._buffer = WindowBuffer(info.timesteps, hop)
+
+    @property
+    def handle(self):
+        return self._handle
 
     def append_buffer(self, baro, motion):
-        self.BARO_BUFFER.append(baro)
-        self.GYRO_X_BUFFER.append(motion[0])
-        self.GYRO_Y_BUFFER.append(motion[1])
-        self.GYRO_Z_BUFFER.append(motion[2])
-        self.ACC_X_BUFFER.append(motion[3])
-        self.ACC_Y_BUFFER.append(motion[4])
-        self.ACC_Z_BUFFER.append(motion[5])
-        self.MAG_X_BUFFER.append(motion[6])
-        self.MAG_Y_BUFFER.append(motion[7])
-        self.MAG_Z_BUFFER.append(motion[8])
-
-    # load the dataset, returns train and test X and y elements
+        self._buffer.append(baro, motion)
+
+    # a window is due every hop samples once the buffer has filled
+    def ready(self):
+        return self._buffer.ready()
+
+    # returns the buffered window as model input, shape (1, timesteps, 10)
     def load_dataset(self):
-        # load all data
-        loaded = []
-        loaded.append(self.ACC_X_BUFFER)
-        loaded.append(self.ACC_Y_BUFFER)
-        loaded.append(self.ACC_Z_BUFFER)
-        loaded.append(self.GYRO_X_BUFFER)
-        loaded.append(self.GYRO_Y_BUFFER)
-        loaded.append(self.GYRO_Z_BUFFER)
-        loaded.append(self.MAG_X_BUFFER)
-        loaded.append(self.MAG_X_BUFFER)
-        loaded.append(self.MAG_X_BUFFER)
-        loaded.append(self.BARO_BUFFER)
-        # stack group so that features are the 3rd dimension
-        data = dstack(loaded)
-        return data
+        return self._buffer.window()
 
     # Clearing buffers after making prediction
     def clear_buffer(self):
-        self.BARO_BUFFER.clear()
-        self.GYRO_X_BUFFER.clear()
-        self.GYRO_Y_BUFFER.clear()
-        self.GYRO_Z_BUFFER.clear()
-        self.ACC_X_BUFFER.clear()
-        self.ACC_Y_BUFFER.clear()
-        self.ACC_Z_BUFFER.clear()
-        self.MAG_X_BUFFER.clear()
-        self.MAG_Y_BUFFER.clear()
-        self.MAG_Z_BUFFER.clear()
+        self._buffer.clear()
 
     def predict(self):
         data = self.load_dataset()
-        result = self._loaded_model.predict(data)
+        result = self._infer(data)
         # print(f"result: {result}")
-        self.clear_buffer()
-        themax = numpy.argmax(result[0])
+        return self.decide(result[0])
+
+    # Predicting through a MicroBatcher shared with other tags
+    async def predict_batched(self, batcher):
+        return self.decide(await batcher.submit(self.load_dataset()))
+
+    # Turns the class probabilities of one window into the action to show
+    def decide(self, result):
+        themax = numpy.argmax(result)
         # print(f"themax: {themax}")
 
-        if (result[0][themax] < self._confidence): # prediction = 'IDLE'            
+        if (result[themax] < self._confidence): # prediction = 'IDLE'            
             
             if self._temp_predict != self._IDLE:
                 if time() - self._predict_time < SHOW_INTERVAL:
@@ -253,34 +273,49 @@ class lstm_model():
             return self._temp_predict
 
 class SensorTag:
-    def __init__(self, address, name, model, mqtt_client):
+    def __init__(self, address, name, model, mqtt_client, hop=None, backend='compiled', batcher=None):
         self._battery_life = None
         self._address = address
         self._mqtt_client = mqtt_client
         self._previous_shown = ''
-        # Iterations of data collection
-        self._timesteps = 5 
+        self._hop = hop
+        self._backend = backend
 
-        self._topic = "Group_12/LSTM/predict/"
+        self._user_topic = "Group_12/LSTM/predict/"
         print(f"name: {name}")
         if name == 'glen':
-            self._topic += "Glen"
+            self._user_topic += "Glen"
         elif name == 'nicholas':
-            self._topic += "Nicholas"
+            self._user_topic += "Nicholas"
         elif name == 'sean':
-            self._topic += "Sean"
+            self._user_topic += "Sean"
         else:
-            self._topic += "Permas"
+            self._user_topic += "Permas"
 
         # Enabling battery status
         self._battery = BatteryService()
         
+        self.switch_model(model, batcher)
+
+        self.samples = 0
+        self.predict_latencies = collections.deque(maxlen=LATENCY_WINDOW)
+
+    @property
+    def topic(self):
+        return self._topic
+
+    @property
+    def address(self):
+        return self._address
+
+    # Models come from the registry, so switching back and forth never reloads one
+    def switch_model(self, model, batcher=None):
+        self._topic = self._user_topic
         if model == 'hand':
             self._topic += "_hand"
-            self._model = lstm_model(model= "hand_model.hd5")
-        else:
-            self._model = lstm_model(model= "lstm_model.hd5")
-
+        self._model = lstm_model(model= MODEL_FILES[model], hop= self._hop, backend= self._backend)
+        # windows go through the shared batcher when one is given, else straight to the model
+        self._batcher = batcher
         print(f"topic: {self._topic}")
 
     def check_and_publish(self, prediction):
@@ -292,8 +327,8 @@ class SensorTag:
         
         self._previous_shown = prediction
 
-    async def run(self):
-        async with BleakClient(self._address) as client:
+    async def run(self, stream=False, client_factory=BleakClient):
+        async with client_factory(self._address) as client:
             x = await client.is_connected()
             print("Connected: {0}".format(x))
 
@@ -313,23 +348,41 @@ class SensorTag:
 
             self._battery_life = await self._battery.read(client) 
             prev_battery_reading_time = time() 
-                
-            while (True):
-                for i in range(self._timesteps):
-                    baro_reading = await self._barometer_sensor.read(client)
-                    motion_reading = await self._m_sensor.read(client)
-                    self._model.append_buffer(baro= baro_reading, motion= motion_reading)
-                
-                prediction = self._model.predict()
 
-                print('predicted result: ', prediction)
-                
-                if time() - prev_battery_reading_time > BATTERY_INTERVAL:
-                    self._battery_life = await self._battery.read(client)
-                    print(self._battery_life)
-                    prev_battery_reading_time = time()
+            # Samples arrive either from notifications or from a polling task
+            self._stream = SensorStream(self._barometer_sensor, self._m_sensor)
+            if stream:
+                await self._stream.subscribe(client)
+                poller = None
+            else:
+                poller = asyncio.ensure_future(self._stream.poll(client))
 
-                self.check_and_publish(prediction)
+            try:
+                while (True):
+                    baro_reading, motion_reading = await self._stream.get()
+                    self.samples += 1
+                    self._model.append_buffer(baro= baro_reading, motion= motion_reading)
+                    if not self._model.ready():
+                        continue
+
+                    predict_start = perf_counter()
+                    if self._batcher is None:
+                        prediction = self._model.predict()
+                    else:
+                        prediction = await self._model.predict_batched(self._batcher)
+                    self.predict_latencies.append(perf_counter() - predict_start)
+
+                    print('predicted result: ', prediction)
+                    
+                    if time() - prev_battery_reading_time > BATTERY_INTERVAL:
+                        self._battery_life = await self._battery.read(client)
+                        print(self._battery_life)
+                        prev_battery_reading_time = time()
+
+                    self.check_and_publish(prediction)
+            finally:
+                if poller is not None:
+                    poller.cancel()
 
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
@@ -337,7 +390,7 @@ def on_connect(client, userdata, flags, rc):
     else:
         print("Failed to connect. Error code: %d." % rc)
         
-def setup(hostname):
+def setup(hostname, port=1883):
     print("setting up client")
     USERID = os.getenv("REACT_APP_EC2_USER")
     PASSWORD = os.getenv("REACT_APP_EC2_PASSWORD")    
@@ -345,9 +398,16 @@ def setup(hostname):
     client = mqtt.Client()
     client.username_pw_set(USERID, PASSWORD)
     client.on_connect = on_connect
-    client.connect(hostname, port=1883)
+    client.connect(hostname, port=port)
     client.loop_start()
     return client
+
+async def async_setup(hostname, port=1883):
+    # publishes from the event loop itself, no network thread
+    print("setting up client")
+    client = AsyncMQTTClient(hostname, port, os.getenv("REACT_APP_EC2_USER"), os.getenv("REACT_APP_EC2_PASSWORD"))
+    client.on_connect = on_connect
+    return await client.connect()
     
 if __name__ == '__main__':
 
@@ -358,6 +418,14 @@ if __name__ == '__main__':
     p.add_argument("-s1", action= "store_true", help= "sensortag 1")
     p.add_argument("-s2", action= "store_true", help = "sensortag 2")
     p.add_argument("-m", required= True, choices= ['head', 'hand'], type = str, help= "choose model to use")
+    p.add_argument("--stream", action= "store_true", help= "subscribe to sensor notifications instead of polling")
+    p.add_argument("--hop", type= int, help= "predict every HOP samples over the last window (default: window size)")
+    p.add_argument("--backend", default= "compiled", choices= list(BACKENDS), type= str, help= "how the model is called per window")
+    p.add_argument("--broker", type= str, help= "MQTT broker to publish to, e.g. localhost for broker.py (default: the EC2 broker)")
+    p.add_argument("--port", default= 1883, type= int, help= "port of the MQTT broker")
+    p.add_argument("--mqtt", default= "asyncio", choices= MQTT_TRANSPORTS, type= str, help= "MQTT client, on the asyncio loop or on paho's own thread")
+    p.add_argument("--outbox", type= str, help= "file to queue predictions in while the broker is unreachable, sent once it is back")
+    p.add_argument("--outbox-ttl", type= float, help= "seconds a queued prediction stays worth sending (default: forever)")
 
     args = p.parse_args()
     if args.s1 and args.s2:
@@ -378,22 +446,33 @@ if __name__ == '__main__':
                 addr = addrs[-1]
             else:
                 addr = "6FFBA6AE-0802-4D92-B1CD-041BE4B4FEB9"
+    except FileNotFoundError:
+        print("no file named sensortag_addr.txt, create file and input sensortag MAC addr")
+        exit(1)
 
-        # Setting MQTT Client
-        mqtt_client = setup(os.getenv("REACT_APP_EC2_PUBLIC_IP"))
+    loop = asyncio.get_event_loop()
 
-        sensortag = SensorTag(address= addr, name= args.n, model= args.m, mqtt_client= mqtt_client)
+    # Setting MQTT Client
+    hostname = args.broker or os.getenv("REACT_APP_EC2_PUBLIC_IP")
+    if args.mqtt == 'paho':
+        mqtt_client = setup(hostname, args.port)
+    else:
+        mqtt_client = loop.run_until_complete(async_setup(hostname, args.port))
+    outbox = None
+    if args.outbox:
+        mqtt_client = outbox = OfflineQueue(mqtt_client, args.outbox, ttl= args.outbox_ttl)
 
-        loop = asyncio.get_event_loop()
-        
-        try:
-            loop.run_until_complete(sensortag.run())
-        except KeyboardInterrupt:
-            loop.stop()
-            loop.close()
-            print("Received exit, exiting...")
-        # except Exception as e:
-        #     print(f"exception: {e}")
+    sensortag = SensorTag(address= addr, name= args.n, model= args.m, mqtt_client= mqtt_client, hop= args.hop, backend= args.backend)
 
-    except FileNotFoundError:
-        print("no file named sensortag_addr.txt, create file and input sensortag MAC addr")      
\ No newline at end of file
+    try:
+        loop.run_until_complete(sensortag.run(stream= args.stream))
+    except KeyboardInterrupt:
+        print("Received exit, exiting...")
+    # except Exception as e:
+    #     print(f"exception: {e}")
+    finally:
+        if outbox is not None:
+            # predictions still queued in memory go to the file, for the next run to send
+            outbox.close()
+        loop.stop()
+        loop.close()
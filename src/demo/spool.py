@@ -0,0 +1,245 @@
+'''
+Outbound MQTT queue that survives the broker being down, slow, or the process
+restarting.
+
+OfflineQueue wraps an MQTT client (asyncio or paho) and is handed to the tags
+in its place. While the broker can be written to, messages go straight
+through. Otherwise they are queued in memory, up to max_memory of them, and
+after that everything queued is spilled to an append-only file, so memory use
+stays flat however long the outage lasts. Once the broker is back the backlog
+is sent in order, batch messages per pass of the event loop, waiting for the
+socket to drain between batches:
+
+    outbox = OfflineQueue(mqtt_client, "outbox.spool", ttl=600)
+    SensorTag(..., mqtt_client= outbox)
+
+A record in the file is
+
+    time      d    seconds since the epoch, when it was published
+    topic     H    length of the topic
+    payload   I    length of the payload
+    topic and payload bytes
+
+The offset of the first record not yet sent is kept next to the file
+(outbox.spool.offset), so a restarted process sends what the last one could
+not. Messages older than ttl seconds when their turn comes are dropped, and
+when the file holds more than max_bytes the oldest records are dropped.
+'''
+import os
+import struct
+import asyncio
+import collections
+
+from time import time, perf_counter
+
+OUTBOX = "outbox.spool"
+RECORD = struct.Struct('<dHI')
+MAX_MEMORY = 100
+MAX_BYTES = 16 * 1024 * 1024
+# seconds a message may wait before it is no longer worth sending, None keeps them all
+TTL = None
+REPLAY_BATCH = 100
+RETRY_INTERVAL = 0.1
+
+
+class OfflineQueue:
+
+    def __init__(self, mqtt_client, path=OUTBOX, max_memory=MAX_MEMORY, max_bytes=MAX_BYTES, ttl=TTL,
+                 batch=REPLAY_BATCH, fsync=False):
+        self._client = mqtt_client
+        self.path = path
+        self._max_memory = max_memory
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._batch = batch
+        self._fsync = fsync
+        self._memory = collections.deque()
+        self._file = open(path, "a+b")
+        self._write_offset = self._file.seek(0, os.SEEK_END)
+        self._read_offset = self._load_offset()
+        self._spooled = self._count(self._read_offset)
+        self._wakeup = asyncio.Event()
+        self._replayer = None
+        self._replay_start = None
+        self._replay_sent = 0
+        self.sent = 0
+        self.replayed = 0
+        self.dropped = 0
+        self.expired = 0
+        self.replay_rate = None
+        if self._spooled:
+            # left over from the last run, sent as soon as the broker is there
+            self._start_replay()
+
+    def _load_offset(self):
+        try:
+            with open(self.path + ".offset") as f:
+                offset = int(f.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+        return offset if offset <= self._write_offset else 0
+
+    def _save_offset(self):
+        with open(self.path + ".offset.tmp", "w") as f:
+            f.write(str(self._read_offset))
+        os.replace(self.path + ".offset.tmp", self.path + ".offset")
+
+    def _count(self, offset):
+        count = 0
+        while offset < self._write_offset:
+            self._file.seek(offset)
+            header = self._file.read(RECORD.size)
+            length = RECORD.size + sum(RECORD.unpack(header)[1:]) if len(header) == RECORD.size else None
+            if length is None or offset + length > self._write_offset:
+                # the last record was cut short by a crash, it was never queued in full
+                self._file.truncate(offset)
+                self._write_offset = offset
+                break
+            offset += length
+            count += 1
+        return count
+
+    def _available(self):
+        # the asyncio client also counts a broker that stopped reading as unavailable
+        if hasattr(self._client, "writable"):
+            return self._client.writable()
+        return self._client.is_connected()
+
+    def queued(self):
+        return len(self._memory) + self._spooled
+
+    def publish(self, topic, payload):
+        '''Sends straight away when nothing is queued and the broker is there, queues the message otherwise'''
+        if isinstance(payload, str):
+            payload = payload.encode()
+        if not self.queued() and self._available():
+            self._client.publish(topic, payload)
+            self.sent += 1
+            return
+        now = time()
+        if self._spooled or len(self._memory) >= self._max_memory:
+            # from here on the file holds the whole backlog, in order
+            while self._memory:
+                self._append(*self._memory.popleft())
+            self._append(now, topic, payload)
+            self._file.flush()
+            if self._fsync:
+                os.fsync(self._file.fileno())
+        else:
+            self._memory.append((now, topic, payload))
+        self._start_replay()
+
+    def _start_replay(self):
+        if self._replayer is None or self._replayer.done():
+            self._replayer = asyncio.ensure_future(self._replay())
+        self._wakeup.set()
+
+    def _append(self, stamp, topic, payload):
+        topic = topic.encode()
+        self._file.write(RECORD.pack(stamp, len(topic), len(payload)) + topic + payload)
+        self._write_offset += RECORD.size + len(topic) + len(payload)
+        self._spooled += 1
+        dropped = self.dropped
+        while self._write_offset - self._read_offset > self._max_bytes:
+            self._file.flush()
+            self._read_record()
+            self.dropped += 1
+        if self._read_offset > self._max_bytes:
+            self._compact()
+        elif self.dropped != dropped:
+            # or a restart would bring the dropped records back
+            self._save_offset()
+
+    def _read_record(self):
+        self._file.seek(self._read_offset)
+        stamp, topic_length, payload_length = RECORD.unpack(self._file.read(RECORD.size))
+        topic = self._file.read(topic_length).decode()
+        payload = self._file.read(payload_length)
+        self._read_offset += RECORD.size + topic_length + payload_length
+        self._spooled -= 1
+        return stamp, topic, payload
+
+    def _compact(self):
+        '''Rewrites the file without the records already sent or dropped'''
+        self._file.flush()
+        self._file.seek(self._read_offset)
+        with open(self.path + ".tmp", "wb") as f:
+            while True:
+                chunk = self._file.read(1 << 20)
+                if not chunk:
+                    break
+                f.write(chunk)
+        self._file.close()
+        os.replace(self.path + ".tmp", self.path)
+        self._file = open(self.path, "a+b")
+        self._write_offset -= self._read_offset
+        self._read_offset = 0
+        self._save_offset()
+
+    def _next(self):
+        if self._memory:
+            return self._memory.popleft()
+        return self._read_record()
+
+    def _send_batch(self):
+        now = time()
+        for _ in range(min(self._batch, self.queued())):
+            stamp, topic, payload = self._next()
+            if self._ttl is not None and now - stamp > self._ttl:
+                self.expired += 1
+                continue
+            self._client.publish(topic, payload)
+            self.replayed += 1
+            self._replay_sent += 1
+        if not self._spooled and self._write_offset:
+            # the file has been sent in full, start it over
+            self._file.truncate(0)
+            self._write_offset = self._read_offset = 0
+        self._save_offset()
+
+    async def _replay(self):
+        while True:
+            await self._wakeup.wait()
+            while self.queued():
+                if not self._available():
+                    self._replay_start = None
+                    await asyncio.sleep(RETRY_INTERVAL)
+                    continue
+                if self._replay_start is None:
+                    self._replay_start, self._replay_sent = perf_counter(), 0
+                try:
+                    self._send_batch()
+                    if hasattr(self._client, "flush"):
+                        await self._client.flush()
+                except (OSError, ConnectionError):
+                    # the broker went away mid-batch, wait for it to be back
+                    self._replay_start = None
+                    await asyncio.sleep(RETRY_INTERVAL)
+                    continue
+                # let the tags run between batches
+                await asyncio.sleep(0)
+            if self._replay_start is not None:
+                self.replay_rate = self._replay_sent / max(perf_counter() - self._replay_start, 1e-9)
+                self._replay_start = None
+            self._wakeup.clear()
+
+    async def drain(self):
+        '''Waits until the backlog has been sent'''
+        while self.queued():
+            await asyncio.sleep(RETRY_INTERVAL)
+
+    def close(self):
+        '''Stops replaying, keeping whatever is still queued in the file for the next run'''
+        if self._replayer is not None:
+            self._replayer.cancel()
+        while self._memory:
+            self._append(*self._memory.popleft())
+        self._file.close()
+
+    def stats(self):
+        line = (f"outbox: {len(self._memory)} queued in memory, {self._spooled} spooled "
+                f"({(self._write_offset - self._read_offset) / 1024:.1f}KiB), {self.sent} sent, {self.replayed} replayed, "
+                f"{self.dropped} dropped, {self.expired} expired")
+        if self.replay_rate is not None:
+            line += f", last replay {self.replay_rate:.0f} msgs/s"
+        return line
@@ -0,0 +1,51 @@
+'''
+Time-to-first-prediction breakdown for the demo entry points (--startup-profile).
+
+Import this module before anything heavy so START is taken when the script
+begins importing. Stages may overlap, e.g. the model loading in a thread while
+the tag connects, so the report gives each stage's start and duration relative
+to START rather than a sum.
+'''
+from time import perf_counter
+from contextlib import contextmanager
+
+START = perf_counter()
+
+
+class StartupProfile:
+
+    def __init__(self, enabled=False, start=START):
+        self.enabled = enabled
+        self._start = start
+        self._stages = []
+        self._reported = False
+
+    def record(self, name, begin, end=None):
+        self._stages.append((name, begin, perf_counter() if end is None else end))
+
+    @contextmanager
+    def stage(self, name):
+        begin = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, begin)
+
+    def first_prediction(self, window_start, predict_start):
+        '''Records filling the first window and predicting on it, then prints the report once'''
+        if self._reported:
+            return
+        self._reported = True
+        self.record("first window", window_start, predict_start)
+        self.record("first prediction", predict_start)
+        self.report()
+
+    def report(self):
+        if not self.enabled:
+            return
+        print("startup profile (ms from start):")
+        for name, begin, end in self._stages:
+            print(f"  {name:>18}: {(begin - self._start) * 1000:8.1f} -> {(end - self._start) * 1000:8.1f} "
+                  f"({(end - begin) * 1000:8.1f})")
+        end = max(end for _, _, end in self._stages)
+        print(f"  {'total':>18}: {(end - self._start) * 1000:8.1f}")
@@ -0,0 +1,185 @@
+'''
+Pipelined window uplink for demo_send.py.
+
+Windows are published with a sequence number and up to max_in_flight of them
+may be waiting for their result at once, so sampling the next window overlaps
+the round trip of the previous ones. The server answers every window on
+Group_12/LSTM/result/<name> with its sequence number. A window unanswered
+after `timeout` seconds is published again, up to `retries` times, then
+counted as lost.
+
+With max_batch > 1 consecutive windows are packed into one message, sent once
+max_batch of them are queued or the first has waited `linger` seconds, and the
+sequence number, slot and retransmits are per message. The server answers with
+a result per window, in "results", oldest first. delta and compress code the
+packed samples, see wire.py.
+'''
+import json
+import asyncio
+import collections
+import numpy
+
+from time import perf_counter
+
+from wire import encode
+
+CLASSIFY_TOPIC = "Group_12/LSTM/classify/{}"
+RESULT_TOPIC = "Group_12/LSTM/result/{}"
+MAX_IN_FLIGHT = 4
+TIMEOUT = 1.0
+RETRIES = 2
+MAX_BATCH = 1
+LINGER = 0.5
+# Recent round trips kept for reporting
+RTT_WINDOW = 1000
+
+
+class Uplink:
+
+    def __init__(self, mqtt_client, device, max_in_flight=MAX_IN_FLIGHT, timeout=TIMEOUT, retries=RETRIES,
+                 fmt='float32', on_result=None, max_batch=MAX_BATCH, linger=LINGER, delta=False, compress=False):
+        self._client = mqtt_client
+        self._topic = CLASSIFY_TOPIC.format(device)
+        self.result_topic = RESULT_TOPIC.format(device)
+        self._device = device
+        self._timeout = timeout
+        self._retries = retries
+        self._fmt = fmt
+        self._on_result = on_result
+        self._max_batch = max_batch
+        self._linger = linger
+        self._delta = delta
+        self._compress = compress
+        self._batch = []
+        self._battery = None
+        self._linger_timer = None
+        self._lingering = None
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._loop = asyncio.get_event_loop()
+        self._in_flight = {}
+        self._retransmitter = None
+        self.sequence = 0
+        self.windows = 0
+        self.samples = 0
+        self.bytes = 0
+        self._first_sent = None
+        self.acked = 0
+        self.retransmits = 0
+        self.lost = 0
+        self.duplicates = 0
+        self.rtts = collections.deque(maxlen=RTT_WINDOW)
+
+    def in_flight(self):
+        return len(self._in_flight)
+
+    async def send(self, window, battery=None):
+        '''
+        Queues a window and, once max_batch are queued, publishes them as soon as a
+        slot is free. Returns the sequence number of the message published, None
+        while the window waits for more, without waiting for the result.
+        '''
+        # copied, the caller may reuse its buffer straight away
+        self._batch.append(numpy.array(window, dtype=numpy.float32))
+        self._battery = battery
+        self.windows += 1
+        if len(self._batch) >= self._max_batch:
+            return await self._publish_batch()
+        if self._linger_timer is None:
+            self._linger_timer = self._loop.call_later(self._linger, self._linger_expired)
+        return None
+
+    def _linger_expired(self):
+        self._linger_timer = None
+        # nothing awaits this publish, so its errors are reported when it is done
+        self._lingering = asyncio.ensure_future(self._publish_batch())
+        self._lingering.add_done_callback(self._report_failure)
+
+    def _report_failure(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Could not publish the windows of {self._device}: {task.exception()!r}")
+
+    async def _publish_batch(self):
+        if self._linger_timer is not None:
+            self._linger_timer.cancel()
+            self._linger_timer = None
+        if not self._batch:
+            return None
+        windows, self._batch = self._batch, []
+        await self._slots.acquire()
+        sequence = self.sequence
+        self.sequence += 1
+        window = windows[0] if len(windows) == 1 else numpy.concatenate(windows)
+        payload = encode(window, device=self._device, sequence=sequence, battery=self._battery, fmt=self._fmt,
+                         delta=self._delta, compress=self._compress)
+        now = perf_counter()
+        if self._first_sent is None:
+            self._first_sent = now
+        self.samples += window.shape[0] * window.shape[1]
+        self.bytes += len(payload)
+        # first sent, last sent, attempts
+        self._in_flight[sequence] = [payload, now, now, 1]
+        # started first, a publish that raises is still retried
+        if self._retransmitter is None:
+            self._retransmitter = asyncio.ensure_future(self._retransmit())
+        self._client.publish(self._topic, payload)
+        return sequence
+
+    def on_message(self, client, userdata, msg):
+        # runs on the MQTT network thread, hand the result over to the event loop
+        self._loop.call_soon_threadsafe(self._acknowledge, json.loads(msg.payload))
+
+    def _acknowledge(self, result):
+        entry = self._in_flight.pop(result.get("sequence"), None)
+        if entry is None:
+            # the answer to a retransmit, or to a window already given up on
+            self.duplicates += 1
+            return
+        self.rtts.append(perf_counter() - entry[1])
+        self.acked += 1
+        self._slots.release()
+        if self._on_result is not None:
+            self._on_result(result)
+
+    async def _retransmit(self):
+        while True:
+            await asyncio.sleep(self._timeout / 4)
+            now = perf_counter()
+            for sequence, entry in list(self._in_flight.items()):
+                if now - entry[2] < self._timeout:
+                    continue
+                if entry[3] > self._retries:
+                    del self._in_flight[sequence]
+                    self.lost += 1
+                    self._slots.release()
+                else:
+                    self._client.publish(self._topic, entry[0])
+                    entry[2] = now
+                    entry[3] += 1
+                    self.retransmits += 1
+
+    async def drain(self):
+        '''Publishes the windows still queued and waits until every message is answered or lost'''
+        await self._publish_batch()
+        while self._in_flight:
+            await asyncio.sleep(self._timeout / 20)
+
+    def close(self):
+        if self._linger_timer is not None:
+            self._linger_timer.cancel()
+        if self._lingering is not None:
+            self._lingering.cancel()
+        if self._retransmitter is not None:
+            self._retransmitter.cancel()
+
+    def message_rate(self):
+        '''Messages published per second since the first'''
+        if self._first_sent is None:
+            return 0.0
+        return self.sequence / max(perf_counter() - self._first_sent, 1e-9)
+
+    def bytes_per_sample(self):
+        return self.bytes / max(self.samples, 1)
+
+    def stats(self):
+        return (f"{self.sequence} sent ({self.message_rate():.1f} msgs/s, {self.bytes_per_sample():.1f} bytes/sample), "
+                f"{self.acked} answered, {self.retransmits} retransmits, {self.lost} lost, {self.in_flight()} in flight")
@@ -0,0 +1,60 @@
+import numpy
+
+# Feature order the models were trained on, see load_dataset_group in generate/model
+CHANNELS = ('acc_x', 'acc_y', 'acc_z',
+            'gyro_x', 'gyro_y', 'gyro_z',
+            'mag_x', 'mag_y', 'mag_z',
+            'baro')
+
+
+class WindowBuffer:
+    '''
+    Fixed size (timesteps, 10) float32 ring buffer of sensor rows.
+
+    Every row is written twice, timesteps apart, so the latest `timesteps` rows
+    are always one contiguous slice and window() never has to copy.
+
+    hop is the number of new rows between windows: hop == timesteps gives
+    tumbling windows, a smaller hop gives overlapping (sliding) windows.
+    '''
+
+    def __init__(self, timesteps, hop=None):
+        self.timesteps = timesteps
+        self.hop = hop or timesteps
+        if not 0 < self.hop <= timesteps:
+            raise ValueError(f"hop must be between 1 and {timesteps}, got {self.hop}")
+        self._data = numpy.zeros((2 * timesteps, len(CHANNELS)), dtype=numpy.float32)
+        self._count = 0
+        self._pending = 0
+
+    def append(self, baro, motion):
+        '''motion is (gyro xyz, accel xyz, mag xyz) as returned by MovementSensorMPU9250'''
+        self.append_row((*motion[3:6], *motion[0:3], *motion[6:9], baro))
+
+    def append_row(self, row):
+        '''row holds one value per entry of CHANNELS, in that order'''
+        i = self._count % self.timesteps
+        self._data[i] = row
+        self._data[i + self.timesteps] = row
+        self._count += 1
+        self._pending += 1
+
+    def __len__(self):
+        return min(self._count, self.timesteps)
+
+    def full(self):
+        return self._count >= self.timesteps
+
+    def ready(self):
+        '''True once the buffer is full and hop rows arrived since the last window'''
+        return self.full() and self._pending >= self.hop
+
+    def window(self):
+        '''Returns the latest rows, oldest first, as a (1, timesteps, 10) view and starts the next hop'''
+        self._pending = 0
+        start = self._count % self.timesteps
+        return self._data[numpy.newaxis, start:start + self.timesteps]
+
+    def clear(self):
+        self._count = 0
+        self._pending = 0
@@ -0,0 +1,164 @@
+'''
+Payloads of the demo_send -> demo_receive sensor uplink.
+
+A binary payload is a fixed header, the device id, the window shape and, for
+int16, per-channel offsets and scales, padded to 4 bytes, then the raw
+little-endian window:
+
+    magic      2s   b'CW'
+    version    B    WIRE_VERSION, or 1 when no flags are set
+    dtype      B    0 float32, 1 int16, ORed with the flags
+    ndim       B
+    battery    B    percent, 255 when unknown
+    id length  H
+    sequence   I
+    timestamp  d    seconds since the epoch, as sent
+    device id  utf-8, id length bytes
+    shape      ndim x uint32
+    offsets    channels x float32, int16 only
+    scales     channels x float32, int16 only
+
+The window may be several consecutive windows, (B, timesteps, 10), sent as
+one message under one sequence number. Version 2 adds two flags for
+such sample blocks, both lossless:
+
+    DELTA   0x10  every sample is sent as its difference to the one before,
+                  taken on the raw bits (int32 for float32, int16 for int16)
+                  and wrapping around, so the first sample is sent as is
+    ZLIB    0x20  the window data, after delta coding, is zlib compressed
+
+float32 windows are decoded with numpy.frombuffer straight out of the payload.
+int16 windows are quantized per channel to half the size and decoded back to
+float32, the offsets and scales only pay off for windows of more than a few
+samples. Payloads starting with '{' are the original JSON
+{"data": [...], "batterylife": n} and are still understood.
+'''
+import json
+import zlib
+import numpy
+import struct
+
+from time import time
+
+MAGIC = b'CW'
+WIRE_VERSION = 2
+HEADER = struct.Struct('<2sBBBBHId')
+DTYPES = {0: numpy.dtype('<f4'), 1: numpy.dtype('<i2')}
+# integer views the delta coding works on
+DELTA_DTYPES = {0: numpy.dtype('<i4'), 1: numpy.dtype('<i2')}
+DELTA = 0x10
+ZLIB = 0x20
+ZLIB_LEVEL = 6
+# values a payload may declare, about 10k windows of 5 samples; bounds what a compressed one inflates to
+MAX_VALUES = 1 << 19
+DTYPE_CODES = {'float32': 0, 'int16': 1}
+FORMATS = ('float32', 'int16', 'json')
+NO_BATTERY = 255
+
+
+class Message:
+    '''A decoded window with what was sent alongside it'''
+
+    def __init__(self, window, device=None, sequence=None, timestamp=None, battery=None, version=None):
+        self.window = window
+        self.device = device
+        self.sequence = sequence
+        self.timestamp = timestamp
+        self.battery = battery
+        self.version = version
+
+
+def _inflate(data, size):
+    '''Decompresses a block that must come out exactly size bytes long, without inflating any further'''
+    inflater = zlib.decompressobj()
+    block = inflater.decompress(data, size)
+    # the end of the stream may still be waiting behind the limit
+    extra = inflater.decompress(inflater.unconsumed_tail, 1)
+    if len(block) != size or extra or not inflater.eof or inflater.unused_data:
+        raise ValueError(f"compressed window does not hold the {size} bytes its shape declares")
+    return block
+
+
+def _padding(length):
+    return -length % 4
+
+
+def quantize(window):
+    '''Per-channel offsets and scales mapping the window onto the int16 range'''
+    flat = window.reshape(-1, window.shape[-1]).astype(numpy.float64)
+    low, high = flat.min(axis=0), flat.max(axis=0)
+    offsets = (low + high) / 2
+    scales = numpy.maximum(high - low, 1e-12) / 65534
+    data = numpy.rint((window - offsets) / scales).astype('<i2')
+    return offsets.astype('<f4'), scales.astype('<f4'), data
+
+
+def encode(window, device='', sequence=0, timestamp=None, battery=None, fmt='float32', delta=False, compress=False):
+    timestamp = time() if timestamp is None else timestamp
+    if fmt == 'json':
+        return json.dumps({"data": numpy.asarray(window).tolist(), "batterylife": battery,
+                           "device": device, "sequence": sequence, "timestamp": timestamp}).encode()
+
+    window = numpy.asarray(window)
+    device_id = device.encode()
+    flags = (DELTA if delta else 0) | (ZLIB if compress else 0)
+    head = HEADER.pack(MAGIC, WIRE_VERSION if flags else 1, DTYPE_CODES[fmt] | flags, window.ndim,
+                       NO_BATTERY if battery is None else battery, len(device_id), sequence, timestamp)
+    parts = [head, device_id, struct.pack(f'<{window.ndim}I', *window.shape)]
+    if fmt == 'int16':
+        offsets, scales, data = quantize(window)
+        parts += [offsets.tobytes(), scales.tobytes()]
+    else:
+        data = window.astype('<f4', copy=False)
+    length = sum(len(part) for part in parts)
+    parts.append(bytes(_padding(length)))
+    data = numpy.ascontiguousarray(data)
+    if delta:
+        # samples follow each other across window boundaries, difference the (samples, channels) block
+        data = data.view(DELTA_DTYPES[DTYPE_CODES[fmt]]).reshape(-1, window.shape[-1])
+        data = numpy.concatenate([data[:1], data[1:] - data[:-1]])
+    block = data.tobytes()
+    parts.append(zlib.compress(block, ZLIB_LEVEL) if compress else block)
+    return b''.join(parts)
+
+
+def decode(payload):
+    if payload[:1] == b'{':
+        recv_dict = json.loads(payload)
+        return Message(numpy.asarray(recv_dict["data"], dtype=numpy.float32), recv_dict.get("device"),
+                       recv_dict.get("sequence"), recv_dict.get("timestamp"), recv_dict.get("batterylife"))
+
+    magic, version, code, ndim, battery, id_length, sequence, timestamp = HEADER.unpack_from(payload)
+    if magic != MAGIC:
+        raise ValueError("not a sensor window payload")
+    if not 1 <= version <= WIRE_VERSION:
+        raise ValueError(f"unsupported wire version {version}, expected up to {WIRE_VERSION}")
+    code, flags = code & 0x0F, code & 0xF0
+    offset = HEADER.size
+    device = bytes(payload[offset:offset + id_length]).decode()
+    offset += id_length
+    shape = struct.unpack_from(f'<{ndim}I', payload, offset)
+    offset += 4 * ndim
+    dtype = DTYPES[code]
+    if dtype == numpy.dtype('<i2'):
+        channels = shape[-1]
+        offsets = numpy.frombuffer(payload, dtype='<f4', count=channels, offset=offset)
+        scales = numpy.frombuffer(payload, dtype='<f4', count=channels, offset=offset + 4 * channels)
+        offset += 8 * channels
+    offset += _padding(offset)
+    count = 1
+    for n in shape:
+        count *= n
+    if count > MAX_VALUES:
+        raise ValueError(f"window of {count} values is larger than {MAX_VALUES}")
+    if flags & ZLIB:
+        payload, offset = _inflate(payload[offset:], count * dtype.itemsize), 0
+    if flags & DELTA:
+        deltas = numpy.frombuffer(payload, dtype=DELTA_DTYPES[code], count=count, offset=offset)
+        # integer sums wrap around just as the differences did
+        window = numpy.cumsum(deltas.reshape(-1, shape[-1]), axis=0, dtype=DELTA_DTYPES[code]).view(dtype).reshape(shape)
+    else:
+        window = numpy.frombuffer(payload, dtype=dtype, count=count, offset=offset).reshape(shape)
+    if dtype == numpy.dtype('<i2'):
+        window = (window * scales + offsets).astype(numpy.float32)
+    return Message(window, device, sequence, timestamp, None if battery == NO_BATTERY else battery, version)
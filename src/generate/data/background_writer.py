@@ -0,0 +1,85 @@
+'''
+CSV writes of the BLE notification callbacks in generate.py, moved onto a
+thread so a slow disk never stalls the callbacks.
+'''
+import queue
+import threading
+
+# Notifications BackgroundWriter holds before it starts dropping
+QUEUE_SIZE = 1000
+# Notifications BackgroundWriter writes between flushes
+BATCH_SIZE = 64
+
+
+class BackgroundWriter:
+    '''
+    Appends text to files from a thread fed by a bounded queue.
+
+    put() never blocks: each call is one notification's worth of (path, text)
+    pairs, dropped whole if the queue is full. It returns whether they were
+    queued, so callers only move on to the next sample once one was written.
+    The thread owns the file handles and flushes once per batch.
+    '''
+
+    def __init__(self, maxsize=QUEUE_SIZE, batch_size=BATCH_SIZE):
+        self.written = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self._batch_size = batch_size
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._files = {}
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def put(self, writes):
+        try:
+            self._queue.put_nowait(writes)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+        return True
+
+    def stats(self):
+        return f"written: {self.written}, queued: {self.depth()}, max queued: {self.max_depth}, dropped: {self.dropped}"
+
+    def _file(self, path):
+        if path not in self._files:
+            self._files[path] = open(path, 'a')
+        return self._files[path]
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            for writes in batch:
+                if writes is None:
+                    running = False
+                    break
+                for path, text in writes:
+                    self._file(path).write(text)
+                self.written += 1
+            for f in self._files.values():
+                f.flush()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
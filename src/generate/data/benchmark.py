@@ -0,0 +1,74 @@
+import os
+import numpy
+import asyncio
+import tempfile
+
+from time import perf_counter
+from argparse import ArgumentParser
+
+from capture import CHANNELS
+from background_writer import BackgroundWriter
+
+# Files written per notification tick: 3 + 3 + 3 motion files and baro + label
+GROUPS = (('acc_x', 'acc_y', 'acc_z'), ('mag_x', 'mag_y', 'mag_z'), ('gyro_x', 'gyro_y', 'gyro_z'), ('baro', 'y'))
+
+
+def reopen_writes(writes):
+    # what the generate.py callbacks used to do on every notification
+    for path, text in writes:
+        with open(path, 'a') as f:
+            f.write(text)
+
+
+async def notifications(rate, duration, handle):
+    '''Calls handle once per sensor group at `rate` Hz, returns per-callback times and the achieved rate'''
+    period = 1.0 / rate
+    ticks = int(rate * duration)
+    times = []
+    start = perf_counter()
+    for tick in range(ticks):
+        # sleep until the next tick is due, like notifications arriving from the tag
+        await asyncio.sleep(max(0.0, start + tick * period - perf_counter()))
+        end = "\n" if tick % 5 == 4 else ","
+        for group in GROUPS:
+            t = perf_counter()
+            handle([(name, "{}{}".format(numpy.random.rand(), end)) for name in group])
+            times.append(perf_counter() - t)
+    return numpy.array(times) * 1000.0, ticks / (perf_counter() - start)
+
+
+def bench_writer(args):
+    loop = asyncio.get_event_loop()
+    for rate in args.rate:
+        for mode in ("reopen", "background"):
+            with tempfile.TemporaryDirectory() as tmp:
+                paths = {name: os.path.join(tmp, name + ".csv") for name in CHANNELS + ('y',)}
+                writer = BackgroundWriter() if mode == "background" else None
+
+                def handle(writes):
+                    writes = [(paths[name], text) for name, text in writes]
+                    if writer is None:
+                        reopen_writes(writes)
+                    else:
+                        writer.put(writes)
+
+                times, achieved = loop.run_until_complete(notifications(rate, args.duration, handle))
+                stats = ""
+                if writer is not None:
+                    writer.close()
+                    stats = f", {writer.stats()}"
+                print(f"{rate:>4}Hz {mode:>10}: {achieved:6.1f} ticks/s, callback mean {times.mean():.3f}ms, "
+                      f"p99 {numpy.percentile(times, 99):.3f}ms, max {times.max():.3f}ms{stats}")
+
+
+if __name__ == '__main__':
+    p = ArgumentParser(description= "Benchmarks for data generation")
+    sub = p.add_subparsers(dest= "bench", required= True)
+
+    writer = sub.add_parser("writer", help= "callback cost of reopening files vs the background writer")
+    writer.add_argument("--rate", nargs= "+", default= [10, 25, 100], type= int, help= "notification rates in Hz")
+    writer.add_argument("--duration", default= 5.0, type= float, help= "seconds per rate and mode")
+    writer.set_defaults(func= bench_writer)
+
+    args = p.parse_args()
+    args.func(args)
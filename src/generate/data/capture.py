@@ -0,0 +1,137 @@
+'''
+Binary capture files for data generation.
+
+A capture is a short header followed by fixed-width little-endian records,
+one per sample. The writer keeps a single file open for the whole session and
+flushes records in chunks, so capturing never reopens files per sample.
+
+Running this file converts captures back into the CSV layout that
+load_dataset_group expects:
+
+    python capture.py ProjectData/train/captures/*.cap --group train --out ProjectData/
+'''
+import os
+import json
+import numpy
+
+from argparse import ArgumentParser
+
+MAGIC = b'CS3237CAP'
+VERSION = 1
+
+# Same order as the CSV files and the model input
+CHANNELS = ('acc_x', 'acc_y', 'acc_z',
+            'gyro_x', 'gyro_y', 'gyro_z',
+            'mag_x', 'mag_y', 'mag_z',
+            'baro')
+
+RECORD = numpy.dtype([('timestamp', '<f8')] + [(name, '<f4') for name in CHANNELS] + [('label', '<i4')])
+
+# Records buffered in memory before they are written out
+CHUNK_SIZE = 256
+
+
+def capture_header():
+    descr = json.dumps({'version': VERSION, 'descr': RECORD.descr}).encode()
+    return MAGIC + len(descr).to_bytes(4, 'little') + descr
+
+
+class CaptureWriter:
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.count = 0
+        self._chunk = numpy.zeros(chunk_size, dtype=RECORD)
+        self._pending = 0
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'ab')
+        if new_file:
+            self._file.write(capture_header())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, timestamp, baro, motion, label):
+        '''motion is (gyro xyz, accel xyz, mag xyz) as returned by MovementSensorMPU9250'''
+        record = self._chunk[self._pending]
+        record['timestamp'] = timestamp
+        record['gyro_x'], record['gyro_y'], record['gyro_z'] = motion[0:3]
+        record['acc_x'], record['acc_y'], record['acc_z'] = motion[3:6]
+        record['mag_x'], record['mag_y'], record['mag_z'] = motion[6:9]
+        record['baro'] = baro
+        record['label'] = int(label)
+        self._pending += 1
+        self.count += 1
+        if self._pending == len(self._chunk):
+            self.flush()
+
+    def flush(self):
+        self._file.write(self._chunk[:self._pending].tobytes())
+        self._file.flush()
+        self._pending = 0
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+
+def read_capture(path):
+    '''Returns the records of a capture as a read-only structured array, a torn last record is ignored'''
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        length = int.from_bytes(f.read(4), 'little')
+        header = json.loads(f.read(length))
+    if header['version'] != VERSION:
+        raise ValueError(f"{path} has capture version {header['version']}, expected {VERSION}")
+    offset = len(MAGIC) + 4 + length
+    count = (os.path.getsize(path) - offset) // RECORD.itemsize
+    if count == 0:
+        return numpy.zeros(0, dtype=RECORD)
+    return numpy.memmap(path, dtype=RECORD, mode='r', offset=offset, shape=(count,))
+
+
+def write_csv(paths, out, group, timesteps=5, append=False):
+    '''
+    Writes captures as out/<group>/IndividualSignals/<channel>_<group>.csv and
+    out/<group>/y_<group>.csv, one row of `timesteps` samples per window.
+    Windows never span two captures; leftover samples at the end of a capture are dropped.
+    Returns the number of windows written.
+    '''
+    signals = os.path.join(out, group, 'IndividualSignals')
+    os.makedirs(signals, exist_ok=True)
+    mode = 'a' if append else 'w'
+    files = {name: open(os.path.join(signals, f"{name}_{group}.csv"), mode) for name in CHANNELS}
+    files['label'] = open(os.path.join(out, group, f"y_{group}.csv"), mode)
+    windows = 0
+    try:
+        for path in paths:
+            records = read_capture(path)
+            n = len(records) // timesteps
+            records = records[:n * timesteps].reshape(n, timesteps)
+            for name in CHANNELS:
+                files[name].writelines(",".join(map(str, row)) + "\n" for row in records[name])
+            # the label of a window is the label of its last sample, as final_generate wrote it
+            files['label'].writelines(f"{label}\n" for label in records['label'][:, -1])
+            windows += n
+    finally:
+        for f in files.values():
+            f.close()
+    return windows
+
+
+if __name__ == '__main__':
+    p = ArgumentParser(description= "Convert capture files to the IndividualSignals CSV layout")
+    p.add_argument("captures", nargs= "+", type= str, help= "capture files, converted in order")
+    p.add_argument("--group", required= True, choices= ['train', 'test'], type= str, help= "dataset group")
+    p.add_argument("--out", default= "./ProjectData/", type= str, help= "dataset root")
+    p.add_argument("--timesteps", default= 5, type= int, help= "samples per window")
+    p.add_argument("--append", action= "store_true", help= "append to existing CSVs instead of replacing them")
+    args = p.parse_args()
+
+    windows = write_csv(args.captures, args.out, args.group, args.timesteps, args.append)
+    print(f"wrote {windows} windows to {os.path.join(args.out, args.group)}")
@@ -15,7 +15,9 @@ import struct
 import os
 import sys
 
+from time import time
 from bleak import BleakClient
+from capture import CaptureWriter
 
 # 0: Idle, 1: Nod, 2: Shake, 3: Look up, 4: Tilt
 LABEL = '0'
@@ -45,7 +47,7 @@ DATATYPE = "train"
 
 # Number of timesteps for lstm
 TIMESTEPS = 5
-val_count = 0
+CAPTURE_DIR = './ProjectData/{0}/captures'
 useful_data = 0
 write_count = 0
 
@@ -213,66 +215,42 @@ async def run(address):
         movement_sensor.register(gyro_sensor)
         movement_sensor.register(magneto_sensor)
         m_sensor = await movement_sensor.enable(client)
-        global val_count, useful_data, write_count
-
-        while (write_count < DATA_POINTS):
-            # await asyncio.sleep(0.08)
-            data1 = await barometer_sensor.read(client)
-            data2 = await m_sensor.read(client)
-            # data = await asyncio.gather(light_sensor.read(client), humidity_sensor.read(client))
-
-            # print(data1, data2)
-            if useful_data < START_THRESHOLD:
-                print(f"countdown: {START_THRESHOLD - useful_data}")
-                useful_data += 1
-                continue
-            elif useful_data == START_THRESHOLD:
-                print("You may begin!")
-                useful_data += 1
-                await asyncio.sleep(1)
-
-            with open('./ProjectData/{0}/IndividualSignals/acc_x_{0}.csv'.format(DATATYPE), 'a') as acc_x_file, \
-                    open('./ProjectData/{0}/IndividualSignals/acc_y_{0}.csv'.format(DATATYPE), 'a') as acc_y_file, \
-                    open('./ProjectData/{0}/IndividualSignals/acc_z_{0}.csv'.format(DATATYPE), 'a') as acc_z_file, \
-                    open('./ProjectData/{0}/IndividualSignals/baro_{0}.csv'.format(DATATYPE), 'a') as baro_file, \
-                    open('./ProjectData/{0}/IndividualSignals/gyro_x_{0}.csv'.format(DATATYPE), 'a') as gyro_x_file, \
-                    open('./ProjectData/{0}/IndividualSignals/gyro_y_{0}.csv'.format(DATATYPE), 'a') as gyro_y_file, \
-                    open('./ProjectData/{0}/IndividualSignals/gyro_z_{0}.csv'.format(DATATYPE), 'a') as gyro_z_file, \
-                    open('./ProjectData/{0}/IndividualSignals/mag_x_{0}.csv'.format(DATATYPE), 'a') as mag_x_file, \
-                    open('./ProjectData/{0}/IndividualSignals/mag_y_{0}.csv'.format(DATATYPE), 'a') as mag_y_file, \
-                    open('./ProjectData/{0}/IndividualSignals/mag_z_{0}.csv'.format(DATATYPE), 'a') as mag_z_file, \
-                    open('./ProjectData/{0}/y_{0}.csv'.format(DATATYPE), 'a') as result_file:
-
-                if val_count == TIMESTEPS - 1:
-                    gyro_x_file.write("{}\n".format(data2[0]))
-                    gyro_y_file.write("{}\n".format(data2[1]))
-                    gyro_z_file.write("{}\n".format(data2[2]))
-                    acc_x_file.write("{}\n".format(data2[3]))
-                    acc_y_file.write("{}\n".format(data2[4]))
-                    acc_z_file.write("{}\n".format(data2[5]))
-                    mag_x_file.write("{}\n".format(data2[6]))
-                    mag_y_file.write("{}\n".format(data2[7]))
-                    mag_z_file.write("{}\n".format(data2[8]))
-                    baro_file.write("{}\n".format(data1))
-                    result_file.write("{}\n".format(LABEL))
-                    val_count = 0
-                    write_count += 1
-                    print(f"writecount: {write_count / TIMESTEPS}")
-                else:
-                    gyro_x_file.write("{},".format(data2[0]))
-                    gyro_y_file.write("{},".format(data2[1]))
-                    gyro_z_file.write("{},".format(data2[2]))
-                    acc_x_file.write("{},".format(data2[3]))
-                    acc_y_file.write("{},".format(data2[4]))
-                    acc_z_file.write("{},".format(data2[5]))
-                    mag_x_file.write("{},".format(data2[6]))
-                    mag_y_file.write("{},".format(data2[7]))
-                    mag_z_file.write("{},".format(data2[8]))
-                    baro_file.write("{},".format(data1))
-                    val_count += 1
-                    write_count += 1
-
-        print("Finished training...")
+
+        # one capture file per session, convert with capture.py once recording is done
+        os.makedirs(CAPTURE_DIR.format(DATATYPE), exist_ok=True)
+        path = os.path.join(CAPTURE_DIR.format(DATATYPE),
+                            "{}_{:%Y%m%d_%H%M%S}.cap".format(LABEL, datetime.datetime.now()))
+        with CaptureWriter(path) as capture:
+            await record(client, barometer_sensor, m_sensor, capture)
+
+        print(f"Saved {capture.count} samples to {path}")
+
+
+async def record(client, barometer_sensor, m_sensor, capture):
+    global useful_data, write_count
+
+    while (write_count < DATA_POINTS):
+        # await asyncio.sleep(0.08)
+        data1 = await barometer_sensor.read(client)
+        data2 = await m_sensor.read(client)
+        # data = await asyncio.gather(light_sensor.read(client), humidity_sensor.read(client))
+
+        # print(data1, data2)
+        if useful_data < START_THRESHOLD:
+            print(f"countdown: {START_THRESHOLD - useful_data}")
+            useful_data += 1
+            continue
+        elif useful_data == START_THRESHOLD:
+            print("You may begin!")
+            useful_data += 1
+            await asyncio.sleep(1)
+
+        capture.write(time(), data1, data2, LABEL)
+        write_count += 1
+        if write_count % TIMESTEPS == 0:
+            print(f"writecount: {write_count / TIMESTEPS}")
+
+    print("Finished training...")
 
 
 if __name__ == "__main__":
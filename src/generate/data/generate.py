@@ -17,6 +17,7 @@ import csv
 
 from time import time
 from bleak import BleakClient
+from background_writer import BackgroundWriter
 
 # 1: Nod, 2: Shake, 3: Look up, 4: Tilt
 LABEL = '2'
@@ -40,6 +41,12 @@ gryo_count = 0
 mag_count = 0
 baro_count = 0
 useful_data = 0
+# Owns the CSV files, notification callbacks only queue their lines
+WRITER = None
+
+
+def signal_path(name):
+    return './ProjectData/{0}/IndividualSignals/{1}_{0}.csv'.format(DATATYPE, name)
 
 
 class Service:
@@ -157,19 +164,11 @@ class AccelerometerSensorMovementSensorMPU9250(MovementSensorMPU9250SubService):
 
     def save_values(self):
         global accel_count
-        with open('./ProjectData/{0}/IndividualSignals/acc_x_{0}.csv'.format(DATATYPE), 'a') as a, \
-                open('./ProjectData/{0}/IndividualSignals/acc_y_{0}.csv'.format(DATATYPE), 'a') as b, \
-                open('./ProjectData/{0}/IndividualSignals/acc_z_{0}.csv'.format(DATATYPE), 'a') as c:
-            if accel_count == TIMESTEPS - 1:
-                a.write("{}\n".format(self.scaledVals[0]))
-                b.write("{}\n".format(self.scaledVals[1]))
-                c.write("{}\n".format(self.scaledVals[2]))
-                accel_count = 0
-            else:
-                a.write("{},".format(self.scaledVals[0]))
-                b.write("{},".format(self.scaledVals[1]))
-                c.write("{},".format(self.scaledVals[2]))
-                accel_count += 1
+        end = "\n" if accel_count == TIMESTEPS - 1 else ","
+        # a dropped sample leaves the row where it was, so rows stay TIMESTEPS long
+        if WRITER.put([(signal_path(name), "{}{}".format(value, end))
+                       for name, value in zip(('acc_x', 'acc_y', 'acc_z'), self.scaledVals)]):
+            accel_count = (accel_count + 1) % TIMESTEPS
 
 
 class MagnetometerSensorMovementSensorMPU9250(MovementSensorMPU9250SubService):
@@ -200,19 +199,10 @@ class MagnetometerSensorMovementSensorMPU9250(MovementSensorMPU9250SubService):
 
     def save_values(self):
         global mag_count
-        with open('./ProjectData/{0}/IndividualSignals/mag_x_{0}.csv'.format(DATATYPE), 'a') as a, \
-                open('./ProjectData/{0}/IndividualSignals/mag_y_{0}.csv'.format(DATATYPE), 'a') as b, \
-                open('./ProjectData/{0}/IndividualSignals/mag_z_{0}.csv'.format(DATATYPE), 'a') as c:
-            if mag_count == TIMESTEPS - 1:
-                a.write("{}\n".format(self.scaledVals[0]))
-                b.write("{}\n".format(self.scaledVals[1]))
-                c.write("{}\n".format(self.scaledVals[2]))
-                mag_count = 0
-            else:
-                a.write("{},".format(self.scaledVals[0]))
-                b.write("{},".format(self.scaledVals[1]))
-                c.write("{},".format(self.scaledVals[2]))
-                mag_count += 1
+        end = "\n" if mag_count == TIMESTEPS - 1 else ","
+        if WRITER.put([(signal_path(name), "{}{}".format(value, end))
+                       for name, value in zip(('mag_x', 'mag_y', 'mag_z'), self.scaledVals)]):
+            mag_count = (mag_count + 1) % TIMESTEPS
 
 
 class GyroscopeSensorMovementSensorMPU9250(MovementSensorMPU9250SubService):
@@ -242,19 +232,10 @@ class GyroscopeSensorMovementSensorMPU9250(MovementSensorMPU9250SubService):
 
     def save_values(self):
         global gryo_count
-        with open('./ProjectData/{0}/IndividualSignals/gyro_x_{0}.csv'.format(DATATYPE), 'a') as a, \
-                open('./ProjectData/{0}/IndividualSignals/gyro_y_{0}.csv'.format(DATATYPE), 'a') as b, \
-                open('./ProjectData/{0}/IndividualSignals/gyro_z_{0}.csv'.format(DATATYPE), 'a') as c:
-            if gryo_count == TIMESTEPS - 1:
-                a.write("{}\n".format(self.scaledVals[0]))
-                b.write("{}\n".format(self.scaledVals[1]))
-                c.write("{}\n".format(self.scaledVals[2]))
-                gryo_count = 0
-            else:
-                a.write("{},".format(self.scaledVals[0]))
-                b.write("{},".format(self.scaledVals[1]))
-                c.write("{},".format(self.scaledVals[2]))
-                gryo_count += 1
+        end = "\n" if gryo_count == TIMESTEPS - 1 else ","
+        if WRITER.put([(signal_path(name), "{}{}".format(value, end))
+                       for name, value in zip(('gyro_x', 'gyro_y', 'gyro_z'), self.scaledVals)]):
+            gryo_count = (gryo_count + 1) % TIMESTEPS
 
 
 class BarometerSensor(Sensor):
@@ -288,18 +269,13 @@ class BarometerSensor(Sensor):
 
     def save_values(self):
         global baro_count
-        with open('./ProjectData/{0}/IndividualSignals/baro_{0}.csv'.format(DATATYPE), 'a') as barofile,\
-                open('./ProjectData/{0}/y_{0}.csv'.format(DATATYPE), 'a') as yfile:
-            if baro_count == TIMESTEPS - 1:
-                barofile.write(str(self.press))
-                barofile.write('\n')
-                yfile.write(LABEL)
-                yfile.write('\n')
-                baro_count = 0
-            else:
-                barofile.write(str(self.press))
-                barofile.write(',')
-                baro_count += 1
+        if baro_count == TIMESTEPS - 1:
+            writes = [(signal_path('baro'), "{}\n".format(self.press)),
+                      ('./ProjectData/{0}/y_{0}.csv'.format(DATATYPE), "{}\n".format(LABEL))]
+        else:
+            writes = [(signal_path('baro'), "{},".format(self.press))]
+        if WRITER.put(writes):
+            baro_count = (baro_count + 1) % TIMESTEPS
 
 
 class LEDAndBuzzer(Service):
@@ -360,6 +336,7 @@ async def run(address):
             await asyncio.sleep(1.0)
 
             if cntr == 0:
+                print(f"writer {WRITER.stats()}")
                 # shine the red light
                 await led_and_buzzer.notify(client, 0x01)
 
@@ -392,6 +369,7 @@ if __name__ == "__main__":
             LABEL, LABELTOACTION[LABEL]))
 
         loop = asyncio.get_event_loop()
+        WRITER = BackgroundWriter()
 
         try:
             loop.run_until_complete(run(address))
@@ -402,6 +380,9 @@ if __name__ == "__main__":
             print("Received exit, exiting...")
         except Exception as e:
             print(f"exception: {e}")
+        finally:
+            WRITER.close()
+            print(f"writer {WRITER.stats()}")
 
         # finally:
         #     loop.stop()
@@ -0,0 +1,62 @@
+import os
+import numpy
+import tempfile
+import tracemalloc
+
+from time import perf_counter
+from argparse import ArgumentParser
+
+from dataset import TIMESTEPS, load_file, load_group, load_group_parallel, group_files, load_dataset_group
+
+
+def write_synthetic(prefix, group, windows, timesteps=TIMESTEPS):
+    '''Writes a random dataset group in the IndividualSignals layout'''
+    filenames, labels = group_files(group, prefix)
+    os.makedirs(os.path.dirname(filenames[0]), exist_ok=True)
+    for name in filenames:
+        numpy.savetxt(name, numpy.random.randn(windows, timesteps), delimiter=",", fmt="%.8f")
+    numpy.savetxt(labels, numpy.random.randint(0, 4, windows), fmt="%d")
+    return filenames, labels
+
+
+def measure(fn):
+    '''Returns the result of fn with its wall time in seconds and peak traced memory in MiB'''
+    tracemalloc.start()
+    start = perf_counter()
+    result = fn()
+    elapsed = perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def bench_load(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        prefix = tmp + "/"
+        filenames, labels = write_synthetic(prefix, "train", args.windows)
+        n_windows = len(load_file(labels))
+        print(f"{args.windows} windows x {TIMESTEPS} timesteps x {len(filenames)} channels")
+
+        runs = [
+            ("sequential + dstack", lambda: load_group(filenames)),
+            ("parallel, 1 worker", lambda: load_group_parallel(filenames, n_windows, workers=1)),
+            ("parallel", lambda: load_group_parallel(filenames, n_windows, workers=args.workers)),
+            ("cache build", lambda: load_dataset_group("train", prefix, workers=args.workers)[0]),
+            ("cache hit (mmap)", lambda: load_dataset_group("train", prefix, workers=args.workers)[0]),
+        ]
+        for name, fn in runs:
+            X, elapsed, peak = measure(fn)
+            print(f"{name:>20}: {elapsed:7.3f}s, peak {peak:7.1f}MiB, {X.dtype} {X.shape}")
+
+
+if __name__ == '__main__':
+    p = ArgumentParser(description= "Benchmarks for dataset loading")
+    sub = p.add_subparsers(dest= "bench", required= True)
+
+    load = sub.add_parser("load", help= "load time and peak memory of the dataset loaders")
+    load.add_argument("--windows", default= 100000, type= int, help= "windows in the synthetic dataset")
+    load.add_argument("--workers", type= int, help= "threads for the parallel loader (default: one per channel)")
+    load.set_defaults(func= bench_load)
+
+    args = p.parse_args()
+    args.func(args)
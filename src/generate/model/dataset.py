@@ -0,0 +1,170 @@
+import os
+import json
+import numpy
+import zipfile
+
+from numpy import dstack
+from functools import partial
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from pandas import read_csv
+
+# file structure for data required:
+# /ProjectData
+# 	train
+# 		y_train.csv
+# 		/IndividualSignals
+# 			acc_x_train.csv ... baro_train.csv
+# 	test
+# 		y_test.csv
+# 		/IndividualSignals
+# 			acc_x_test.csv ... baro_test.csv
+#
+# If a group directory is missing, its zip (ProjectData/train.zip) is read
+# directly, without extracting. Parsed groups are cached under cache/ as a
+# (N, T, 10) float32 .npy plus labels, and reused with mmap while the source
+# files are unchanged.
+
+# feature order of the model input
+CHANNELS = ('acc_x', 'acc_y', 'acc_z',
+            'gyro_x', 'gyro_y', 'gyro_z',
+            'mag_x', 'mag_y', 'mag_z',
+            'baro')
+
+CACHE_DIR = 'cache'
+# samples per window, i.e. columns per row of every signal file
+TIMESTEPS = 5
+
+
+# load a single file as a numpy array
+def load_file(filepath):
+    dataframe = read_csv(filepath, header=None)
+    return dataframe.values
+
+
+# load a list of files and return as a 3d numpy array
+def load_group(filenames, prefix=''):
+    loaded = list()
+    for name in filenames:
+        data = load_file(prefix + name)
+        loaded.append(data)
+    # stack group so that features are the 3rd dimension
+    loaded = dstack(loaded)
+    return loaded
+
+
+def read_channel(f, timesteps=TIMESTEPS):
+    '''Parses one signal file as float32 with a fixed column count'''
+    return read_csv(f, header=None, names=range(timesteps), dtype=numpy.float32, engine='c').values
+
+
+def count_columns(f):
+    return f.readline().count(b',') + 1
+
+
+@contextmanager
+def zip_member(archive_path, name):
+    # one ZipFile per member so threads never share a file position
+    with zipfile.ZipFile(archive_path) as archive, archive.open(name) as f:
+        yield f
+
+
+# load a list of files in parallel straight into a (n_windows, timesteps, files) float32 array
+def load_group_parallel(filenames, n_windows, opener=partial(open, mode='rb'), timesteps=None, workers=None):
+    if timesteps is None:
+        with opener(filenames[0]) as f:
+            timesteps = count_columns(f)
+    X = numpy.empty((n_windows, timesteps, len(filenames)), dtype=numpy.float32)
+
+    def fill(i):
+        with opener(filenames[i]) as f:
+            X[:, :, i] = read_channel(f, timesteps)
+
+    # the C parser releases the GIL, so threads parse the channels side by side
+    with ThreadPoolExecutor(workers or len(filenames)) as pool:
+        list(pool.map(fill, range(len(filenames))))
+    return X
+
+
+def group_files(group, prefix=''):
+    '''Returns the 10 signal files of a group in CHANNELS order and its label file'''
+    filepath = prefix + group + '/IndividualSignals/'
+    filenames = [filepath + name + '_' + group + '.csv' for name in CHANNELS]
+    return filenames, prefix + group + '/y_' + group + '.csv'
+
+
+def source_stats(paths):
+    stats = []
+    for path in paths:
+        st = os.stat(path)
+        stats.append([path, st.st_mtime_ns, st.st_size])
+    return stats
+
+
+def cache_paths(group, prefix=''):
+    cache = prefix + CACHE_DIR
+    return (os.path.join(cache, group + '_X.npy'),
+            os.path.join(cache, group + '_y.npy'),
+            os.path.join(cache, group + '.json'))
+
+
+def load_cached(group, prefix, sources):
+    '''Returns the cached (X, y) if it was built from exactly these source files, else None'''
+    x_path, y_path, manifest_path = cache_paths(group, prefix)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest != source_stats(sources):
+            return None
+        return numpy.load(x_path, mmap_mode='r'), numpy.load(y_path, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+
+
+def save_cached(group, prefix, sources, X, y):
+    x_path, y_path, manifest_path = cache_paths(group, prefix)
+    os.makedirs(os.path.dirname(x_path), exist_ok=True)
+    # write everything under temporary names first so a crash never leaves a half-written cache
+    for path, array in ((x_path, X), (y_path, y)):
+        with open(path + '.tmp', 'wb') as f:
+            numpy.save(f, array)
+        os.replace(path + '.tmp', path)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(source_stats(sources), f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def load_zip_group(archive_path, group, workers=None):
+    '''Parses a group straight out of its zip, streaming each member through read_csv'''
+    # members are named like the extracted files, relative to the zip
+    filenames, labels = group_files(group)
+    opener = partial(zip_member, archive_path)
+    with opener(labels) as f:
+        y = load_file(f)
+    X = load_group_parallel(filenames, len(y), opener, workers=workers)
+    return X, y
+
+
+# load a dataset group, such as train or test
+def load_dataset_group(group, prefix='', cache=True, workers=None):
+    archive = prefix + group + '.zip'
+    from_zip = not os.path.isdir(prefix + group) and os.path.exists(archive)
+    if from_zip:
+        sources = [archive]
+    else:
+        filenames, labels = group_files(group, prefix)
+        sources = filenames + [labels]
+    if cache:
+        cached = load_cached(group, prefix, sources)
+        if cached is not None:
+            return cached
+    if from_zip:
+        X, y = load_zip_group(archive, group, workers)
+    else:
+        # load class output
+        y = load_file(labels)
+        # load input data
+        X = load_group_parallel(filenames, len(y), workers=workers)
+    if cache:
+        save_cached(group, prefix, sources, X, y)
+    return X, y
@@ -1,9 +1,5 @@
-import numpy as np
 import os
-from numpy import mean
-from numpy import std
-from numpy import dstack
-from pandas import read_csv
+from dataset import load_dataset_group
 from keras.models import Sequential
 from keras.layers import Dense
 from keras.layers import Flatten
@@ -21,49 +17,6 @@ MODEL_NAME = 'lstm_model.hd5'
 NUM_CLASSES = 4
 
 
-def load_file(filepath):
-    dataframe = read_csv(filepath, header=None, delim_whitespace=False)
-    return dataframe.values
-
-# load a list of files and return as a 3d numpy array
-
-
-def load_group(filenames, prefix=''):
-    loaded = list()
-    for name in filenames:
-        data = load_file(prefix + name)
-        loaded.append(data)
-    # stack group so that features are the 3rd dimension
-    loaded = dstack(loaded)
-    return loaded
-
-
-# load a dataset group, such as train or test
-def load_dataset_group(group, prefix=''):
-    # # filepath: /ProjectData/IndividualSignals
-    # filepath = prefix + 'IndividualSignals\\'
-
-    filepath = prefix + group + '/IndividualSignals/'
-    # load all 9 files as a single array
-    filenames = list()
-    # acceleration
-    filenames += ['acc_x_'+group+'.csv', 'acc_y_' +
-                  group+'.csv', 'acc_z_'+group+'.csv']
-    # body gyroscope
-    filenames += ['gyro_x_'+group+'.csv', 'gyro_y_' +
-                  group+'.csv', 'gyro_z_'+group+'.csv']
-    # magnetometer
-    filenames += ['mag_x_'+group+'.csv', 'mag_y_' +
-                  group+'.csv', 'mag_z_'+group+'.csv']
-    # barometer
-    filenames += ['baro_'+group+'.csv']
-    # load input data
-    X = load_group(filenames, filepath)
-    # load class output
-    y = load_file(prefix + group + '/y_'+group+'.csv')
-    return X, y
-
-
 # load the dataset, returns train and test X and y elements
 def load_dataset(prefix=''):
     # load all train